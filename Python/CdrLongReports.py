@@ -38,6 +38,7 @@ import cdr
 import cdrbatch
 import cdrcgi
 from cdrapi import db
+from cdrapi.docs import Resolver
 
 class BatchReport:
     """
@@ -1813,12 +1814,15 @@ class Control:
         if job_id.isdigit():
             logger.info("CdrLongReports: job id %s", job_id)
             job = cdrbatch.CdrBatch(job_id)
+            Resolver.cache_callbacks(cutoff=job.getStarted())
             try:
                 cls.get_job_class(job.getJobName())(job).run()
             except Exception as e:
                 message = "Failure executing job %s: %s" % (job_id, e)
                 logger.exception("failure executing job %s", job_id)
                 job.fail("Caught exception: %s" % e)
+            finally:
+                Resolver.stop_caching_callbacks(logger)
         else:
             job_name = job_id
             job_class = cls.get_job_class(job_name)
@@ -436,8 +436,12 @@ class CdrRepublisher:
                      (id INTEGER NOT NULL UNIQUE,
              doc_version INTEGER     NULL)""")
         self.__conn.commit()
-        for docId in self.__docs:
-            self.__cursor.execute("INSERT INTO #docs (id) VALUES(?)", docId)
+        if self.__docs:
+            rows = [(docId,) for docId in self.__docs]
+            self.__cursor.fast_executemany = True
+            self.__cursor.executemany("INSERT INTO #docs (id) VALUES(?)",
+                                      rows)
+            self.__cursor.fast_executemany = False
         self.__conn.commit()
         if DEBUG:
             self.__logger.info("republish(): added %d rows to #docs table; "
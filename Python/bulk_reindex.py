@@ -0,0 +1,532 @@
+"""
+Reindex CDR documents in bulk, using a pool of worker processes
+
+Needed after every change to the `query_term_def` table, and after a
+database has been refreshed from another tier. The documents can be
+selected by document type, by ID, or by a "modified since" cutoff
+(or by a combination of these). Each worker process has its own
+`Session` object (and therefore its own database connection), and
+fetches the XML for a whole batch of documents in a single query.
+
+Progress is logged as each batch is finished, and the IDs of the
+documents which have been processed are appended to a checkpoint
+file (if one is named), so that an interrupted run can be resumed
+by running the same command again. A checkpoint file written by a run
+with a different document type, cutoff, or set of paths is refused.
+
+When new paths have been added to the `query_term_def` table, the
+--paths option runs a much cheaper backfill instead of a full reindex:
+only the documents of the types the new paths can match are visited,
+only the new paths are evaluated, and the resulting rows are added to
+the `query_term` and `query_term_pub` tables without touching the rows
+for any other paths.
+
+Usage:
+    python bulk_reindex.py --session SESSION --doctype Summary
+    python bulk_reindex.py --user USER --since 2024-01-01 --processes 8
+    python bulk_reindex.py --session SESSION --paths /Term/SemanticType
+
+Run with --help for the complete list of options.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+import json
+import os
+from cdrapi.db import Query
+from cdrapi.docs import Doc, IndexPlan
+from cdrapi.settings import Tier
+from cdrapi.users import Session
+
+
+class Reindexer:
+    """
+    Reindex a set of documents using parallel worker processes
+
+    Attributes:
+      session - reference to object representing the current login
+      logger - object for recording what we do
+      doctype - optional name of document type to be reindexed
+      since - optional date/time cutoff for documents saved since then
+      checkpoint - optional path for the file recording our progress
+      processes - number of worker processes to use
+      batch_size - number of documents to hand to a worker at a time
+      force - if True, don't skip documents whose index rows are current
+      paths - optional sequence of new `query_term_def` paths to backfill
+      doctypes - names of the document types to be processed (None for all)
+      ids - sequence of integers for the documents to be reindexed
+    """
+
+    LOGNAME = "bulk-reindex"
+    PROCESSES = 4
+    BATCH_SIZE = 50
+
+    def __init__(self, session, **opts):
+        """
+        Capture the caller's options
+
+        Pass:
+          session - reference to object representing the current login
+
+        Optional keyword arguments:
+          doctype - name of document type to be reindexed
+          ids - sequence of document IDs to be reindexed
+          since - date/time (or string) cutoff; only documents saved
+                  on or after this point in time will be reindexed
+          checkpoint - path for file used to record (and resume) progress
+          processes - number of worker processes to use (default 4)
+          batch_size - number of documents per batch (default 50)
+          force - if True, don't skip documents whose index rows are
+                  already current (see `IndexDigests`)
+          paths - sequence of newly added `query_term_def` paths; if
+                  present, only the values for these paths are added
+                  (a backfill) instead of reindexing the documents
+          logger - override for the default logger
+        """
+
+        self.__session = session
+        self.__opts = opts
+
+    @property
+    def batch_size(self):
+        """Number of documents to hand to a worker at a time."""
+        return self.__opts.get("batch_size") or self.BATCH_SIZE
+
+    @property
+    def checkpoint(self):
+        """Optional path for the file recording our progress."""
+        return self.__opts.get("checkpoint")
+
+    @property
+    def doctype(self):
+        """Optional name of the type of documents to be reindexed."""
+        return self.__opts.get("doctype")
+
+    @property
+    def doctypes(self):
+        """
+        Names of the types of documents to be processed (None for all)
+
+        For a backfill, the types are derived from the new paths, unless
+        the caller named a type explicitly, or one of the paths is
+        relative (and can therefore match any type of document).
+        """
+
+        if not hasattr(self, "_doctypes"):
+            if self.doctype:
+                self._doctypes = [self.doctype]
+            elif self.paths:
+                doctypes = {path.split("/")[1] for path in self.paths}
+                self._doctypes = None if "" in doctypes else sorted(doctypes)
+            else:
+                self._doctypes = None
+        return self._doctypes
+
+    @property
+    def force(self):
+        """If True, rebuild the index rows even for unchanged documents."""
+        return True if self.__opts.get("force") else False
+
+    @property
+    def ids(self):
+        """
+        Sequence of integers for the documents to be reindexed
+
+        If no selection criteria are given, all documents are selected.
+        """
+
+        if not hasattr(self, "_ids"):
+            query = Query("document d", "d.id").order("d.id")
+            if self.doctypes:
+                query.join("doc_type t", "t.id = d.doc_type")
+                query.where(query.Condition("t.name", self.doctypes, "IN"))
+            if self.since:
+                subquery = Query("audit_trail", "document")
+                subquery.where(subquery.Condition("dt", self.since, ">="))
+                query.where(query.Condition("d.id", subquery, "IN"))
+            rows = query.execute(self.session.cursor).fetchall()
+            self._ids = [row.id for row in rows]
+
+            # Filter on an ID list here (it could be too long for SQL).
+            if self.__opts.get("ids"):
+                ids = {Doc.extract_id(id) for id in self.__opts["ids"]}
+                self._ids = [id for id in self._ids if id in ids]
+        return self._ids
+
+    @property
+    def logger(self):
+        """Object for recording what we do."""
+
+        if not hasattr(self, "_logger"):
+            self._logger = self.__opts.get("logger")
+            if self._logger is None:
+                opts = dict(console=True, rolling=True)
+                self._logger = self.session.tier.get_logger(self.LOGNAME,
+                                                            **opts)
+        return self._logger
+
+    @property
+    def paths(self):
+        """New `query_term_def` paths to be backfilled (if any)."""
+        return self.__opts.get("paths")
+
+    @property
+    def processes(self):
+        """Number of worker processes to use."""
+        return self.__opts.get("processes") or self.PROCESSES
+
+    @property
+    def session(self):
+        """Reference to object representing the current login."""
+        return self.__session
+
+    @property
+    def since(self):
+        """Optional cutoff for documents saved on or after this time."""
+
+        if not hasattr(self, "_since"):
+            self._since = self.__opts.get("since")
+            if isinstance(self._since, str):
+                self._since = datetime.datetime.fromisoformat(self._since)
+        return self._since
+
+    def run(self):
+        """
+        Reindex the documents and report on the results
+
+        Return:
+          dictionary with counts for "done", "failed", and "skipped"
+          (the last of these for documents already processed by an
+          earlier run recorded in the checkpoint file), as well as
+          the elapsed number of seconds and a list of failures
+          (each a tuple of document ID and error message)
+        """
+
+        # Find out what's left to do.
+        start = datetime.datetime.now()
+        finished = self.__load_checkpoint()
+        self.__start_checkpoint(finished)
+        todo = [doc_id for doc_id in self.ids if doc_id not in finished]
+        skipped = len(self.ids) - len(todo)
+        action = "backfill" if self.paths else "reindex"
+        args = action, len(todo), self.processes, skipped
+        self.logger.info("%sing %d docs with %d processes (%d skipped)",
+                         *args)
+        if self.paths:
+            self.logger.info("backfilling %s", ", ".join(self.paths))
+
+        # Hand the batches off to the worker processes.
+        batches = []
+        for i in range(0, len(todo), self.batch_size):
+            batches.append(todo[i:i+self.batch_size])
+        init_args = self.session.name, self.session.tier.name
+        opts = dict(
+            max_workers=self.processes,
+            initializer=_init_worker,
+            initargs=init_args,
+        )
+        done = 0
+        failures = []
+        with ProcessPoolExecutor(**opts) as executor:
+            futures = {}
+            for batch in batches:
+                if self.paths:
+                    args = _backfill_batch, batch, self.paths
+                else:
+                    args = _reindex_batch, batch, self.force
+                futures[executor.submit(*args)] = batch
+            for future in as_completed(futures):
+                try:
+                    processed, failed = future.result()
+                except Exception as e:
+                    self.logger.exception("batch failure")
+                    processed = []
+                    failed = [(doc_id, str(e)) for doc_id in futures[future]]
+                for doc_id, error in failed:
+                    self.logger.error("CDR%d: %s", doc_id, error)
+                failures += failed
+                done += len(processed)
+                self.__save_checkpoint(processed)
+                elapsed = (datetime.datetime.now() - start).total_seconds()
+                rate = done / elapsed if elapsed else 0
+                args = done, len(todo), action, rate, len(failures)
+                self.logger.info("%d of %d docs %sed (%.1f docs/sec); "
+                                 "%d failures", *args)
+
+        # Report the results.
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        args = action, done, elapsed, len(failures)
+        self.logger.info("%sed %d docs in %f seconds with %d failures",
+                         *args)
+        return dict(
+            done=done,
+            failed=len(failures),
+            skipped=skipped,
+            elapsed=elapsed,
+            failures=failures,
+        )
+
+    def __load_checkpoint(self):
+        """
+        Find out which documents an earlier run has already reindexed
+
+        The earlier run must have used the same document type, cutoff,
+        and backfill paths. Otherwise the documents it recorded weren't
+        necessarily processed the way this run would process them, so
+        we refuse to resume from its checkpoint.
+
+        The first line of the file holds the options and the documents
+        processed by earlier runs, and each line after that holds the
+        IDs for one finished batch (see `__save_checkpoint()`).
+
+        Return:
+          set of integers for document IDs
+        """
+
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint, encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+        values = json.loads(lines[0])
+        for name, value in self.__get_checkpoint_options().items():
+            if values.get(name) != value:
+                args = self.checkpoint, name, values.get(name), value
+                raise Exception("checkpoint {} has {}={!r} (not {!r}); "
+                                "remove it or use another checkpoint "
+                                "file".format(*args))
+        self.logger.info("resuming from %s", self.checkpoint)
+        finished = set(values.get("done", []))
+        for line in lines[1:]:
+            try:
+                finished.update(json.loads(line))
+            except ValueError:
+                self.logger.warning("ignoring partial checkpoint line")
+        return finished
+
+    def __get_checkpoint_options(self):
+        """
+        Assemble the options recorded with the checkpoint
+
+        Return:
+          dictionary of JSON-friendly values for the options which
+          determine what a run does to each document
+        """
+
+        return dict(
+            doctype=self.doctype,
+            since=str(self.since) if self.since else None,
+            paths=list(self.paths) if self.paths else None,
+        )
+
+    def __save_checkpoint(self, processed):
+        """
+        Record the documents processed by a finished batch
+
+        Only the batch's IDs are appended to the file, so the cost of
+        recording progress doesn't grow as the run goes on. A line cut
+        short by an interruption is ignored when the run is resumed.
+
+        Pass:
+          processed - sequence of integers for the batch's document IDs
+        """
+
+        if self.checkpoint and processed:
+            with open(self.checkpoint, "a", encoding="utf-8") as fp:
+                fp.write(json.dumps(sorted(processed)) + "\n")
+
+    def __start_checkpoint(self, finished):
+        """
+        Write a fresh checkpoint file for this run
+
+        The options and the documents finished by earlier runs are
+        written to a temporary location and then moved into place,
+        so an interruption can't leave a partial file.
+
+        Pass:
+          finished - set of integers for the already processed IDs
+        """
+
+        if self.checkpoint:
+            values = self.__get_checkpoint_options()
+            values["done"] = sorted(finished)
+            path = f"{self.checkpoint}.tmp"
+            with open(path, "w", encoding="utf-8") as fp:
+                fp.write(json.dumps(values) + "\n")
+            os.replace(path, self.checkpoint)
+
+
+# Each worker process gets its own `Session` object (and connection).
+_session = None
+
+
+def _init_worker(name, tier):
+    """
+    Connect the worker process to the parent's CDR session
+
+    Pass:
+      name - string for the parent's session name
+      tier - name of the CDR tier
+    """
+
+    global _session
+    _session = Session(name, tier=tier)
+
+
+def _reindex_batch(ids, force=False):
+    """
+    Reindex a batch of documents in a worker process
+
+    Pass:
+      ids - sequence of integers for the documents to be reindexed
+      force - if True, don't skip documents whose index rows are current
+
+    Return:
+      tuple of the sequence of IDs for the documents which were
+      processed and a sequence of tuples of ID and error message for
+      documents which could not be reindexed
+    """
+
+    processed = []
+    failures = []
+    docs = Doc.bulk_load(_session, ids, version=None)
+    loaded = {doc.id for doc in docs}
+    for doc_id in ids:
+        if doc_id not in loaded:
+            failures.append((doc_id, "document not found"))
+    for doc in docs:
+        try:
+            doc.reindex(force=force)
+            processed.append(doc.id)
+        except Exception as e:
+            failures.append((doc.id, str(e)))
+    return processed, failures
+
+
+def _backfill_batch(ids, paths):
+    """
+    Add the index rows for new paths for a batch of documents
+
+    The current working documents are used for the `query_term` table,
+    and the latest publishable versions for the `query_term_pub` table.
+    Any rows already present for the new paths (for example, because
+    the document was saved after the paths were added) are replaced
+    for the documents whose values were collected successfully, and
+    the rows for all other paths are left alone. Both tables are
+    updated in a single transaction.
+
+    Pass:
+      ids - sequence of integers for the documents to be processed
+      paths - sequence of new `query_term_def` path strings
+
+    Return:
+      tuple of the sequence of IDs for the documents which were
+      processed and a sequence of tuples of ID and error message for
+      documents which could not be processed
+    """
+
+    plan = IndexPlan("backfill", paths)
+    processed = set()
+    failures = []
+    cursor = _session.conn.cursor()
+    try:
+        tables = ("query_term", None), ("query_term_pub", "lastp")
+        for table, version in tables:
+            rows = []
+            collected = []
+            for doc in Doc.bulk_load(_session, ids, version=version):
+                try:
+                    terms = doc.collect_query_terms(plan)
+                    rows += Doc.make_query_term_rows(doc.id, terms)
+                    processed.add(doc.id)
+                    collected.append(doc.id)
+                except Exception as e:
+                    failures.append((doc.id, str(e)))
+
+            # Find the existing rows to be replaced (the IN tests take
+            # care of lists too long to pass as separate parameters).
+            stale = []
+            if collected:
+                query = Query(table, "doc_id", "path").unique()
+                query.where(query.Condition("doc_id", collected, "IN"))
+                query.where(query.Condition("path", paths, "IN"))
+                stale = [tuple(r) for r in query.execute(cursor).fetchall()]
+            cursor.fast_executemany = True
+            try:
+                if stale:
+                    delete = "DELETE FROM {} WHERE doc_id = ? AND path = ?"
+                    cursor.executemany(delete.format(table), stale)
+                if rows:
+                    insert = Doc.QUERY_TERM_INSERT.format(table)
+                    cursor.executemany(insert, rows)
+            finally:
+                cursor.fast_executemany = False
+        _session.conn.commit()
+    except Exception as e:
+        _session.conn.rollback()
+        return [], [(doc_id, str(e)) for doc_id in ids]
+    finally:
+        cursor.close()
+    failed = {doc_id for doc_id, error in failures}
+    for doc_id in ids:
+        if doc_id not in processed and doc_id not in failed:
+            failures.append((doc_id, "document not found"))
+    return sorted(processed - failed), failures
+
+
+def main():
+    """
+    Run the bulk reindexing job from the command line
+    """
+
+    parser = ArgumentParser(description="Reindex CDR documents in bulk")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--session", help="name of existing CDR session")
+    group.add_argument("--user", help="CDR account name for a new session")
+    parser.add_argument("--password", help="password for --user")
+    parser.add_argument("--tier", help="CDR tier (default: local tier)")
+    parser.add_argument("--doctype", help="type of documents to reindex")
+    parser.add_argument("--ids", nargs="*", help="documents to reindex")
+    parser.add_argument("--since", help="reindex docs saved since ISO date")
+    parser.add_argument("--processes", type=int, default=Reindexer.PROCESSES)
+    parser.add_argument("--batch-size", type=int,
+                        default=Reindexer.BATCH_SIZE)
+    parser.add_argument("--checkpoint", help="file for resumable progress")
+    parser.add_argument("--force", action="store_true",
+                        help="reindex even unchanged documents")
+    parser.add_argument("--paths", nargs="+",
+                        help="only add index rows for these new paths")
+    args = parser.parse_args()
+    if args.session:
+        session = Session(args.session, tier=args.tier)
+    else:
+        password = args.password
+        if password is None:
+            password = Tier(args.tier).passwords.get(args.user.lower())
+        opts = dict(password=password, tier=args.tier)
+        session = Session.create_session(args.user, **opts)
+    opts = dict(
+        doctype=args.doctype,
+        ids=args.ids,
+        since=args.since,
+        processes=args.processes,
+        batch_size=args.batch_size,
+        checkpoint=args.checkpoint,
+        force=args.force,
+        paths=args.paths,
+    )
+    try:
+        results = Reindexer(session, **opts).run()
+    finally:
+        if args.user:
+            session.logout()
+    print("done={done} failed={failed} skipped={skipped} "
+          "elapsed={elapsed:.1f}".format(**results))
+
+
+if __name__ == "__main__":
+    """
+    Let this be loaded as a module without doing anything
+    """
+
+    main()
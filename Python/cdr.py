@@ -153,15 +153,13 @@ def getControlValue(group, name, default=None, tier=None):
       string for control value if active value found; otherwise `default`
     """
 
-    cursor = None
-    if tier:
-        cursor = cdrdb.connect(user="CdrGuest", tier=tier).cursor()
     query = cdrdb.Query("ctl", "val")
     query.where(query.Condition("grp", group))
     query.where(query.Condition("name", name))
     query.where("inactivated IS NULL")
-    row = query.execute(cursor).fetchone()
-    return row.val if row else default
+    key = "value", group, name
+    rows = cdrdb.RefCache.get("ctl", key, query, tier=tier)
+    return rows[0].val if rows else default
 
 def getControlGroup(group, tier=None):
     """
@@ -175,12 +173,12 @@ def getControlGroup(group, tier=None):
       dictionary of active values for the group, indexed by their names
     """
 
-    cursor = cdrdb.connect(user="CdrGuest", tier=tier).cursor()
     query = cdrdb.Query("ctl", "name", "val")
     query.where(query.Condition("grp", group))
     query.where("inactivated IS NULL")
+    rows = cdrdb.RefCache.get("ctl", ("group", group), query, tier=tier)
     group = dict()
-    for name, value in query.execute(cursor).fetchall():
+    for name, value in rows:
         group[name] = value
     return group
 
@@ -242,6 +240,7 @@ def updateCtl(credentials, action, **opts):
             Tier.inactivate_control_value(session, group, name)
         elif action != "Install":
             raise Exception("Invalid action {!r}".format(action))
+        cdrdb.RefCache.invalidate("ctl", tier=session.tier)
     else:
         command = etree.Element("CdrSetCtl")
         wrapper = etree.SubElement(command, "Ctl")
@@ -256,6 +255,7 @@ def updateCtl(credentials, action, **opts):
             etree.SubElement(wrapper, "Comment").text = value
         for response in _Control.send_command(session, command, tier):
             if response.node.tag == command.tag + "Resp":
+                cdrdb.RefCache.invalidate("ctl", tier=tier)
                 return
             raise Exception(";".join(response.errors) or "missing response")
         raise Exception("missing response")
@@ -2263,6 +2263,9 @@ def valDoc(credentials, doctype, **opts):
                  if errors are found
       errorLocators - deprecated legacy equivalent for `locators`; if set
                       to "Y" behaves the same as locators=True
+      memo - if True, reuse the results of an earlier validation which
+             are still applicable (see `cdrapi.docs.ValidationMemo`);
+             only honored when the command is handled locally
       tier - optional; one of DEV, QA, STAGE, PROD
       host - deprecated alias for tier
 
@@ -2320,6 +2323,7 @@ def valDoc(credentials, doctype, **opts):
     # Handle the command locally if appropriate.
     if isinstance(session, Session):
         validation_opts = dict(types=val_types, locators=locators, store=store)
+        validation_opts["memo"] = bool(opts.get("memo"))
         if doc_id:
             doc = APIDoc(session, id=doc_id)
         else:
@@ -2361,6 +2365,9 @@ def reindex(credentials, doc_id, **opts):
       doc_id - unique identifier for document to be reindexed
 
     Optional keyword arguments:
+      force - if True, rebuild the index rows even if the document
+              hasn't changed since it was last indexed (only supported
+              for local sessions)
       tier - optional; one of DEV, QA, STAGE, PROD
       host - deprecated alias for tier
     """
@@ -2368,7 +2375,7 @@ def reindex(credentials, doc_id, **opts):
     tier = opts.get("tier") or opts.get("host") or None
     session = _Control.get_session(credentials, tier)
     if isinstance(session, Session):
-        APIDoc(session, id=doc_id).reindex()
+        APIDoc(session, id=doc_id).reindex(force=opts.get("force"))
     else:
         command = etree.Element("CdrReindexDoc")
         etree.SubElement(command, "DocId").text = normalize(doc_id)
@@ -5010,7 +5017,8 @@ def valPair(session, docType, oldDoc, newDoc, **opts):
     If the old version is invalid, don't bother with the new.
 
     Used to ensure that a global change has not invalidated a
-    previously valid doc.
+    previously valid doc. The old versions are usually unchanged
+    since they were last validated, so the validation memo is used.
 
     Pass:
         Logon credentials - must be authorized to validate this doctype.
@@ -5030,11 +5038,11 @@ def valPair(session, docType, oldDoc, newDoc, **opts):
     tier = opts.get("tier")
 
     # Validate first document
-    result = valDoc(session, docType, doc=oldDoc, tier=tier)
+    result = valDoc(session, docType, doc=oldDoc, tier=tier, memo=True)
 
     # If no errors, check the new version
     if not getErrors(result, errorsExpected=False):
-        result = valDoc(session, docType, doc=newDoc, tier=tier)
+        result = valDoc(session, docType, doc=newDoc, tier=tier, memo=True)
         return deDupErrs(result)
 
     # Else return empty list
@@ -2,7 +2,19 @@
 DB-SIG compliant module for CDR database access.
 """
 
+import atexit
+from collections import namedtuple
+import csv
+import hashlib
+import io
+import json
+import os
 import platform
+import re
+import sqlite3
+import sys
+import threading
+import time
 import unittest
 import pyodbc
 from cdrapi import settings
@@ -18,6 +30,8 @@ def connect(**opts):
       database - initial db for the connection (default Query.DB)
       timeout - time to wait before giving up (default Query.DEFAULT_TIMEOUT)
       autocommit - if True, don't wrap db writes in transactions
+      pool - if True, check the connection out of a `Pool` (closing it
+             returns it to the pool); default is Pool.ENABLED
     """
 
     tier = opts.get("tier") or settings.Tier()
@@ -30,29 +44,936 @@ def connect(**opts):
     user = opts.get("user", Query.CDRSQLACCOUNT)
     if user == "cdr":
         user = Query.CDRSQLACCOUNT
-    password = tier.password(user, Query.DB)
-    if not password:
-        raise Exception("user {!r} unknown on {!r}".format(user, tier.name))
-    if platform.system().lower() == "windows":
-        parms = dict(
-            Driver="{ODBC Driver 17 for SQL Server}",
-            Server="{},{}".format(tier.sql_server, tier.port(Query.DB)),
-            Database=opts.get("database", Query.DB),
-            Uid=user,
-            Pwd=password,
-            Timeout=timeout
-        )
-        conn_string = ";".join(["{}={}".format(*p) for p in parms.items()])
+    database = opts.get("database", Query.DB)
+
+    # Only look up the password and open a connection when we need one.
+    def factory():
+        password = tier.password(user, Query.DB)
+        if not password:
+            args = user, tier.name
+            raise Exception("user {!r} unknown on {!r}".format(*args))
+        if platform.system().lower() == "windows":
+            parms = dict(
+                Driver="{ODBC Driver 17 for SQL Server}",
+                Server="{},{}".format(tier.sql_server, tier.port(Query.DB)),
+                Database=database,
+                Uid=user,
+                Pwd=password,
+                Timeout=timeout
+            )
+            conn_string = ";".join(["{}={}".format(*p) for p in parms.items()])
+        else:
+            dsn = f"CDR{tier.name.upper()}"
+            conn_string = f"DSN={dsn};UID={user};PWD={password}"
+        if opts.get("debug"):
+            print(conn_string)
+        connect_opts = dict(timeout=timeout, autocommit=autocommit)
+        return pyodbc.connect(conn_string, **connect_opts)
+
+    if opts.get("pool", Pool.ENABLED):
+        key = tier.name, user, database, timeout, autocommit
+        conn = Pool.get(key, autocommit=autocommit).checkout(factory)
     else:
-        conn_string = f"DSN=CDR{tier.name.upper()};UID={user};PWD={password}"
-    if opts.get("debug"):
-        print(conn_string)
-    opts = dict(timeout=timeout, autocommit=autocommit)
-    conn = pyodbc.connect(conn_string, **opts)
+        conn = factory()
     conn.timeout = timeout
+    if QueryStats.ENABLED:
+        conn = QueryStats.Connection(conn)
     return conn
 
 
+class Pool:
+    """
+    Thread-safe pool of open database connections
+
+    Opening a connection to SQL Server (over TLS) is a measurable share
+    of the time needed for short requests, so when pooling is turned on
+    (by setting the CDR_DB_POOL environment variable to "Y", or by passing
+    `pool=True` to `connect()`) the connections are kept open and reused.
+    There is a separate pool for each combination of tier, user, database,
+    timeout, and autocommit setting.
+
+    A connection is checked with a trivial query when it is checked out
+    of the pool, and is discarded if that fails or if it has been open
+    longer than `max_age` seconds. When the connection is closed it is
+    rolled back and returned to the pool (or closed for real if the pool
+    already has `max_idle` idle connections). A connection which is not
+    closed is discarded when it is garbage collected. If `max_total`
+    connections are already checked out, a request waits up to `wait`
+    seconds for one to be returned. Note that other state tied to the
+    connection (temporary tables, SET options) is not reset, so code
+    which relies on such state should not use a pooled connection.
+
+    Class values:
+      ENABLED - default for whether `connect()` uses the pools
+      MAX_IDLE - default for the number of idle connections kept open
+      MAX_TOTAL - default for the number of connections open at once
+      MAX_AGE - default for the number of seconds a connection is used
+      WAIT - default for the number of seconds to wait for a connection
+      CHECK - query used to make sure a connection still works
+      POOLS - `Pool` objects, indexed by tier, user, database, timeout,
+              and autocommit
+      LOCK - used to make access to the POOLS dictionary thread-safe
+    """
+
+    ENABLED = os.environ.get("CDR_DB_POOL", "N").upper() == "Y"
+    MAX_IDLE = 5
+    MAX_TOTAL = 20
+    MAX_AGE = 3600
+    WAIT = 30
+    CHECK = "SELECT 1"
+    POOLS = {}
+    LOCK = threading.Lock()
+
+    def __init__(self, **opts):
+        """
+        Create an empty pool
+
+        Optional keyword arguments:
+          max_idle - how many idle connections to keep open
+          max_total - how many connections can be open at the same time
+          max_age - seconds after which a connection is closed
+          wait - how long to wait for a connection before giving up
+          autocommit - setting to restore when a connection is returned
+        """
+
+        self.max_idle = opts.get("max_idle", self.MAX_IDLE)
+        self.max_total = opts.get("max_total", self.MAX_TOTAL)
+        self.max_age = opts.get("max_age", self.MAX_AGE)
+        self.wait = opts.get("wait", self.WAIT)
+        self.autocommit = opts.get("autocommit")
+        self.__idle = []
+        self.__open = 0
+        self.__condition = threading.Condition()
+        self.__stats = dict(
+            checkouts=0,
+            created=0,
+            recycled=0,
+            failed_checks=0,
+            discarded=0,
+            waits=0,
+            wait_seconds=0.0,
+            max_wait_seconds=0.0,
+            timeouts=0,
+        )
+        self.__ages = []
+
+    def checkout(self, factory):
+        """
+        Get a connection from the pool, opening a new one if necessary
+
+        Pass:
+          factory - callable which opens a new connection
+
+        Return:
+          `Pool.Connection` object
+        """
+
+        start = time.monotonic()
+        waited = False
+        while True:
+            conn = None
+            with self.__condition:
+                while conn is None:
+                    if self.__idle:
+                        conn, created = self.__idle.pop()
+                        if time.monotonic() - created > self.max_age:
+                            self.__close(conn)
+                            self.__stats["recycled"] += 1
+                            conn = None
+                    elif self.__open < self.max_total:
+                        self.__open += 1
+                        created = None
+                        break
+                    else:
+                        remaining = self.wait - (time.monotonic() - start)
+                        if remaining <= 0:
+                            self.__stats["timeouts"] += 1
+                            raise Exception("timed out waiting for "
+                                            "database connection")
+                        waited = True
+                        self.__condition.wait(remaining)
+            if conn is None:
+                try:
+                    conn = factory()
+                except Exception:
+                    with self.__condition:
+                        self.__open -= 1
+                        self.__condition.notify()
+                    raise
+                created = time.monotonic()
+                with self.__condition:
+                    self.__stats["created"] += 1
+                break
+            if self.__check(conn):
+                break
+            with self.__condition:
+                self.__stats["failed_checks"] += 1
+                self.__close(conn)
+        elapsed = time.monotonic() - start
+        with self.__condition:
+            self.__stats["checkouts"] += 1
+            if waited:
+                self.__stats["waits"] += 1
+                self.__stats["wait_seconds"] += elapsed
+                if elapsed > self.__stats["max_wait_seconds"]:
+                    self.__stats["max_wait_seconds"] = elapsed
+        return self.Connection(self, conn, created)
+
+    def clear(self):
+        """
+        Close all of the idle connections in the pool
+        """
+
+        with self.__condition:
+            while self.__idle:
+                conn, created = self.__idle.pop()
+                self.__close(conn)
+
+    def discard(self, conn):
+        """
+        Close a checked-out connection instead of returning it to the pool
+
+        Pass:
+          conn - raw database connection
+        """
+
+        with self.__condition:
+            self.__stats["discarded"] += 1
+            self.__close(conn)
+
+    def release(self, conn, created):
+        """
+        Reset a connection and return it to the pool
+
+        Pass:
+          conn - raw database connection
+          created - value of `time.monotonic()` when it was opened
+        """
+
+        try:
+            conn.rollback()
+            if self.autocommit is not None:
+                if conn.autocommit != self.autocommit:
+                    conn.autocommit = self.autocommit
+            reusable = True
+        except Exception:
+            reusable = False
+        age = time.monotonic() - created
+        with self.__condition:
+            self.__ages.append(age)
+            del self.__ages[:-1000]
+            if not reusable:
+                self.__stats["discarded"] += 1
+                self.__close(conn)
+            elif age > self.max_age:
+                self.__stats["recycled"] += 1
+                self.__close(conn)
+            elif len(self.__idle) >= self.max_idle:
+                self.__close(conn)
+            else:
+                self.__idle.append((conn, created))
+                self.__condition.notify()
+
+    @property
+    def metrics(self):
+        """
+        Snapshot of the pool's usage numbers
+
+        Return:
+          dictionary of counts and times, including the number of open,
+          idle, and busy connections, how often and how long requests
+          had to wait for a connection, and the ages (in seconds) of the
+          connections when they were returned to the pool
+        """
+
+        now = time.monotonic()
+        with self.__condition:
+            metrics = dict(self.__stats)
+            metrics["open"] = self.__open
+            metrics["idle"] = len(self.__idle)
+            metrics["busy"] = self.__open - len(self.__idle)
+            idle_ages = [now - created for conn, created in self.__idle]
+            ages = list(self.__ages)
+        metrics["oldest_idle_seconds"] = max(idle_ages, default=0.0)
+        metrics["mean_age_seconds"] = sum(ages) / len(ages) if ages else 0.0
+        metrics["max_age_seconds"] = max(ages, default=0.0)
+        return metrics
+
+    def __check(self, conn):
+        """
+        Make sure a connection from the pool still works
+
+        Pass:
+          conn - raw database connection
+
+        Return:
+          True if the connection can be used; otherwise False
+        """
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.CHECK)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def __close(self, conn):
+        """
+        Close a connection for real (caller holds the lock)
+
+        Pass:
+          conn - raw database connection
+        """
+
+        self.__open -= 1
+        self.__condition.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @classmethod
+    def get(cls, key, **opts):
+        """
+        Find (or create) the pool for a set of connection parameters
+
+        Pass:
+          key - tuple of tier name, user, database, and autocommit flag
+          opts - passed to the constructor for a new pool
+
+        Return:
+          `Pool` object
+        """
+
+        with cls.LOCK:
+            if key not in cls.POOLS:
+                cls.POOLS[key] = cls(**opts)
+            return cls.POOLS[key]
+
+    @classmethod
+    def report(cls):
+        """
+        Get the metrics for all of the process's pools
+
+        Return:
+          dictionary of `metrics` values indexed by string for the key
+        """
+
+        with cls.LOCK:
+            pools = list(cls.POOLS.items())
+        return {"/".join(str(v) for v in key): pool.metrics
+                for key, pool in pools}
+
+    class Connection:
+        """
+        Wrapper for a connection checked out of a pool
+
+        Behaves like the wrapped connection, except that closing it
+        returns the connection to the pool.
+        """
+
+        def __init__(self, pool, conn, created):
+            object.__setattr__(self, "_pool", pool)
+            object.__setattr__(self, "_conn", conn)
+            object.__setattr__(self, "_created", created)
+
+        def close(self):
+            """Return the connection to the pool"""
+
+            conn = self._conn
+            if conn is not None:
+                object.__setattr__(self, "_conn", None)
+                self._pool.release(conn, self._created)
+
+        def __getattr__(self, name):
+            if self._conn is None:
+                message = "connection has been returned to the pool"
+                raise AttributeError(message)
+            return getattr(self._conn, name)
+
+        def __setattr__(self, name, value):
+            setattr(self._conn, name, value)
+
+        def __enter__(self):
+            self._conn.__enter__()
+            return self
+
+        def __exit__(self, *args):
+            return self._conn.__exit__(*args)
+
+        def __del__(self):
+            try:
+                conn = self._conn
+                if conn is not None:
+                    object.__setattr__(self, "_conn", None)
+                    self._pool.discard(conn)
+            except Exception:
+                pass
+
+
+class QueryStats:
+    """
+    Optional instrumentation of the database cursors
+
+    When the CDR_QUERY_STATS environment variable is set to "Y", the
+    connections returned by `connect()` hand out cursors which time
+    every statement they execute. The statements are grouped by a
+    normalized fingerprint of their SQL (with literals and lists of
+    placeholders collapsed), and for each fingerprint we count the
+    executions, the elapsed time, and the rows fetched or affected.
+    Statements which take longer than CDR_SLOW_QUERY_SECONDS (default
+    1.0) are written to the slow-queries log, along with the location
+    in the code which executed them, and a summary of the fingerprints
+    which used the most time is logged when the process exits (or can
+    be fetched at any time by calling `report()`). When the variable
+    is not set, `connect()` returns the connections unwrapped, so the
+    instrumentation costs nothing.
+
+    Class values:
+      ENABLED - True if the cursors should be instrumented
+      SLOW - number of seconds at which a statement is logged as slow
+      STATS - `QueryStats` objects indexed by SQL fingerprint
+      LOCK - used to make access to the statistics thread-safe
+
+    Attributes:
+      fingerprint - normalized SQL for the statement
+      count - number of times the statement was executed
+      seconds - total elapsed time for the executions
+      max_seconds - longest time for a single execution
+      rows - number of rows fetched or affected
+      callers - set of code locations which executed the statement
+    """
+
+    ENABLED = os.environ.get("CDR_QUERY_STATS", "N").upper() == "Y"
+    SLOW = float(os.environ.get("CDR_SLOW_QUERY_SECONDS") or 1.0)
+    STATS = {}
+    LOCK = threading.Lock()
+    PATTERNS = (
+        (re.compile(r"'(?:[^']|'')*'"), "?"),
+        (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+        (re.compile(r"#ids_[0-9a-f]+"), "#ids_?"),
+        (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),
+        (re.compile(r"\s+"), " "),
+    )
+    __logger = None
+
+    def __init__(self, fingerprint):
+        """
+        Start collecting numbers for a statement fingerprint
+
+        Pass:
+          fingerprint - normalized SQL for the statement
+        """
+
+        self.fingerprint = fingerprint
+        self.count = self.rows = 0
+        self.seconds = self.max_seconds = 0.0
+        self.callers = set()
+
+    @classmethod
+    def record(cls, sql, seconds, rows=0):
+        """
+        Add the numbers for an execution of a SQL statement
+
+        Pass:
+          sql - string for the statement which was executed
+          seconds - elapsed time for the execution
+          rows - number of rows affected (if known)
+
+        Return:
+          `QueryStats` object for the statement's fingerprint
+        """
+
+        fingerprint = cls.get_fingerprint(sql)
+        caller = cls.__get_caller()
+        with cls.LOCK:
+            stats = cls.STATS.get(fingerprint)
+            if stats is None:
+                stats = cls.STATS[fingerprint] = cls(fingerprint)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.rows += rows
+            stats.callers.add(caller)
+        if seconds >= cls.SLOW:
+            message = "%.3f seconds (%d rows) at %s\n%s"
+            cls.get_logger().warning(message, seconds, rows, caller, sql)
+        return stats
+
+    @classmethod
+    def add_rows(cls, stats, rows):
+        """
+        Count rows fetched for a statement
+
+        Pass:
+          stats - `QueryStats` object returned by `record()`
+          rows - number of rows fetched
+        """
+
+        with cls.LOCK:
+            stats.rows += rows
+
+    @classmethod
+    def report(cls, limit=20):
+        """
+        Get the numbers for the statements which used the most time
+
+        Pass:
+          limit - maximum number of fingerprints to report
+
+        Return:
+          sequence of dictionaries, sorted by total time (descending)
+        """
+
+        with cls.LOCK:
+            stats = sorted(cls.STATS.values(), key=lambda s: -s.seconds)
+            return [
+                dict(
+                    fingerprint=s.fingerprint,
+                    count=s.count,
+                    seconds=round(s.seconds, 6),
+                    mean_seconds=round(s.seconds / s.count, 6),
+                    max_seconds=round(s.max_seconds, 6),
+                    rows=s.rows,
+                    callers=sorted(s.callers),
+                )
+                for s in stats[:limit]
+            ]
+
+    @classmethod
+    def reset(cls):
+        """
+        Discard the numbers collected so far
+        """
+
+        with cls.LOCK:
+            cls.STATS.clear()
+
+    @classmethod
+    def log_report(cls, limit=20):
+        """
+        Write the summary of the most expensive statements to the log
+
+        Pass:
+          limit - maximum number of fingerprints to report
+        """
+
+        report = cls.report(limit)
+        if report:
+            lines = ["top statements by total time:"]
+            for s in report:
+                lines.append(f"{s['seconds']:10.3f}s {s['count']:7d}x "
+                             f"{s['rows']:9d} rows {s['fingerprint']}")
+            cls.get_logger().info("\n".join(lines))
+
+    @classmethod
+    def get_fingerprint(cls, sql):
+        """
+        Normalize SQL so that executions of the same statement match
+
+        Pass:
+          sql - string for the statement
+
+        Return:
+          string with literals, placeholder lists, and whitespace collapsed
+        """
+
+        for pattern, replacement in cls.PATTERNS:
+            sql = pattern.sub(replacement, sql)
+        return sql.strip()
+
+    @classmethod
+    def get_logger(cls):
+        """
+        Get the logger for slow queries and the summary report
+        """
+
+        if cls.__logger is None:
+            cls.__logger = settings.Tier().get_logger("slow-queries")
+        return cls.__logger
+
+    @staticmethod
+    def __get_caller():
+        """
+        Find the code location which executed the statement
+
+        Return:
+          string for the file name, line number, and function name
+          of the first stack frame outside this module
+        """
+
+        frame = sys._getframe(1)
+        while frame and frame.f_code.co_filename == __file__:
+            frame = frame.f_back
+        if frame is None:
+            return "unknown"
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        return f"{filename}:{frame.f_lineno} {code.co_name}"
+
+    class Connection:
+        """
+        Wrapper for a database connection handing out timed cursors
+        """
+
+        def __init__(self, conn):
+            object.__setattr__(self, "_conn", conn)
+
+        def cursor(self):
+            return QueryStats.Cursor(self._conn.cursor())
+
+        def __getattr__(self, name):
+            return getattr(self._conn, name)
+
+        def __setattr__(self, name, value):
+            setattr(self._conn, name, value)
+
+        def __enter__(self):
+            self._conn.__enter__()
+            return self
+
+        def __exit__(self, *args):
+            return self._conn.__exit__(*args)
+
+    class Cursor:
+        """
+        Wrapper for a database cursor which times its statements
+        """
+
+        def __init__(self, cursor):
+            object.__setattr__(self, "_cursor", cursor)
+            object.__setattr__(self, "_stats", None)
+
+        def execute(self, sql, *args):
+            start = time.perf_counter()
+            self._cursor.execute(sql, *args)
+            elapsed = time.perf_counter() - start
+            rows = getattr(self._cursor, "rowcount", -1)
+            if not isinstance(rows, int) or rows < 0:
+                rows = 0
+            stats = QueryStats.record(sql, elapsed, rows)
+            object.__setattr__(self, "_stats", stats)
+            return self
+
+        def executemany(self, sql, params):
+            params = list(params)
+            start = time.perf_counter()
+            self._cursor.executemany(sql, params)
+            elapsed = time.perf_counter() - start
+            stats = QueryStats.record(sql, elapsed, len(params))
+            object.__setattr__(self, "_stats", stats)
+
+        def fetchone(self):
+            row = self._cursor.fetchone()
+            if row is not None and self._stats is not None:
+                QueryStats.add_rows(self._stats, 1)
+            return row
+
+        def fetchmany(self, *args):
+            rows = self._cursor.fetchmany(*args)
+            if self._stats is not None:
+                QueryStats.add_rows(self._stats, len(rows))
+            return rows
+
+        def fetchall(self):
+            rows = self._cursor.fetchall()
+            if self._stats is not None:
+                QueryStats.add_rows(self._stats, len(rows))
+            return rows
+
+        def __iter__(self):
+            return iter(self.fetchone, None)
+
+        def __getattr__(self, name):
+            return getattr(self._cursor, name)
+
+        def __setattr__(self, name, value):
+            setattr(self._cursor, name, value)
+
+        def __enter__(self):
+            self._cursor.__enter__()
+            return self
+
+        def __exit__(self, *args):
+            return self._cursor.__exit__(*args)
+
+
+if QueryStats.ENABLED:
+    atexit.register(QueryStats.log_report)
+
+
+class RefCache:
+    """
+    Process-wide read-through cache for the small reference tables
+
+    Code throughout the system looks up the same handful of rows in
+    tables which rarely change (`doc_type`, `format`, the link tables,
+    `ctl`, and the valid-values tables), and a publishing job can run
+    thousands of these lookups. Callers ask for a value by the tables
+    it is derived from and a key, passing a loader for the case when
+    the value isn't cached. Cached values are trusted for the number
+    of seconds in TTLS for the table (or TTL for tables not listed).
+    When a value ages out, a cheap watermark probe is run against its
+    tables (at most once every PROBE_INTERVAL seconds for each table),
+    and if the tables haven't changed, the value is kept for another
+    round without running the loader again. Code which modifies one
+    of these tables should call `invalidate()` so the current process
+    sees its own changes right away; other processes pick them up when
+    their cached values age out. Setting the CDR_REF_CACHE environment
+    variable to "N" turns off the caching (every call runs its loader).
+
+    Values are shared by all callers, so they must be treated as
+    read-only.
+
+    Class values:
+      ENABLED - False if the caching has been turned off
+      TTL - default number of seconds a value is trusted
+      TTLS - seconds a value is trusted, indexed by table name
+      WATERMARK - SQL for the default change probe for a table
+      WATERMARKS - override probes (None for "don't probe") by table
+      PROBE_INTERVAL - seconds during which a probe result is reused
+      PERMANENT_ERRORS - SQLSTATE classes (syntax or access errors,
+                         unsupported features) for probe failures which
+                         will keep happening, so the probe is dropped
+      ENTRIES - cached `RefCache` objects, indexed by tier/tables/key
+      MARKS - watermarks for each table, indexed by tier/table
+      LOCK - used to make access to the cache thread-safe
+
+    Attributes:
+      value - the cached value
+      expires - time after which the value must be checked again
+      marks - watermarks for the value's tables when it was loaded
+    """
+
+    ENABLED = os.environ.get("CDR_REF_CACHE", "Y").upper() != "N"
+    TTL = 300
+    TTLS = dict(
+        action=600,
+        board=600,
+        ctl=30,
+        doc_type=600,
+        format=3600,
+        grp_action=120,
+        link_prop_type=3600,
+        link_properties=600,
+        link_target=600,
+        link_type=600,
+        link_xml=600,
+        pub_system=600,
+        query_term_def=600,
+    )
+    WATERMARK = "SELECT COUNT(*), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM {}"
+    WATERMARKS = {}
+    PROBE_INTERVAL = 5
+    ENTRIES = {}
+    MARKS = {}
+    LOCK = threading.Lock()
+    PERMANENT_ERRORS = "42", "0A"
+    __tier = None
+    __logger = None
+
+    def __init__(self, value, expires, marks):
+        """
+        Remember a value loaded from the database
+
+        Pass:
+          value - the value to be cached
+          expires - time after which the value must be checked again
+          marks - watermarks for the value's tables (None if unknown)
+        """
+
+        self.value = value
+        self.expires = expires
+        self.marks = marks
+
+    @classmethod
+    def get(cls, tables, key, loader, **opts):
+        """
+        Fetch a cached value, loading it if necessary
+
+        Pass:
+          tables - name of the table (or sequence of names of tables)
+                   from which the value is derived
+          key - hashable value distinguishing this lookup from others
+                on the same tables
+          loader - `Query` object whose rows are to be cached, or
+                   callable which takes a cursor and returns the value
+
+        Optional keyword arguments:
+          cursor - cursor to use if the database must be queried
+                   (by default a connection is opened only when needed,
+                   and closed, or returned to its pool, before we return)
+          tier - tier name string or `Tier` object (default is the
+                 local tier)
+
+        Return:
+          cached (or freshly loaded) value
+        """
+
+        if isinstance(tables, str):
+            tables = tables,
+        tables = tuple(tables)
+        tier = opts.get("tier")
+        cursor = opts.get("cursor")
+        if isinstance(loader, Query):
+            query = loader
+            loader = lambda cursor: query.execute(cursor).fetchall()
+        if not cls.ENABLED:
+            if cursor is not None:
+                return loader(cursor)
+            conn = cls.__connect(tier)
+            try:
+                return loader(conn.cursor())
+            finally:
+                conn.close()
+        tier_name = cls.__get_tier_name(tier)
+        cache_key = tier_name, tables, key
+        now = time.time()
+        with cls.LOCK:
+            entry = cls.ENTRIES.get(cache_key)
+            if entry is not None and entry.expires > now:
+                return entry.value
+        conn = None
+        if cursor is None:
+            conn = cls.__connect(tier)
+            cursor = conn.cursor()
+        try:
+            ttl = min(cls.TTLS.get(table, cls.TTL) for table in tables)
+            marks = cls.__get_marks(cursor, tier_name, tables, now)
+            if entry is not None and marks is not None:
+                if marks == entry.marks:
+                    with cls.LOCK:
+                        entry.expires = now + ttl
+                    return entry.value
+            value = loader(cursor)
+        finally:
+            if conn is not None:
+                conn.close()
+        with cls.LOCK:
+            cls.ENTRIES[cache_key] = cls(value, now + ttl, marks)
+        return value
+
+    @classmethod
+    def invalidate(cls, tables=None, tier=None):
+        """
+        Drop cached values so they will be loaded again
+
+        Pass:
+          tables - optional name (or sequence of names) of the table(s)
+                   which have been modified; if omitted, all values
+                   are dropped
+          tier - optional tier name string or `Tier` object; if
+                 omitted, values for all tiers are dropped
+        """
+
+        if isinstance(tables, str):
+            tables = tables,
+        tables = set(tables or [])
+        tier_name = cls.__get_tier_name(tier) if tier else None
+        with cls.LOCK:
+            for key in list(cls.ENTRIES):
+                if tier_name and key[0] != tier_name:
+                    continue
+                if tables and not tables & set(key[1]):
+                    continue
+                del cls.ENTRIES[key]
+            for key in list(cls.MARKS):
+                if tier_name and key[0] != tier_name:
+                    continue
+                if tables and key[1] not in tables:
+                    continue
+                del cls.MARKS[key]
+
+    @classmethod
+    def __get_marks(cls, cursor, tier_name, tables, now):
+        """
+        Find the current watermarks for a value's tables
+
+        Pass:
+          cursor - used for running the probes
+          tier_name - string for the tier from which the value comes
+          tables - names of the tables from which the value is derived
+          now - time of the request for the cached value
+
+        Return:
+          tuple of the watermarks for the tables, or None if any of
+          the tables can't be probed
+        """
+
+        marks = []
+        for table in tables:
+            key = tier_name, table
+            with cls.LOCK:
+                sql = cls.WATERMARKS.get(table, cls.WATERMARK)
+                probed, mark = cls.MARKS.get(key, (0, None))
+            if sql is None:
+                return None
+            if now - probed >= cls.PROBE_INTERVAL:
+                try:
+                    cursor.execute(sql.format(table))
+                    mark = tuple(cursor.fetchone())
+                except Exception as e:
+
+                    # Don't keep trying a probe the database can't handle,
+                    # but a timeout or a deadlock only costs us this check.
+                    state = str(e.args[0]) if e.args else ""
+                    if state[:2] in cls.PERMANENT_ERRORS:
+                        with cls.LOCK:
+                            cls.WATERMARKS[table] = None
+                        message = "dropping %s watermark probe: %s"
+                    else:
+                        message = "skipping %s watermark probe: %s"
+                    cls.get_logger().warning(message, table, e)
+                    return None
+                with cls.LOCK:
+                    cls.MARKS[key] = now, mark
+            marks.append(mark)
+        return tuple(marks)
+
+    @classmethod
+    def get_logger(cls):
+        """
+        Get the logger for problems with the watermark probes
+        """
+
+        if cls.__logger is None:
+            cls.__logger = settings.Tier().get_logger("ref-cache")
+        return cls.__logger
+
+    @classmethod
+    def __get_tier_name(cls, tier):
+        """
+        Get the string to use for the tier in the cache keys
+
+        Pass:
+          tier - tier name string, `Tier` object, or None
+
+        Return:
+          uppercase string for the tier name
+        """
+
+        if tier is None:
+            if cls.__tier is None:
+                cls.__tier = settings.Tier().name.upper()
+            return cls.__tier
+        if isinstance(tier, bytes):
+            tier = tier.decode("utf-8")
+        return str(getattr(tier, "name", tier)).upper()
+
+    @staticmethod
+    def __connect(tier):
+        """
+        Get a read-only connection for loading a value
+
+        The caller closes it when it's done (which returns it to its
+        pool when pooling is turned on).
+        """
+
+        return connect(user="CdrGuest", tier=tier)
+
+
 class Query:
 
     """
@@ -81,6 +1002,12 @@ class Query:
     CDRSQLACCOUNT = "cdrsqlaccount"
     DB = "CDR"
 
+    # Lists of values for IN tests longer than this are loaded into a
+    # temporary table (see `prepare()`), keeping us well clear of SQL
+    # Server's limit of 2,100 parameters for a single statement.
+    ID_TABLE_THRESHOLD = 500
+    INTEGER = re.compile(r"\s*[-+]?\d+\s*$")
+
     def __init__(self, table, *columns):
         """
         Initializes a SQL query builder
@@ -100,6 +1027,7 @@ class Query:
         self._having = []
         self._order = []
         self._parms = []
+        self._id_tables = {}
         self._unions = []
         self._timeout = self.DEFAULT_TIMEOUT
         self._alias = None
@@ -257,17 +1185,185 @@ class Query:
 
         Note that the temporary 'sql' variable is assigned before
         invoking the cursor's execute() method, to make sure that
-        the _parms sequence has been constructed.
+        the _parms sequence has been constructed. Any long lists of
+        values for IN tests are loaded into their temporary tables
+        (see `prepare()`) before the query itself is executed.
         """
         if not cursor:
             if not timeout:
                 timeout = self._timeout
             conn = connect(user="CdrGuest", timeout=timeout)
             cursor = conn.cursor()
-        sql = str(self)
+        sql = self.prepare(cursor)
         cursor.execute(sql, tuple(self._parms))
         return cursor
 
+    def prepare(self, cursor):
+        """
+        Assemble the query and load the temporary tables it refers to
+
+        A query with an IN test on more than `ID_TABLE_THRESHOLD`
+        values reads the values from an `#ids_...` temporary table,
+        which only exists once it has been loaded. `execute()` takes
+        care of this, but code which runs the assembled SQL itself
+        (for example, `cursor.execute(query.prepare(cursor),
+        query.parms())`) must call this method first, using a cursor
+        on the connection which will run the query. The string returned
+        by `str()` can still be used for logging without doing this.
+
+        Pass:
+          cursor - used to create and load the temporary tables
+
+        Return:
+          the assembled SQL query string
+        """
+
+        sql = str(self)
+        for name, values in self._id_tables.items():
+            Query.load_id_table(cursor, name, values)
+        return sql
+
+    def stream(self, cursor=None, chunk=1000, **opts):
+        """
+        Execute the query and return an iterator over the result rows
+
+        Unlike `execute().fetchall()`, the rows are pulled from the
+        database a chunk at a time, so the full result set is never
+        held in memory. The query is executed before this method
+        returns, so errors are reported right away.
+
+        Example usage:
+
+            for row in query.stream(cursor):
+                process(row)
+
+        Pass:
+          cursor - optional cursor to be used (see `execute()`)
+          chunk - number of rows to fetch at a time
+
+        Optional keyword arguments:
+          named - if True, yield namedtuples instead of database rows
+          timeout - passed to `execute()`
+
+        Return:
+          generator of result rows
+        """
+
+        cursor = self.execute(cursor, opts.get("timeout"))
+        return self.iterate(cursor, chunk, named=opts.get("named"))
+
+    def write_csv(self, fp, cursor=None, chunk=1000, **opts):
+        """
+        Write the query's results to a CSV file without loading them all
+
+        Pass:
+          fp - file object opened for writing text (with newline="")
+          cursor - optional cursor to be used (see `execute()`)
+          chunk - number of rows to fetch at a time
+
+        Optional keyword arguments:
+          header - if False, don't write the column names as the first row
+          timeout - passed to `execute()`
+
+        Return:
+          number of data rows written
+        """
+
+        cursor = self.execute(cursor, opts.get("timeout"))
+        writer = csv.writer(fp)
+        if opts.get("header", True):
+            writer.writerow([column[0] for column in cursor.description])
+        count = 0
+        for row in self.iterate(cursor, chunk):
+            writer.writerow(row)
+            count += 1
+        return count
+
+    def write_jsonl(self, fp, cursor=None, chunk=1000, **opts):
+        """
+        Write the query's results as JSON lines, one object for each row
+
+        Values which JSON can't represent (e.g., dates) are written as
+        strings.
+
+        Pass:
+          fp - file object opened for writing text
+          cursor - optional cursor to be used (see `execute()`)
+          chunk - number of rows to fetch at a time
+
+        Optional keyword arguments:
+          timeout - passed to `execute()`
+
+        Return:
+          number of rows written
+        """
+
+        cursor = self.execute(cursor, opts.get("timeout"))
+        names = [column[0] for column in cursor.description]
+        count = 0
+        for row in self.iterate(cursor, chunk):
+            values = dict(zip(names, row))
+            fp.write(json.dumps(values, default=str) + "\n")
+            count += 1
+        return count
+
+    def write_sheet(self, sheet, cursor=None, chunk=1000, **opts):
+        """
+        Append the query's results to an openpyxl worksheet
+
+        Combined with a workbook created with `write_only=True`, this
+        keeps memory use flat for very large reports.
+
+        Pass:
+          sheet - openpyxl worksheet object
+          cursor - optional cursor to be used (see `execute()`)
+          chunk - number of rows to fetch at a time
+
+        Optional keyword arguments:
+          header - if False, don't add the column names as the first row
+          timeout - passed to `execute()`
+
+        Return:
+          number of data rows added
+        """
+
+        cursor = self.execute(cursor, opts.get("timeout"))
+        if opts.get("header", True):
+            sheet.append([column[0] for column in cursor.description])
+        count = 0
+        for row in self.iterate(cursor, chunk):
+            sheet.append(list(row))
+            count += 1
+        return count
+
+    @staticmethod
+    def iterate(cursor, chunk=1000, named=False):
+        """
+        Yield the rows from an executed cursor a chunk at a time
+
+        Can be used for cursors whose SQL was not built by a `Query`
+        object.
+
+        Pass:
+          cursor - cursor on which a query has been executed
+          chunk - number of rows to fetch at a time
+          named - if True, yield namedtuples instead of database rows
+
+        Return:
+          generator of result rows
+        """
+
+        row_class = None
+        if named:
+            names = [column[0] for column in cursor.description]
+            row_class = namedtuple("Row", names, rename=True)
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            for row in rows:
+                yield row_class._make(row) if row_class else row
+
     def alias(self, alias):
         """
         Assigns an alias for a query so that it can be used as a virtual
@@ -351,6 +1447,7 @@ class Query:
 
         # Start with a fresh paramater list.
         self._parms = []
+        self._id_tables = {}
 
         # Start the select statement, and calculate needed left padding.
         select = "SELECT"
@@ -385,6 +1482,7 @@ class Query:
             sql = str(self._table)
             if self._table._parms:
                 raise Exception("Placeholders not allowed in virtual table")
+            self._id_tables.update(self._table._id_tables)
 
             # Add the indented query in parentheses.
             query.append(self._align("FROM", "("))
@@ -419,6 +1517,7 @@ class Query:
         for union in self._unions:
             query.append(self._align("UNION"))
             query.append(str(union))
+            self._id_tables.update(union._id_tables)
 
         # Specify the sorting of the result set if requested.
         if self._order:
@@ -491,6 +1590,7 @@ class Query:
             query.append(self._align(keyword, test + " ("))
             query.append(Query.indent(serialized))
             self._parms += nested._parms
+            self._id_tables.update(nested._id_tables)
 
         # Handle a sequence of values.
         elif condition.test.upper() in ("IN", "NOT IN"):
@@ -505,14 +1605,21 @@ class Query:
                 raise Exception("%s test with no values" %
                                 repr(condition.test.upper()))
 
-            # Add the placeholders.
-            test += " (%s)" % ", ".join([self.PLACEHOLDER] * len(values))
+            # Use a temporary table for a long list of IDs (or strings).
+            name = None
+            if len(values) > self.ID_TABLE_THRESHOLD:
+                name = Query.id_table_name(values)
+            if name:
+                self._id_tables[name] = values
+                test += " (SELECT id FROM %s)" % name
+                query.append(self._align(keyword, test + suffix))
 
-            # Plug in the condition to the query string.
-            query.append(self._align(keyword, test + suffix))
-
-            # Add the parameters.
-            self._parms += values
+            # Otherwise, add the placeholders and the parameters.
+            else:
+                placeholders = ", ".join([self.PLACEHOLDER] * len(values))
+                test += " (%s)" % placeholders
+                query.append(self._align(keyword, test + suffix))
+                self._parms += values
 
         # Last case: single value test.
         else:
@@ -545,6 +1652,7 @@ class Query:
             # Add the table expression indented and in parentheses.
             query.append(self._align(keyword, "("))
             query.append(Query.indent("%s) %s" % (join.table, alias)))
+            self._id_tables.update(join.table._id_tables)
 
         # No, just a named table.
         else:
@@ -556,6 +1664,101 @@ class Query:
             self._serialize_condition(query, keyword, condition)
             keyword = "AND"
 
+    @staticmethod
+    def id_table_name(values):
+        """
+        Pick the name of the temporary table for a list of values
+
+        The name is derived from the values, so the same list always
+        gets the same table, and different lists used by the same
+        query get different tables.
+
+        Pass:
+          values - sequence of values for an IN test
+
+        Return:
+          string for the temporary table's name, or None if the values
+          can't be loaded into a table (see `__id_table_values()`)
+        """
+
+        values = Query.__id_table_values(values)
+        if values is None:
+            return None
+        kind = "int" if type(values[0]) is int else "str"
+        key = repr((kind, values))
+        return "#ids_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def load_id_table(cursor, name, values):
+        """
+        Create and populate a temporary table for a long list of values
+
+        The table lasts as long as the database connection (or until
+        the next time it's loaded), and is populated using the driver's
+        fast bulk parameter binding where it's available. Strings get
+        a column with no length limit and no primary key (values which
+        differ only in case would collide under a case-insensitive
+        collation), using the database's collation rather than that of
+        tempdb, so comparisons with the CDR tables' columns work.
+
+        Pass:
+          cursor - used to create and load the table
+          name - string returned by `id_table_name()`
+          values - sequence of integers and/or strings
+        """
+
+        values = Query.__id_table_values(values)
+        if type(values[0]) is int:
+            column = "id INT PRIMARY KEY"
+        else:
+            column = "id NVARCHAR(MAX) COLLATE DATABASE_DEFAULT"
+        drop = f"IF OBJECT_ID('tempdb..{name}') IS NOT NULL DROP TABLE {name}"
+        cursor.execute(drop)
+        cursor.execute(f"CREATE TABLE {name} ({column})")
+        fast = getattr(cursor, "fast_executemany", None)
+        if fast is not None:
+            cursor.fast_executemany = True
+        try:
+            insert = f"INSERT INTO {name} (id) VALUES (?)"
+            cursor.executemany(insert, [(value,) for value in values])
+        finally:
+            if fast is not None:
+                cursor.fast_executemany = fast
+
+    @staticmethod
+    def __id_table_values(values):
+        """
+        Reduce a list of values for an ID table to a single type
+
+        A mix of integers and strings which all look like integers
+        becomes a list of integers; any other mix of integers and
+        strings becomes a list of strings (matching the conversions
+        SQL Server would apply to the values as parameters).
+
+        Pass:
+          values - sequence of values for an IN test
+
+        Return:
+          sorted list of unique integers or strings, or None if some
+          of the values are neither integers nor strings
+        """
+
+        if all(type(value) is int for value in values):
+            return sorted(set(values))
+        if all(isinstance(value, str) for value in values):
+            return sorted(set(values))
+        for value in values:
+            if type(value) is not int and not isinstance(value, str):
+                return None
+        integers = True
+        for value in values:
+            if isinstance(value, str) and not Query.INTEGER.match(value):
+                integers = False
+                break
+        if integers:
+            return sorted(set([int(value) for value in values]))
+        return sorted(set([str(value) for value in values]))
+
     @staticmethod
     def indent(block, n=4):
         """
@@ -749,6 +1952,276 @@ class QueryTests(unittest.TestCase):
         u = self.Q(q1, "*").union(self.Q(q2, "*"))
         r = [r[0] for r in u.execute(self.c).fetchall()]
         self.assertTrue(r == ["aviation", "volleyball"])
+    def test_12_long_id_list(self):
+        ids = list(range(1000, 4000)) + [42, 44]
+        q = self.Q("#t1", "n").where(self.C("i", ids, "IN")).order("n")
+        self.assertIn("#ids_", str(q))
+        self.assertEqual(q.parms(), [])
+        r = self.V(q.execute(self.c).fetchall())
+        self.assertTrue(r == [("Alan",), ("Volker",)])
+        q = self.Q("#t1", "n").where(self.C("i", [42, 43, 44], "IN"))
+        self.assertEqual(q.parms(), [42, 43, 44])
+    def test_13_long_string_list(self):
+        names = [f"name{i}" for i in range(600)] + ["x" * 600]
+        names += ["Alan", "ALAN", "alan", "Volker"]
+        q = self.Q("#t1", "i").where(self.C("n", names, "IN")).order("i")
+        self.assertIn("#ids_", str(q))
+        r = self.V(q.execute(self.c).fetchall())
+        self.assertTrue(r == [(42,), (44,)])
+    def test_14_long_mixed_list(self):
+        ids = list(range(1000, 2200)) + [str(i) for i in range(3000, 4200)]
+        ids += [" 42", "44"]
+        self.assertGreater(len(ids), 2100)
+        q = self.Q("#t1", "n").where(self.C("i", ids, "IN")).order("n")
+        sql = q.prepare(self.c)
+        self.assertIn("#ids_", sql)
+        self.assertEqual(q.parms(), [])
+        self.c.execute(sql, tuple(q.parms()))
+        r = self.V(self.c.fetchall())
+        self.assertTrue(r == [("Alan",), ("Volker",)])
+        name = self.Q.id_table_name(ids)
+        self.Q.load_id_table(self.c, name, ids)
+        self.c.execute(f"SELECT COUNT(*) FROM {name}")
+        self.assertEqual(self.c.fetchall()[0][0], len(ids))
+
+
+class StreamTests(unittest.TestCase):
+    """
+    Check the streaming of query results, using a SQLite stand-in.
+    """
+
+    def setUp(self):
+        self.c = sqlite3.connect(":memory:").cursor()
+        self.c.execute("CREATE TABLE t (i INT, n VARCHAR(32))")
+        for i, n in enumerate(["Alan", "Bob", "Volker", "Elmer"]):
+            self.c.execute("INSERT INTO t VALUES (?, ?)", (i + 42, n))
+
+    def test_01_stream(self):
+        q = Query("t", "i", "n").order("i")
+        r = list(q.stream(self.c, chunk=3, named=True))
+        names = ["Alan", "Bob", "Volker", "Elmer"]
+        self.assertEqual([row.n for row in r], names)
+        self.assertEqual(r[0].i, 42)
+    def test_02_csv_and_jsonl(self):
+        fp = io.StringIO(newline="")
+        q = Query("t", "i", "n").order("i").where("i > 43")
+        self.assertEqual(q.write_csv(fp, self.c, chunk=1), 2)
+        self.assertEqual(fp.getvalue(), "i,n\r\n44,Volker\r\n45,Elmer\r\n")
+        fp = io.StringIO()
+        self.assertEqual(q.write_jsonl(fp, self.c), 2)
+        lines = fp.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[1]), dict(i=45, n="Elmer"))
+    def test_03_sheet(self):
+        sheet = []
+        q = Query("t", "n").order("i").where("i < 44")
+        self.assertEqual(q.write_sheet(sheet, self.c, header=False), 2)
+        self.assertEqual(sheet, [["Alan"], ["Bob"]])
+
+
+class QueryStatsTests(unittest.TestCase):
+    """
+    Check the cursor instrumentation, using a SQLite stand-in.
+    """
+
+    def setUp(self):
+        QueryStats.reset()
+        conn = QueryStats.Connection(sqlite3.connect(":memory:"))
+        self.c = conn.cursor()
+        self.c.execute("CREATE TABLE t (i INT, n VARCHAR(32))")
+
+    def test_01_fingerprints(self):
+        for i, n in enumerate(["Alan", "Bob", "Volker"]):
+            self.c.execute(f"INSERT INTO t VALUES ({i}, '{n}')")
+        q = Query("t", "n").where(Query.Condition("i", [0, 1, 2], "IN"))
+        self.assertEqual(len(q.execute(self.c).fetchall()), 3)
+        stats = {s["fingerprint"]: s for s in QueryStats.report()}
+        insert = stats["INSERT INTO t VALUES (?, ...)"]
+        self.assertEqual(insert["count"], 3)
+        self.assertEqual(insert["rows"], 3)
+        select = stats["SELECT n FROM t WHERE i IN (?, ...)"]
+        self.assertEqual(select["rows"], 3)
+        self.assertEqual(len(select["callers"]), 1)
+
+
+class RefCacheTests(unittest.TestCase):
+    """
+    Check the reference table cache, using a SQLite stand-in.
+    """
+
+    def setUp(self):
+        RefCache.invalidate()
+        self.c = sqlite3.connect(":memory:").cursor()
+        self.c.execute("CREATE TABLE ref_test (id INT, name VARCHAR(32))")
+        self.c.execute("INSERT INTO ref_test VALUES (1, 'Alan')")
+        self.loads = 0
+
+    def tearDown(self):
+        RefCache.WATERMARKS.pop("ref_test", None)
+        RefCache.TTLS.pop("ref_test", None)
+        RefCache.invalidate()
+
+    def get(self):
+        def loader(cursor):
+            self.loads += 1
+            return cursor.execute("SELECT name FROM ref_test").fetchall()
+        opts = dict(cursor=self.c, tier="TEST")
+        return RefCache.get("ref_test", "names", loader, **opts)
+
+    def test_01_ttl(self):
+        RefCache.WATERMARKS["ref_test"] = None
+        self.assertEqual(self.get(), [("Alan",)])
+        self.c.execute("INSERT INTO ref_test VALUES (2, 'Bob')")
+        self.assertEqual(len(self.get()), 1)
+        self.assertEqual(self.loads, 1)
+        RefCache.invalidate("ref_test", tier="test")
+        self.assertEqual(len(self.get()), 2)
+        self.assertEqual(self.loads, 2)
+
+    def test_02_watermark(self):
+        RefCache.WATERMARKS["ref_test"] = "SELECT COUNT(*) FROM {}"
+        RefCache.TTLS["ref_test"] = -1
+        RefCache.PROBE_INTERVAL, interval = 0, RefCache.PROBE_INTERVAL
+        try:
+            self.get()
+            self.get()
+            self.assertEqual(self.loads, 1)
+            self.c.execute("INSERT INTO ref_test VALUES (2, 'Bob')")
+            self.assertEqual(len(self.get()), 2)
+            self.assertEqual(self.loads, 2)
+        finally:
+            RefCache.PROBE_INTERVAL = interval
+
+    def test_03_query_loader(self):
+        RefCache.WATERMARKS["ref_test"] = None
+        query = Query("ref_test", "name").where("id = 1")
+        opts = dict(cursor=self.c, tier="TEST")
+        rows = RefCache.get("ref_test", "alan", query, **opts)
+        self.assertEqual(rows, [("Alan",)])
+        self.c.execute("DELETE FROM ref_test")
+        rows = RefCache.get("ref_test", "alan", query, **opts)
+        self.assertEqual(rows, [("Alan",)])
+
+    def test_04_probe_failures(self):
+        class Cursor:
+            def __init__(self, state):
+                self.state = state
+            def execute(self, sql):
+                raise Exception(self.state, "probe failed")
+        RefCache.WATERMARKS["ref_test"] = "SELECT COUNT(*) FROM {}"
+        opts = dict(tier="TEST")
+        load = lambda cursor: "value"
+        RefCache.get("ref_test", "x", load, cursor=Cursor("HYT00"), **opts)
+        self.assertIsNotNone(RefCache.WATERMARKS["ref_test"])
+        RefCache.invalidate()
+        RefCache.get("ref_test", "x", load, cursor=Cursor("42S22"), **opts)
+        self.assertIsNone(RefCache.WATERMARKS["ref_test"])
+
+    def test_05_own_connection(self):
+        class Connection:
+            opened = closed = 0
+            def __init__(self, tier):
+                Connection.opened += 1
+            def cursor(self):
+                return test.c
+            def close(self):
+                Connection.closed += 1
+        test = self
+        RefCache.WATERMARKS["ref_test"] = "SELECT COUNT(*) FROM {}"
+        RefCache.TTLS["ref_test"] = -1
+        connect = RefCache._RefCache__connect
+        RefCache._RefCache__connect = Connection
+        try:
+            load = lambda cursor: cursor.execute("SELECT 1").fetchall()
+            for key in ("x", "x", "y"):
+                RefCache.get("ref_test", key, load, tier="TEST")
+            self.assertEqual(Connection.opened, 3)
+            self.assertEqual(Connection.closed, 3)
+        finally:
+            RefCache._RefCache__connect = connect
+
+
+class PoolTests(unittest.TestCase):
+    """
+    Check the connection pool, using SQLite connections as stand-ins.
+    """
+
+    @staticmethod
+    def factory():
+        """Open a new stand-in connection"""
+        return sqlite3.connect(":memory:", check_same_thread=False)
+
+    def test_01_reuse(self):
+        pool = Pool()
+        conn = pool.checkout(self.factory)
+        raw = conn._conn
+        conn.close()
+        conn = pool.checkout(self.factory)
+        self.assertIs(conn._conn, raw)
+        self.assertEqual(pool.metrics["created"], 1)
+        self.assertEqual(pool.metrics["busy"], 1)
+        conn.close()
+        self.assertEqual(pool.metrics["idle"], 1)
+    def test_02_health_check(self):
+        pool = Pool()
+        conn = pool.checkout(self.factory)
+        raw = conn._conn
+        conn.close()
+        raw.close()
+        conn = pool.checkout(self.factory)
+        self.assertIsNot(conn._conn, raw)
+        self.assertEqual(pool.metrics["failed_checks"], 1)
+        self.assertEqual(pool.metrics["open"], 1)
+    def test_03_reset_on_return(self):
+        pool = Pool()
+        conn = pool.checkout(self.factory)
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE t (i INT)")
+        conn.commit()
+        cursor.execute("INSERT INTO t VALUES (42)")
+        conn.close()
+        conn = pool.checkout(self.factory)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM t")
+        self.assertEqual(cursor.fetchall()[0][0], 0)
+    def test_04_total_cap(self):
+        pool = Pool(max_total=1, wait=0.1)
+        conn = pool.checkout(self.factory)
+        with self.assertRaises(Exception):
+            pool.checkout(self.factory)
+        self.assertEqual(pool.metrics["timeouts"], 1)
+        threading.Timer(0.1, conn.close).start()
+        pool.wait = 5
+        conn = pool.checkout(self.factory)
+        self.assertEqual(pool.metrics["waits"], 1)
+        self.assertGreater(pool.metrics["max_wait_seconds"], 0)
+        self.assertEqual(pool.metrics["created"], 1)
+    def test_05_idle_cap_and_age(self):
+        pool = Pool(max_idle=1)
+        first = pool.checkout(self.factory)
+        second = pool.checkout(self.factory)
+        first.close()
+        second.close()
+        self.assertEqual(pool.metrics["open"], 1)
+        pool = Pool(max_age=0)
+        pool.checkout(self.factory).close()
+        pool.checkout(self.factory).close()
+        self.assertEqual(pool.metrics["created"], 2)
+        self.assertEqual(pool.metrics["recycled"], 2)
+    def test_06_unclosed_connection(self):
+        pool = Pool()
+        conn = pool.checkout(self.factory)
+        del conn
+        self.assertEqual(pool.metrics["open"], 0)
+        self.assertEqual(pool.metrics["discarded"], 1)
+    def test_07_released_connection(self):
+        pool = Pool()
+        conn = pool.checkout(self.factory)
+        self.assertTrue(hasattr(conn, "cursor"))
+        conn.close()
+        self.assertFalse(hasattr(conn, "cursor"))
+        self.assertIsNone(getattr(conn, "cursor", None))
+        with self.assertRaises(AttributeError):
+            conn.cursor()
 
 if __name__ == "__main__":
     unittest.main()
@@ -3,9 +3,17 @@ Manage CDR documents
 """
 
 import base64
+import bisect
+from collections import OrderedDict
+import contextlib
 import copy
 import datetime
+import functools
+import hashlib
+import json
+import os
 import re
+import sqlite3
 import sys
 import threading
 import time
@@ -14,7 +22,34 @@ from urllib.parse import unquote as url_unquote
 import dateutil.parser
 from lxml import etree
 import requests
-from cdrapi.db import Query
+from cdrapi.db import Query, RefCache
+
+
+def timed(name):
+    """
+    Decorator for `Doc` methods which make up a phase of the save
+
+    Methods invoked when a save is not being timed are passed
+    through without any overhead beyond an attribute lookup.
+    Also available as `SaveTimer.timed()`.
+
+    Pass:
+      name - string identifying the phase
+
+    Return:
+      decorator function
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(doc, *args, **kwargs):
+            timer = doc.__dict__.get("_timer")
+            if timer is None:
+                return method(doc, *args, **kwargs)
+            with timer.phase(name):
+                return method(doc, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class Doc(object):
@@ -79,6 +114,13 @@ class Doc(object):
     BLOCKED = INACTIVE = "I"
     DELETED = "D"
     VALIDATION_TEMPLATE = None
+
+    # Compiled schemas, least recently used first (see
+    # `__get_compiled_schema()`); set CDR_SCHEMA_CACHE_SIZE to change
+    # the number held.
+    SCHEMAS = OrderedDict()
+    SCHEMA_CACHE_SIZE = int(os.environ.get("CDR_SCHEMA_CACHE_SIZE") or 50)
+    SCHEMA_LOCK = threading.Lock()
     VALIDATION = "validation"
 
     # Type and level values for error messages
@@ -97,20 +139,47 @@ class Doc(object):
     MAX_INDEX_ELEMENT_DEPTH = 40
     INDEX_POSITION_WIDTH = 4
     MAX_LOCATION_LENGTH = INDEX_POSITION_WIDTH * MAX_INDEX_ELEMENT_DEPTH
+    TOO_DEEP = "boolean({})".format("/".join(
+        ["*"] * (MAX_INDEX_ELEMENT_DEPTH + 1)))
 
     # Patterns for generating the values for columns in the query term tables
     HEX_INDEX = f"{{:0{INDEX_POSITION_WIDTH}X}}"
     INTEGERS = re.compile(r"\d+")
 
+    QUERY_TERM_FIELDS = "doc_id", "path", "value", "int_val", "node_loc"
+    QUERY_TERM_INSERT = "INSERT INTO {{}} ({}) VALUES ({})".format(
+        ", ".join(QUERY_TERM_FIELDS),
+        ", ".join(["?"] * len(QUERY_TERM_FIELDS)),
+    )
+
+    # Set CDR_BULK_QUERY_TERMS=N to write index and link rows one at a time
+    BULK_QUERY_TERMS = os.environ.get("CDR_BULK_QUERY_TERMS", "Y") != "N"
+
     # Codes indicating which markup revision should be applied
     REVISION_LEVEL_PUBLISHED = 3
     REVISION_LEVEL_PUBLISHED_OR_APPROVED = 2
     REVISION_LEVEL_PUBLISHED_OR_APPROVED_OR_PROPOSED = 1
     DEFAULT_REVISION_LEVEL = REVISION_LEVEL_PUBLISHED
 
+    # Revision markup elements, and the highest (most restrictive) level
+    # at which each `RevisionLevel` attribute value is accepted (markup
+    # with any other value is never accepted).
+    REVISION_MARKUP_TAGS = "Insertion", "Deletion"
+    REVISION_MARKUP_LEVELS = dict(publish=3, approved=2, proposed=1)
+
+    # Set CDR_NATIVE_REVISION_MARKUP=Y to resolve markup without XSL/T
+    NATIVE_REVISION_MARKUP = os.environ.get(
+        "CDR_NATIVE_REVISION_MARKUP", "N"
+    ).upper() == "Y"
+
     # Optimization for mailer cleanup, avoiding mailers from the Oracle system
     LEGACY_MAILER_CUTOFF = 390000
 
+    # Number of documents fetched by each query when loading in bulk
+    # (kept at the point above which `Query` switches from parameters
+    # to a temporary table for IN lists, so each chunk is one query)
+    BULK_LOAD_CHUNK_SIZE = Query.ID_TABLE_THRESHOLD
+
     # Error messages for exceptions raised when a version can't be found
     NOT_VERSIONED = "document not versioned"
     NO_PUBLISHABLE_VERSIONS = "no publishable version found"
@@ -172,11 +241,8 @@ class Doc(object):
 
         if not self.id:
             return None
-        query = Query("all_docs", "active_status")
-        query.where(query.Condition("id", self.id))
-        rows = query.execute(self.cursor).fetchall()
-        assert rows, "Document not in database"
-        status = rows[0].active_status
+        assert self.metadata, "Document not in database"
+        status = self.metadata.active_status
         assert status in "AID", "Invalid active_status value"
         return status
 
@@ -335,16 +401,11 @@ class Doc(object):
             elif not self.id:
                 self._doctype = None
             else:
-                table = "doc_version" if self.version else "all_docs"
-                query = Query(table, "doc_type")
-                query.where(query.Condition("id", self.id))
-                if self.version:
-                    query.where(query.Condition("num", self.version))
-                rows = query.execute(self.cursor).fetchall()
-                if not rows:
+                metadata = self.__get_version_metadata()
+                if metadata is None or not metadata.found:
                     what = "version" if self.version else "document"
                     raise Exception(what + " not found")
-                self._doctype = Doctype(self.session, id=rows[0].doc_type)
+                self._doctype = Doctype(self.session, id=metadata.doc_type)
         return self._doctype
 
     @doctype.setter
@@ -570,13 +631,9 @@ class Doc(object):
         Integer for the most recently created publishable version, if any
         """
 
-        if not self.id:
+        if not self.id or self.metadata is None:
             return None
-        query = Query("doc_version", "MAX(num) AS n")
-        query.where(query.Condition("id", self.id))
-        query.where("publishable = 'Y'")
-        rows = query.execute(self.cursor).fetchall()
-        return rows[0].n if rows else None
+        return self.metadata.last_publishable_version
 
     @property
     def last_saved(self):
@@ -587,9 +644,8 @@ class Doc(object):
         versioning.
         """
 
-        modification = self.modification
-        if modification:
-            return modification.when
+        if self.metadata is not None and self.metadata.last_saved:
+            return self.metadata.last_saved
         creation = self.creation
         if creation:
             return creation.when
@@ -601,13 +657,9 @@ class Doc(object):
         Integer for the most recently created publishable version, if any
         """
 
-        if not self.id:
+        if not self.id or self.metadata is None:
             return None
-        query = Query("doc_version", "MAX(num) AS n")
-        query.where(query.Condition("id", self.id))
-        query.where("val_status = 'V'")
-        rows = query.execute(self.cursor).fetchall()
-        return rows[0].n if rows else None
+        return self.metadata.last_valid_version
 
     @property
     def last_version(self):
@@ -615,12 +667,9 @@ class Doc(object):
         Integer for the most recently saved version, if any; else None
         """
 
-        if not self.id:
+        if not self.id or self.metadata is None:
             return None
-        query = Query("doc_version", "MAX(num) AS n")
-        query.where(query.Condition("id", self.id))
-        rows = query.execute(self.cursor).fetchall()
-        return rows[0].n if rows else None
+        return self.metadata.last_version
 
     @property
     def last_version_date(self):
@@ -628,12 +677,9 @@ class Doc(object):
         Date/time when the last version was created, if any; else None
         """
 
-        if not self.id:
+        if not self.id or self.metadata is None:
             return None
-        query = Query("doc_version", "MAX(updated_dt) as dt")
-        query.where(query.Condition("id", self.id))
-        rows = query.execute(self.cursor).fetchall()
-        date = rows[0].dt if rows else None
+        date = self.metadata.last_version_date
         if isinstance(date, datetime.datetime):
             return date.replace(microsecond=0)
         return date
@@ -659,6 +705,34 @@ class Doc(object):
         rows = query.execute(self.cursor).fetchall()
         return self.Lock(rows[0]) if rows else None
 
+    @property
+    def metadata(self):
+        """
+        `Doc.Metadata` snapshot of the document's database values
+
+        Fetched lazily with a single query and reused by the properties
+        for the document's versions, status, title, etc. Use `refresh()`
+        to pick up changes made by someone else.
+
+        Return:
+          `Doc.Metadata` object, or None if the document isn't in the
+          database
+        """
+
+        if not self.id:
+            return None
+        if not hasattr(self, "_metadata") or self._metadata is None:
+            version = self.Metadata.UNRESOLVED
+            if hasattr(self, "_version") and self._version is not None:
+                version = self._version
+            elif str(self.__opts.get("version")).isdigit():
+                version = int(self.__opts["version"]) or None
+            elif not self.__opts.get("version"):
+                if not self.__opts.get("before"):
+                    version = None
+            self._metadata = self.__fetch_metadata(version)
+        return self._metadata
+
     @property
     def modification(self):
         """
@@ -687,14 +761,11 @@ class Doc(object):
 
         if not self.id or not self.version:
             return None
-        query = Query("doc_version", "publishable")
-        query.where(query.Condition("id", self.id))
-        query.where(query.Condition("num", self.version))
-        rows = query.execute(self.cursor).fetchall()
-        if not rows:
+        metadata = self.__get_version_metadata()
+        if metadata is None or not metadata.found:
             message = f"Information for version {self.version} missing"
             raise Exception(message)
-        return rows[0].publishable == "Y"
+        return metadata.publishable == "Y"
 
     @property
     def ready_for_review(self):
@@ -748,6 +819,14 @@ class Doc(object):
 
         return self.__session
 
+    @property
+    def timing(self):
+        """
+        `SaveTimer` object for the most recent timed save (or None)
+        """
+
+        return getattr(self, "_timing", None)
+
     @property
     def title(self):
         """
@@ -1077,6 +1156,32 @@ class Doc(object):
         self.__check_out(**opts)
         self.session.conn.commit()
 
+    def check_revision_markup(self, level=None):
+        """
+        Compare the native revision markup resolution with the XSL/T filter
+
+        Pass:
+          level - integer (1-3) for what markup to apply/discard
+
+        Return:
+          True if the two implementations produce the same document
+        """
+
+        if self.root is None:
+            return True
+        opts = dict(level=level, native=False)
+        expected = self.__apply_revision_markup(**opts)
+        opts["native"] = True
+        actual = self.__apply_revision_markup(**opts)
+        expected = etree.tostring(expected, encoding="unicode")
+        actual = etree.tostring(actual, encoding="unicode")
+        if actual != expected:
+            args = self.cdr_id, level or self.revision_level
+            self.session.logger.warning("revision markup mismatch for %s "
+                                        "at level %s", *args)
+            return False
+        return True
+
     def delete(self, **opts):
         """
         Mark the document as deleted
@@ -1146,6 +1251,8 @@ class Doc(object):
                 self.cursor.execute(update, (self.id,))
                 self.__audit_action("Doc.delete", "DELETE DOCUMENT", reason)
                 self.session.conn.commit()
+                if self.doctype.name == "Filter":
+                    Filter.TRANSFORMS.invalidate()
             else:
                 raise Exception(f"{self.cdr_id} has incoming links")
         except:
@@ -1218,7 +1325,7 @@ class Doc(object):
                     self.session.logger.debug("applying filter %d", f.doc_id)
                 else:
                     self.session.logger.debug("applying in-memory filter")
-                result = self.__apply_filter(f.xml, doc, parser, **parms)
+                result = self.__apply_filter(f, doc, parser, **parms)
                 doc = result.result_tree
                 self.session.logger.debug("filter result: %r", str(doc))
                 for entry in result.error_log:
@@ -1266,7 +1373,7 @@ class Doc(object):
                 href = node.get("href")
                 node.set("href", href.replace(" ", "%20"))
         xml = etree.tostring(root.getroottree(), encoding="utf-8")
-        return Filter(doc.id, xml)
+        return Filter(doc.id, xml, version=doc.version)
 
     def get_tree(self, depth=1):
         """
@@ -1527,7 +1634,7 @@ class Doc(object):
                         child.tail = None
             self.xml = etree.tostring(self.root, encoding="unicode")
 
-    def reindex(self):
+    def reindex(self, **opts):
         """
         Repopulate the search support tables for this document
 
@@ -1536,6 +1643,10 @@ class Doc(object):
           self.set_status()
           client XML wrapper command CdrReindexDoc
 
+        Optional keyword argument:
+          force - if True, rebuild the index rows even if the document
+                  hasn't changed since it was last indexed
+
         Return:
           None
         """
@@ -1562,11 +1673,12 @@ class Doc(object):
                 tables.append("query_term_pub")
 
         # Make sure we roll back everything if we fail anything.
+        force = opts.get("force")
         try:
-            doc.update_query_terms(tables=tables)
+            doc.update_query_terms(tables=tables, force=force)
             if last_pub_ver and "query_term_pub" not in tables:
                 doc = Doc(self.session, id=doc.id, version=last_pub_ver)
-                doc.update_query_terms(tables=["query_term_pub"])
+                doc.update_query_terms(tables=["query_term_pub"], force=force)
             self.session.conn.commit()
         except Exception as e:
             try:
@@ -1578,6 +1690,18 @@ class Doc(object):
                 pass
             raise
 
+    def refresh(self):
+        """
+        Discard the cached metadata snapshot
+
+        The next request for one of the properties which draw on the
+        snapshot (e.g., `last_version`, `title`, `val_status`) will
+        fetch fresh values from the database. The document's XML and
+        resolved version are left alone.
+        """
+
+        self._metadata = None
+
     def save(self, **opts):
         """
         Store the new or updated document
@@ -1605,19 +1729,34 @@ class Doc(object):
           title - fallback document title if no title filter exists for
                   this document type; if a title filter does exist, and
                   it produces a non-empty string, this option is ignored
+          timing - if True, record how long each phase of the save takes
+                   (see `SaveTimer`); defaults to `SaveTimer.ENABLED`
 
         Return:
           None
         """
 
         self.session.log(f"Doc.save({self.id}, {opts!r})")
+        self._timer = None
         try:
+            if opts.get("timing", SaveTimer.ENABLED):
+                self._timer = SaveTimer(self)
+                self._timer.install()
             self.__audit_trail_delay()
             self.__save(**opts)
             self.session.conn.commit()
             self.cursor.close()
             self._cursor = self.session.conn.commit()
+            if self.doctype.name == "Filter":
+
+                # Other filters may include this one as a module.
+                Filter.TRANSFORMS.invalidate()
+            elif self.doctype.name == "schema":
+                with Doc.SCHEMA_LOCK:
+                    Doc.SCHEMAS.clear()
+            self.__finish_timing(True)
         except:
+            self.__finish_timing(False)
             try:
                 self.session.logger.exception("Doc.save() failure")
                 self.cursor.execute("SELECT @@TRANCOUNT AS tc")
@@ -1717,14 +1856,22 @@ class Doc(object):
         self.cursor.execute(delete, (self.id, rows[0].id))
         self.session.conn.commit()
 
+    @timed("query_terms")
     def update_query_terms(self, **opts):
         """
         Populate the query support tables with values from the document
 
-        Optional keyword argument:
+        If the document's XML and the indexing rules for its type
+        haven't changed since the last time a table was populated for
+        the document (and the table's rows for the document are still
+        the ones we wrote), the table is skipped (see `IndexDigests`).
+
+        Optional keyword arguments:
           tables - set of strings identifying which index table(s) to
-                   update (`query_term` and/or `query_term_def`); default
+                   update (`query_term` and/or `query_term_pub`); default
                    is both tables
+          force - if True, repopulate the tables even if nothing appears
+                  to have changed
         """
 
         # We don't index control documents or documents with malformed XML.
@@ -1736,23 +1883,68 @@ class Doc(object):
             return
 
         # Find out which table(s) we're updating.
-        tables = opts.get("tables", ["query_term", "query_term_def"])
+        tables = opts.get("tables", ["query_term", "query_term_pub"])
         if not tables:
             return
 
-        # Find out which elements and attributes get indexed (`paths`).
-        absolute_path = f"path LIKE '/{self.doctype.name}/%'"
-        relative_path = "path LIKE '//%'"
-        query = Query("query_term_def", "path")
-        query.where(query.Or(absolute_path, relative_path))
-        rows = query.execute(self.cursor).fetchall()
-        paths = {row.path for row in rows}
+        # Find out which elements and attributes get indexed.
+        plan = IndexPlan.get(self.session, self.doctype.name, self.cursor)
+
+        # Skip the tables which are already up to date.
+        digests = IndexDigests.get_store(self.session)
+        if digests:
+            values = self.doctype.name, self.revision_level, plan.generation
+            values += IndexDigests.get_markup_generation(self),
+            digest = IndexDigests.make_digest(self.xml, *values)
+            if not opts.get("force"):
+                stale = []
+                for table in tables:
+                    args = self.session, self.cursor, self.id, table, digest
+                    warnings = digests.check(*args)
+                    if warnings is None:
+                        stale.append(table)
+                    else:
+                        for message in warnings:
+                            self.add_error(message, type=self.OTHER,
+                                           level=self.LEVEL_WARNING)
+                if not stale:
+                    args = self.id, ", ".join(tables)
+                    self.session.logger.info("CDR%d unchanged for %s", *args)
+                    return
+                tables = stale
 
         # Collect the indexable values and store them.
-        terms = set()
-        self.__collect_query_terms(self.resolved, terms, paths)
+        errors = len(self.errors)
+        terms = self.__collect_query_terms(self.resolved, plan)
+        warnings = [error.message for error in self.errors[errors:]]
         for table in tables:
             self.__store_query_terms(terms, table=table)
+            if digests:
+                args = self.session, self.cursor, self.id, table, digest
+                digests.record(*args, warnings=warnings)
+
+    def collect_query_terms(self, plan=None):
+        """
+        Find the document's indexable values
+
+        Used by jobs which populate the query term tables for newly
+        added paths without reindexing documents in full.
+
+        Pass:
+          plan - optional `IndexPlan` object controlling which values
+                 are collected (default is the plan for the document's
+                 type, built from all of the `query_term_def` paths)
+
+        Return:
+          set of path/location/value tuples (empty for documents which
+          aren't indexed)
+        """
+
+        if not self.is_content_type or self.resolved is None:
+            return set()
+        if plan is None:
+            plan = IndexPlan.get(self.session, self.doctype.name, self.cursor)
+        return self.__collect_query_terms(self.resolved, plan)
 
     def update_title(self):
         """
@@ -1799,12 +1991,18 @@ class Doc(object):
                   (only applicable if the document exists in the repository);
           level - which level of revision markup to keep for validation
                   (default is revision marked as ready to be published)
+          memo - if True, use the results of an earlier validation if
+                 they are still applicable (see the `ValidationMemo`
+                 class); default is False, as the memo only pays for
+                 itself when many unchanged documents are validated
+                 again (for example, by a global change job)
         """
 
         # Hand off the work to the private validation method.
         start = datetime.datetime.now()
         self.session.log(f"Doc.validate({self.id}, {opts!r})")
         self._errors = []
+        opts["memo"] = opts.get("memo", False)
         try:
             self.__validate(**opts)
 
@@ -1828,12 +2026,15 @@ class Doc(object):
     # PRIVATE METHODS START HERE.
     # ------------------------------------------------------------------
 
-    def __apply_filter(self, filter_xml, doc, parser=None, **parms):
+    def __apply_filter(self, filter, doc, parser=None, **parms):
         """
         Transform the document using an XSL/T filter
 
+        The compiled transform is pulled from the process-wide cache
+        if we've seen this filter before.
+
         Pass:
-          filter_xml - serialized XSL/T document
+          filter - `Filter` object for the XSL/T document
           doc - parse tree object for document to be filtered
           parser - optional object capable of resolving URLs
           parms - dictionary of  parameters to be passed to the filtering
@@ -1849,7 +2050,8 @@ class Doc(object):
                 value = value.decode("utf-8")
             if isinstance(value, str):
                 parms[name] = etree.XSLT.strparam(value)
-        transform = etree.XSLT(etree.fromstring(filter_xml, parser))
+        args = filter.xml, parser, filter.doc_id, filter.version
+        transform = Filter.TRANSFORMS.get(*args, cursor=self.cursor)
         try:
             doc = transform(doc, **parms)
         except:
@@ -1867,18 +2069,36 @@ class Doc(object):
             raise
         return self.FilterResult(doc, error_log=transform.error_log)
 
-    def __apply_revision_markup(self, root=None, level=None):
+    @timed("revision_markup")
+    def __apply_revision_markup(self, root=None, level=None, native=None):
         """
         Resolve revision markup to requested level
 
+        Most documents have no revision markup at all, in which case
+        we skip the XSL/T filter (and the work of finding and compiling
+        it) and just return a copy of the document.
+
         Pass:
           root - parsed document to be filtered
           level - integer (1-3) for what markup to apply/discard
+          native - if True, resolve the markup without the XSL/T
+                   filter (see `resolve_revision_markup()`); if None
+                   (the default) use NATIVE_REVISION_MARKUP
+
+        Return:
+          new tree with the revision markup resolved
         """
 
-        filter = "name:Revision Markup Filter"
-        parms = dict(useLevel=str(level or self.revision_level))
+        level = int(level or self.revision_level)
         doc = root if root is not None else self.root
+        if next(doc.iter(*self.REVISION_MARKUP_TAGS), None) is None:
+            return copy.deepcopy(doc)
+        if native is None:
+            native = self.NATIVE_REVISION_MARKUP
+        if native:
+            return self.resolve_revision_markup(doc, level)
+        filter = "name:Revision Markup Filter"
+        parms = dict(useLevel=str(level))
         filter_opts = dict(parms=parms, doc=doc)
         result = self.filter(filter, **filter_opts)
         return result.result_tree.getroot()
@@ -1919,6 +2139,7 @@ class Doc(object):
                 filters.append(self.get_filter(doc_id, **opts))
         return filters
 
+    @timed("audit")
     def __audit_action(self, program, action, comment=None):
         """
         Keep a record of who did what with this document
@@ -1954,6 +2175,7 @@ class Doc(object):
         args = ", ".join(fields), ", ".join(["?"] * len(fields))
         insert = "INSERT INTO audit_trail ({}) VALUES ({})".format(*args)
         self.cursor.execute(insert, values)
+        self._metadata = None
         return when
 
     def __audit_added_action(self, action, when):
@@ -1984,6 +2206,7 @@ class Doc(object):
         insert = insert.format(", ".join(fields))
         self.cursor.execute(insert, values)
 
+    @timed("audit_delay")
     def __audit_trail_delay(self):
         """
         Make sure we don't hit a primary key constraint for the audit table
@@ -2108,6 +2331,7 @@ class Doc(object):
         insert = template.format(", ".join(fields))
         self.cursor.execute(insert, values)
 
+    @timed("permissions")
     def __check_save_permissions(self, **opts):
         """
         Make sure the user can perform this save action
@@ -2213,6 +2437,7 @@ class Doc(object):
         # Inform caller know about any additional audit actions to be recorded.
         return active_status_change
 
+    @timed("link_collection")
     def __collect_links(self, doc):
         """
         Find all of the internal linking elements in the document
@@ -2246,11 +2471,14 @@ class Doc(object):
             xpath = f"//*[@cdr:{local_name}]"
             name = Doc.qname(local_name)
             for node in doc.xpath(xpath, namespaces=namespaces):
-                link = Link(self, node, name)
-                links.append(link)
-                link.store = link.key not in unique_links
-                if link.store:
-                    unique_links.add(link.key)
+                links.append(Link(self, node, name, resolve=False))
+
+        # Resolve all of the link targets in a few set-based queries.
+        Link.resolve_targets(self.session, links)
+        for link in links:
+            link.store = link.key not in unique_links
+            if link.store:
+                unique_links.add(link.key)
 
         # Find all of the target fragment IDs in this document.
         for node in doc.xpath("//*[@cdr:id]", namespaces=namespaces):
@@ -2268,62 +2496,88 @@ class Doc(object):
         self.session.logger.debug("checked %d frag ids", len(self._frag_ids))
         return links
 
-    def __collect_query_terms(self, node, terms, paths, parent="", loc=""):
+    def __collect_query_terms(self, root, plan):
         """
-        Recursively collect all of the document's indexable values
+        Collect all of the document's indexable values
+
+        Walks the tree iteratively, following the compiled `IndexPlan`
+        for the document's type, and skipping subtrees in which nothing
+        can be indexed when the plan allows it.
+
+        The location for each value is a string containing concatenated
+        4-digit hex numbers showing the zero-based position of each node
+        in the element's path relative to that node's siblings, with the
+        position of the root node of the document represented by an
+        empty string (since that node has no siblings, its position is
+        known).
 
         Pass:
-          node - reference to element to consider for indexing
-          terms - set of path/location/value tuples we're assembling
-          paths - set of string controlling which values we index
-          parent - xpath string for current node's parent
-          loc - string containing concatenated 4-digit hex numbers
-                showing the zero-based position of each node in
-                this element's path relative to that node's siblings,
-                with the position of the root node of the document
-                represented by an empty string (since that node
-                has no siblings, its position is known)
+          root - reference to top element of the document to be indexed
+          plan - `IndexPlan` object for the document's type
+
+        Return:
+          set of path/location/value tuples
         """
 
-        # Find out where we are and check for infinite recursion.
-        if len(loc) > self.MAX_LOCATION_LENGTH:
-            raise Exception("Indexing beyond max allowed depth")
-        path = f"{parent}/{node.tag}"
-        wild = f"//{node.tag}"
+        terms = set()
         max_length = self.MAX_SQLSERVER_INDEX_SIZE
         error_opts = dict(type=self.OTHER, level=self.LEVEL_WARNING)
         template = "Only {} characters of {} will be indexed"
-
-        # If the element's text value should be indexed, add it.
-        if path in paths or wild in paths:
-            value = Doc.get_text(node, "")
-            if len(value) > max_length:
-                value = value[:max_length]
-                message = template.format(max_length, path)
-                self.add_error(message, **error_opts)
-            terms.add((path, loc, value))
-
-        # Do the same thing for each of the element's attributes.
         namespace = f"{{{Doc.NS}}}"
-        for name in node.attrib:
-            prefixed_name = name.replace(namespace, "cdr:")
-            full_attr_path = f"{path}/@{prefixed_name}"
-            wild_attr_path = f"//@{prefixed_name}"
-            if full_attr_path in paths or wild_attr_path in paths:
-                value = node.attrib[name]
+
+        # Subtrees which are skipped aren't checked for runaway nesting
+        # by the walk below, so look for that up front.
+        if plan.prunable and root.xpath(self.TOO_DEEP):
+            raise Exception("Indexing beyond max allowed depth")
+        step = plan.root.children.get(root.tag)
+        if step is None and plan.prunable:
+            return terms
+        stack = [(root, step, f"/{root.tag}", "")]
+        while stack:
+            node, step, path, loc = stack.pop()
+
+            # Check for runaway nesting.
+            if len(loc) > self.MAX_LOCATION_LENGTH:
+                raise Exception("Indexing beyond max allowed depth")
+
+            # If the element's text value should be indexed, add it.
+            if step and step.indexed or node.tag in plan.wild_tags:
+                value = Doc.get_text(node, "")
                 if len(value) > max_length:
                     value = value[:max_length]
-                    message = template.format(max_length, full_attr_path)
+                    message = template.format(max_length, path)
                     self.add_error(message, **error_opts)
-                terms.add((full_attr_path, loc, value))
-
-        # Recursively check each of this element's child elements.
-        position = 0
-        for child in node.findall("*"):
-            child_loc = loc + self.HEX_INDEX.format(position)
-            position += 1
-            self.__collect_query_terms(child, terms, paths, path, child_loc)
+                terms.add((path, loc, value))
 
+            # Do the same thing for each of the element's attributes.
+            if step and step.attributes or plan.wild_attrs:
+                for name in node.attrib:
+                    prefixed_name = name.replace(namespace, "cdr:")
+                    indexed = step and prefixed_name in step.attributes
+                    if indexed or prefixed_name in plan.wild_attrs:
+                        attr_path = f"{path}/@{prefixed_name}"
+                        value = node.attrib[name]
+                        if len(value) > max_length:
+                            value = value[:max_length]
+                            message = template.format(max_length, attr_path)
+                            self.add_error(message, **error_opts)
+                        terms.add((attr_path, loc, value))
+
+            # Queue up the child elements which might have indexed values
+            # (in reverse, so they're processed in document order).
+            children = []
+            for position, child in enumerate(node.findall("*")):
+                child_step = step.children.get(child.tag) if step else None
+                if child_step is None and plan.prunable:
+                    continue
+                child_path = f"{path}/{child.tag}"
+                child_loc = loc + self.HEX_INDEX.format(position)
+                children.append((child, child_step, child_path, child_loc))
+            stack.extend(reversed(children))
+
+        return terms
+
+    @timed("title_filter")
     def __create_title(self):
         """
         Pass the document's XML through the title filter for its doctype
@@ -2346,6 +2600,7 @@ class Doc(object):
             self.session.logger.exception("__create_title() failure")
             return None
 
+    @timed("versioning")
     def __create_version(self, **opts):
         """
         Add a row to the `all_doc_versions` table
@@ -2411,6 +2666,7 @@ class Doc(object):
         insert = "INSERT INTO all_doc_versions ({}) VALUES ({})".format(*args)
         self.cursor.execute(insert, tuple(values))
         self._version = self._last_version = version
+        self._metadata = None
         if opts.get("publishable"):
             self._last_publishable_version = version
 
@@ -2423,6 +2679,7 @@ class Doc(object):
             insert = template.format(*args)
             self.cursor.execute(insert, values)
 
+    @timed("blob_deletion")
     def __delete_blobs(self):
         """
         Wipe out all of the rows for this document's BLOBs
@@ -2530,6 +2787,11 @@ class Doc(object):
         """
         Fetch a value from a column from `document` or `doc_version` view
 
+        The value comes from the metadata snapshot, which is fetched
+        once and kept for the life of the object (call `refresh()` to
+        see changes made since). As with the `document` view, nothing
+        is returned for the current working copy of a deleted document.
+
         Pass:
           column - string for name of column
 
@@ -2539,17 +2801,64 @@ class Doc(object):
 
         if not self.id:
             return None
-        table = "doc_version" if self.version else "document"
-        query = Query(table, column)
-        query.where(query.Condition("id", self.id))
-        if self.version:
-            query.where(query.Condition("num", self.version))
-        rows = query.execute(self.cursor).fetchall()
-        if rows:
-            return rows[0][0]
+        metadata = self.__get_version_metadata()
+        if metadata is not None and metadata.found:
+            if self.version or metadata.active_status != "D":
+                return getattr(metadata, column)
         self.session.logger.warning("%s for %s not found", column, self.cdr_id)
         return None
 
+    def __fetch_metadata(self, version):
+        """
+        Get the values for the `Doc.Metadata` snapshot in a single query
+
+        Pass:
+          version - integer for the version whose values we want,
+                    None for the current working document, or
+                    `Doc.Metadata.UNRESOLVED` to get only the values
+                    which don't depend on the version (this is what
+                    we do when we need the snapshot in order to work
+                    out which version the object represents)
+
+        Return:
+          `Doc.Metadata` object or None if the document isn't found
+        """
+
+        columns = ["d.active_status"] + list(self.Metadata.AGGREGATES)
+        if version is None:
+            columns += [f"d.{name}" for name in self.Metadata.VERSIONED]
+            columns += ["NULL AS publishable", "d.id AS found"]
+        elif version != self.Metadata.UNRESOLVED:
+            columns += [f"v.{name}" for name in self.Metadata.VERSIONED]
+            columns += ["v.publishable", "v.num AS found"]
+        query = Query("all_docs d", *columns)
+        if version is not None and version != self.Metadata.UNRESOLVED:
+            query.outer("doc_version v", "v.id = d.id",
+                        query.Condition("v.num", version))
+        query.where(query.Condition("d.id", self.id))
+        rows = query.execute(self.cursor).fetchall()
+        return self.Metadata(rows[0], version) if rows else None
+
+    def __finish_timing(self, success):
+        """
+        Wrap up the instrumentation for a timed save
+
+        Problems with the instrumentation are logged, but must not
+        interfere with the outcome of the save itself.
+
+        Pass:
+          success - False if the save failed
+        """
+
+        timer = getattr(self, "_timer", None)
+        if timer is not None:
+            self._timer = None
+            self._timing = timer
+            try:
+                timer.finish(success)
+            except Exception:
+                self.session.logger.exception("save timing failure")
+
     def __generate_fragment_ids(self):
         """
         Make sure all of the elements which can have a cdr:id attribute get one
@@ -2571,6 +2880,57 @@ class Doc(object):
         self._xml = etree.tostring(self.root, encoding="utf-8").decode("utf-8")
         self._resolved = None
 
+    def __get_compiled_schema(self):
+        """
+        Find or create the compiled schema for the document's type
+
+        Parsing a schema (with all of its included schema documents)
+        and compiling it is expensive, so the results are cached for
+        the process, along with the custom validation rule sets found
+        in the schema documents, serialized as `Filter` objects so that
+        their compiled transforms come from `Filter.TRANSFORMS`. Cached
+        entries are checked against the current schema generation (see
+        `get_schema_generation()`), so a schema saved by another process
+        is picked up, and entries from an older generation are dropped
+        as soon as a newer one is seen. Saving a schema in this process
+        clears the cache. As with compiled filters, each thread gets its
+        own objects, and the least recently used entries are dropped when
+        there are more than `SCHEMA_CACHE_SIZE` of them.
+
+        Return:
+          tuple of `etree.XMLSchema` object and sequence of `Filter`
+          objects for the custom rule sets
+        """
+
+        key = self.session.tier.name, self.doctype.schema_id
+        key += (threading.get_ident(),)
+        generation = self.get_schema_generation(self.cursor)
+        with Doc.SCHEMA_LOCK:
+            entry = Doc.SCHEMAS.get(key)
+            if entry is not None:
+                Doc.SCHEMAS.move_to_end(key)
+        if entry is not None and entry[0] == generation:
+            return entry[1:]
+        schema_doc = self.__get_schema()
+        schema = etree.XMLSchema(schema_doc)
+        sets = dict()
+        self.__extract_rule_sets(schema_doc, sets)
+        rule_sets = []
+        for name in sets:
+            for rule_set in sets[name]:
+                xml = etree.tostring(rule_set.xslt)
+                rule_sets.append(Filter(None, xml))
+        with Doc.SCHEMA_LOCK:
+            for other in list(Doc.SCHEMAS):
+                if other[0] == key[0] and Doc.SCHEMAS[other][0] != generation:
+                    del Doc.SCHEMAS[other]
+            Doc.SCHEMAS[key] = generation, schema, rule_sets
+            while len(Doc.SCHEMAS) > Doc.SCHEMA_CACHE_SIZE:
+                Doc.SCHEMAS.popitem(last=False)
+        args = self.doctype.name, len(rule_sets)
+        self.session.logger.debug("compiled %s schema (%d rule sets)", *args)
+        return schema, rule_sets
+
     def __get_filter_set(self, name, **opts):
         """
         Get the filters for the set with the specified name
@@ -2591,7 +2951,27 @@ class Doc(object):
         rows = query.execute(self.cursor).fetchall()
         if not rows:
             return []
-        return self.__get_filter_set_by_id(rows[0].id, 0, **opts)
+        set_id = rows[0].id
+        version = opts.get("version")
+        before = opts.get("before")
+        key = set_id, version, before
+
+        # Start with what this session has already assembled.
+        with self.session.cache.filter_set_lock:
+            if key in self.session.cache.filter_sets:
+                return self.session.cache.filter_sets[key]
+
+        # Next, try the cache shared by all the sessions in this process.
+        filters = Filter.SETS.get(self.session, set_id, version, before)
+        if filters is None:
+            filters = self.__get_filter_set_by_id(set_id, 0, **opts)
+            Filter.SETS.put(self.session, set_id, filters, version, before)
+
+        # Remember the set for the rest of this session.
+        with self.session.cache.filter_set_lock:
+            if key not in self.session.cache.filter_sets:
+                self.session.cache.filter_sets[key] = filters
+        return filters
 
     def __get_filter_set_by_id(self, set_id, depth, **opts):
         """
@@ -2614,11 +2994,6 @@ class Doc(object):
             raise Exception("infinite filter set recursion")
         depth += 1
 
-        # Fetch the set from the cache if we've already assembled it.
-        with self.session.cache.filter_set_lock:
-            if set_id in self.session.cache.filter_sets:
-                return self.session.cache.filter_sets[set_id]
-
         # Find the set's members (can be filters or nested filter sets).
         fields = "filter", "subset"
         query = Query("filter_set_member", *fields).order("position")
@@ -2632,11 +3007,6 @@ class Doc(object):
                 more = self.__get_filter_set_by_id(subset_id, depth, **opts)
                 filters += more
 
-        # Cache the set so we don't have to do this again.
-        with self.session.cache.filter_set_lock:
-            if set_id not in self.session.cache.filter_sets:
-                self.session.cache.filter_sets[set_id] = filters
-
         # Return the sequence of `Filter` objects.
         return filters
 
@@ -2688,6 +3058,23 @@ class Doc(object):
         xml = self.get_schema_xml(rows[0].title, self.cursor)
         return etree.fromstring(xml.encode("utf-8"), parser)
 
+    def __get_version_metadata(self):
+        """
+        Make sure the metadata snapshot matches the version we represent
+
+        If the snapshot was fetched before we knew which version we
+        have (or for a different version, because a new one was just
+        created), fetch it again.
+
+        Return:
+          `Doc.Metadata` object (or None if the document isn't found)
+        """
+
+        metadata = self.metadata
+        if metadata is not None and metadata.version != self.version:
+            metadata = self._metadata = self.__fetch_metadata(self.version)
+        return metadata
+
     def __get_version_before(self, before, publishable=None):
         """
         Find the latest version created before the specified date/time
@@ -2723,6 +3110,26 @@ class Doc(object):
             raise Exception(f"no version before {when}")
         return rows[0].n
 
+    @staticmethod
+    def __drop_node(node):
+        """
+        Remove an element (and its descendants) but not its tail text
+
+        Pass:
+          node - element to be removed
+        """
+
+        parent = node.getparent()
+        if parent is None:
+            return
+        if node.tail:
+            previous = node.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or "") + node.tail
+            else:
+                parent.text = (parent.text or "") + node.tail
+        parent.remove(node)
+
     def __insert_eids(self, root=None):
         """
         Add cdr-eid attributes to all document elements
@@ -2743,6 +3150,43 @@ class Doc(object):
                 node.set("cdr-eid", f"_{eid:d}")
                 eid += 1
 
+    @staticmethod
+    def __load_blobs(cursor, docs, ids, version):
+        """
+        Attach the BLOBs for a chunk of documents loaded by `bulk_load()`
+
+        Pass:
+          cursor - database access for the queries
+          docs - dictionary of loaded `Doc` objects indexed by ID
+          ids - integer IDs for the chunk being processed
+          version - None if the current working documents were loaded
+        """
+
+        if version:
+            fields = "doc_id", "doc_version", "blob_id"
+            query = Query("version_blob_usage", *fields)
+        else:
+            query = Query("doc_blob_usage", "doc_id", "blob_id")
+        query.where(query.Condition("doc_id", ids, "IN"))
+        blob_ids = {}
+        for row in query.execute(cursor).fetchall():
+            doc = docs.get(row.doc_id)
+            if doc is not None:
+                if not version or row.doc_version == doc.version:
+                    blob_ids[row.doc_id] = row.blob_id
+        blobs = {}
+        wanted = sorted(set(blob_ids.values()))
+        if wanted:
+            query = Query("doc_blob", "id", "data")
+            query.where(query.Condition("id", wanted, "IN"))
+            for row in query.execute(cursor).fetchall():
+                blobs[row.id] = row.data
+        for doc_id in ids:
+            if doc_id in docs:
+                blob_id = blob_ids.get(doc_id)
+                docs[doc_id]._blob_id = blob_id
+                docs[doc_id]._blob = blobs.get(blob_id)
+
     def __lt__(self, other):
         """
         Allow sorting of documents by normalized title.
@@ -2753,28 +3197,43 @@ class Doc(object):
 
         return self.title.lower().strip() < other.title.lower().strip()
 
-    def __namespaces_off(self, root):
+    def __prepare_for_validation(self, resolved):
         """
-        Rename attributes with namespaces to non-colonized names
+        Make the copy of the document used for schema validation
 
-        We do this because the XML Schema specification does not
-        support validation of attributes with namespace-qualified
-        attribute names across nested schema documents, when the
-        attributes' constraints need to change from one complex
-        type to another. Basic pattern is:
-          1. {CDR-NS}xxx => cdr-xxx for all cdr: attributes
-          2. perform schema validation on the document
-        """
+        In a single pass over a copy of the document we rename the
+        attributes in the CDR namespace to non-colonized names, because
+        the XML Schema specification does not support validation of
+        attributes with namespace-qualified names across nested schema
+        documents, when the attributes' constraints need to change from
+        one complex type to another ({CDR-NS}xxx => cdr-xxx). In the same
+        pass we remove the `cdr-eid` attributes, which the schema does
+        not allow, remembering them so they can be used to find the
+        locations of any errors (and put back for the custom rules).
 
-        if root is not None:
-            NS = f"{{{self.NS}}}"
-            for node in root.iter("*"):
-                for name in node.attrib:
-                    if name.startswith(NS):
-                        ncname = name.replace(NS, "cdr-")
-                        node.set(ncname, node.get(name))
-                        del node.attrib[name]
+        Pass:
+          resolved - document with revision markup resolved (not modified)
+
+        Return:
+          tuple of the copy of the document and a sequence of (element,
+          cdr-eid attribute value) tuples, in document order
+        """
 
+        doc = copy.deepcopy(resolved)
+        NS = f"{{{self.NS}}}"
+        eids = []
+        for node in doc.iter("*"):
+            attrib = node.attrib
+            if not attrib:
+                continue
+            for name in attrib.keys():
+                if name == "cdr-eid":
+                    eids.append((node, attrib.pop(name)))
+                elif name.startswith(NS):
+                    attrib["cdr-" + name[len(NS):]] = attrib.pop(name)
+        return doc, eids
+
+    @timed("preprocess")
     def __preprocess_save(self, **opts):
         """
         Make the final tweaks to the XML prior to saving the document
@@ -2924,7 +3383,9 @@ class Doc(object):
         self.__audit_added_action(f"{action.upper()} DOCUMENT", when)
         update = "UPDATE all_docs SET active_status = ? WHERE id = ?"
         self.cursor.execute(update, (status, self.id))
+        self._metadata = None
 
+    @timed("store")
     def __store(self, **opts):
         """
         Write to the `all_docs` table (through the `document` view)
@@ -2984,6 +3445,7 @@ class Doc(object):
             if title and title != fields["title"]:
                 update = "UPDATE document SET title = ? WHERE id = ?"
                 self.cursor.execute(update, (title, self.id))
+        self._metadata = None
 
         # If the document has a binary large object (BLOB), save it.
         if self.blob is not None:
@@ -2998,6 +3460,7 @@ class Doc(object):
             except:
                 pass
 
+    @timed("blob_storage")
     def __store_blob(self):
         """
         Store the document's BLOB and link to it
@@ -3078,6 +3541,7 @@ class Doc(object):
         self.cursor.execute(dbu, (blob_id, self.id))
         return blob_id
 
+    @timed("link_storage")
     def __store_links(self, links):
         """
         Populate the `link_net` and `link_fragment` tables
@@ -3114,16 +3578,14 @@ class Doc(object):
         # Otherwise just delete the rows which are not longer correct.
         else:
             delete += " AND source_elem = ? AND url = ?"
-            for source_element, url in unwanted:
-                args = self.id, source_element, url
-                self.cursor.execute(delete, args)
+            rows = [(self.id,) + key for key in unwanted]
+            self.__execute_many(delete, rows, self.BULK_QUERY_TERMS)
             self.session.logger.debug("cleared out unwanted links")
 
-        # Insert the rows that aren't already in place.
-        for link in links:
-            if link.key in wanted:
-                link.save(self.cursor)
-        self.session.logger.debug("stored %d links", len(links))
+        # Insert the rows that aren't already in place, in a single batch.
+        rows = [link.row for link in links if link.key in wanted]
+        self.__execute_many(Link.INSERT, rows, self.BULK_QUERY_TERMS)
+        self.session.logger.debug("stored %d links", len(rows))
 
         # Apply the same technique to the `link_fragment` table.
         query = Query("link_fragment", "fragment")
@@ -3138,17 +3600,17 @@ class Doc(object):
         delete = "DELETE FROM link_fragment WHERE doc_id = ?"
         if len(unwanted) > 500 and len(unwanted) > len(new) / 2:
             wanted = new
-            self.cursor.execute(delete, (self.id))
+            self.cursor.execute(delete, (self.id,))
             self.session.logger.debug("storing all fragments from scratch")
         else:
             delete += " AND fragment = ?"
-            for fragment_id in unwanted:
-                self.cursor.execute(delete, (self.id, fragment_id))
+            rows = [(self.id, fragment_id) for fragment_id in unwanted]
+            self.__execute_many(delete, rows, self.BULK_QUERY_TERMS)
             self.session.logger.debug("cleared out unwanted fragments")
         insert = "INSERT INTO link_fragment (doc_id, fragment) VALUES (?, ?)"
-        for fragment_id in wanted:
-            self.cursor.execute(insert, (self.id, fragment_id))
-        self.session.logger.debug("stored %d fragments", len(links))
+        rows = [(self.id, fragment_id) for fragment_id in wanted]
+        self.__execute_many(insert, rows, self.BULK_QUERY_TERMS)
+        self.session.logger.debug("stored %d fragments", len(rows))
 
     def __store_query_terms(self, terms, **opts):
         """
@@ -3165,12 +3627,20 @@ class Doc(object):
           terms - set of path/location/value tuples for the documents
                   queryable values
 
-        Optional keyword argument:
+        The deletions and insertions are each sent to the database server
+        as a single batch, using pyodbc's `fast_executemany` mode, unless
+        that has been turned off (see `BULK_QUERY_TERMS`).
+
+        Optional keyword arguments:
           table - name of the table we're writing to (default is `query_term`)
+          bulk - if False, write the rows one at a time; default is
+                 `BULK_QUERY_TERMS`
         """
 
         # Collect path/location/value tuples for the old index rows.
+        start = datetime.datetime.now()
         table = opts.get("table", "query_term")
+        bulk = opts.get("bulk", self.BULK_QUERY_TERMS)
         query = Query(table, "path", "node_loc", "value")
         query.where(query.Condition("doc_id", self.id))
         rows = query.execute(self.cursor).fetchall()
@@ -3189,21 +3659,49 @@ class Doc(object):
         # Otherwise, refine the DELETE query and do some surgical pruning.
         else:
             delete += " AND path = ? AND node_loc = ? AND value = ?"
-            for path, location, value in unwanted:
-                args = self.id, path, location, value
-                self.cursor.execute(delete, args)
+            rows = [(self.id,) + term for term in unwanted]
+            self.__execute_many(delete, rows, bulk)
 
         # Insert the rows which still need to be added (possibly all of them).
-        fields = "doc_id", "path", "value", "int_val", "node_loc"
-        args = table, ", ".join(fields), ", ".join(["?"] * len(fields))
-        insert = "INSERT INTO {} ({}) VALUES ({})".format(*args)
-        for path, location, value in wanted:
-            integers = self.INTEGERS.findall(value)
-            int_val = int(integers[0]) if integers else None
-            if int_val is not None and abs(int_val) > 2147483647:
-                int_val = 0
-            args = self.id, path, value, int_val, location
-            self.cursor.execute(insert, args)
+        insert = self.QUERY_TERM_INSERT.format(table)
+        rows = self.make_query_term_rows(self.id, wanted)
+        self.__execute_many(insert, rows, bulk)
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        args = (table, self.id, len(unwanted), len(rows),
+                "bulk" if bulk else "row-by-row", elapsed)
+        self.session.logger.info("%s for CDR%d: %d stale rows, %d rows "
+                                 "written (%s) in %f seconds", *args)
+
+        # The document's fragment IDs may have changed.
+        with self.session.cache.fragment_lock:
+            self.session.cache.fragments.pop((self.id, table), None)
+
+    def __execute_many(self, sql, rows, bulk=True):
+        """
+        Run a parameterized SQL statement for each of a sequence of rows
+
+        Pass:
+          sql - string for the statement to be executed
+          rows - sequence of parameter tuples
+          bulk - if True, send all of the rows to the database server
+                 as a single batch; otherwise execute the statement
+                 separately for each row
+        """
+
+        if not rows:
+            return
+        if not bulk:
+            for row in rows:
+                self.cursor.execute(sql, row)
+            return
+        fast = getattr(self.cursor, "fast_executemany", None)
+        if fast is not None:
+            self.cursor.fast_executemany = True
+        try:
+            self.cursor.executemany(sql, rows)
+        finally:
+            if fast is not None:
+                self.cursor.fast_executemany = fast
 
     def __strip_eids(self, root=None):
         """
@@ -3234,6 +3732,47 @@ class Doc(object):
 
         self.xml = str(self.filter("name:Strip XMetaL PIs").result_tree)
 
+    def __timing(self, name):
+        """
+        Track a block of code as a phase of the save if it is being timed
+
+        Pass:
+          name - string identifying the phase
+
+        Return:
+          context manager
+        """
+
+        timer = getattr(self, "_timer", None)
+        if timer is None:
+            return contextlib.nullcontext()
+        return timer.phase(name)
+
+    @classmethod
+    def __unwrap_node(cls, node):
+        """
+        Replace an element with its content
+
+        Pass:
+          node - element to be replaced
+        """
+
+        parent = node.getparent()
+        if parent is None:
+            return
+        if node.text:
+            previous = node.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or "") + node.text
+            else:
+                parent.text = (parent.text or "") + node.text
+            node.text = None
+        position = parent.index(node)
+        for child in list(node):
+            parent.insert(position, child)
+            position += 1
+        cls.__drop_node(node)
+
     def __update_val_status(self, store):
         """
         Store the current validation status in the database
@@ -3261,8 +3800,10 @@ class Doc(object):
         update += "WHERE id = ?"
         args = self.val_status, self.id
         self.cursor.execute(update, args)
+        self._metadata = None
         return True
 
+    @timed("validate")
     def __validate(self, **opts):
         """
         Determine whether the document conforms to the rules for its type
@@ -3279,6 +3820,8 @@ class Doc(object):
                   (only applicable if the document exists in the repository);
           level - which level of revision markup to keep for validation
                   (default is revision marked as ready to be published)
+          memo - if True, use the results of an earlier validation if
+                 they are still applicable, and remember these results
 
         Return:
           None
@@ -3304,6 +3847,8 @@ class Doc(object):
         # Defaults to be possibly overridden for well-formed content documents.
         validation_xml = self.xml
         complete = True
+        memo = digest = None
+        links_stored = False
 
         # Most validation is only done for well-formed non-control documents.
         if self.root is not None and self.is_content_type:
@@ -3323,6 +3868,20 @@ class Doc(object):
 
             # Find out if we've been asked to do schema and/or link validation.
             validation_types = opts.get("types", ["schema", "links"])
+
+            # Use the results of an earlier validation if nothing has changed.
+            store = opts.get("store", "always")
+            if opts.get("memo") and validation_types:
+                memo = ValidationMemo.get_store(self.session)
+                if memo is not None:
+                    args = validation_xml, resolved
+                    digest = memo.make_digest(self, *args, **opts)
+                    args = digest, validation_types, store
+                    if memo.check(self, *args):
+                        self.session.logger.info("using memoized validation")
+                        self.__update_val_status(store)
+                        return
+
             if validation_types:
 
                 # Apply schema validation if requested.
@@ -3333,8 +3892,7 @@ class Doc(object):
 
                 # Apply link validation if requested.
                 if "links" in validation_types:
-                    store = opts.get("store", "always")
-                    self.__validate_links(resolved, store=store)
+                    links_stored = self.__validate_links(resolved, store=store)
                 else:
                     complete = False
 
@@ -3360,9 +3918,14 @@ class Doc(object):
             elif complete:
                 self._val_status = self.VALID
 
+        # Remember the results for the next time the document is validated.
+        if digest is not None:
+            memo.record(self, digest, links_stored)
+
         # Optionally record the results of the validation.
         self.__update_val_status(opts.get("store", "always"))
 
+    @timed("schema_validation")
     def __validate_against_schema(self, resolved):
         """
         Check the XML document against the requirements for its doctype
@@ -3387,10 +3950,8 @@ class Doc(object):
                 Doc.VALIDATION_TEMPLATE = self.get_filter(doc_id).xml
 
         # Get the document node to validate and schema for the document's type.
-        doc = copy.deepcopy(resolved)
-        self.__namespaces_off(doc)
-        schema_doc = self.__get_schema()
-        schema = etree.XMLSchema(schema_doc)
+        doc, eids = self.__prepare_for_validation(resolved)
+        schema, rule_sets = self.__get_compiled_schema()
 
         # Put a reference to our `Doc` object somewhere where callbacks
         # can find it.
@@ -3398,28 +3959,27 @@ class Doc(object):
         try:
 
             # Validate against the schema.
-            doc_without_eids = copy.deepcopy(doc)
-            self.__strip_eids(doc_without_eids)
-            if not schema.validate(doc_without_eids):
-                location = None
-                if self.eids is not None:
-                    line_map = self.LineMap(self.eids)
-                for error in schema.error_log:
-                    if self.eids is not None:
-                        location = line_map.get_error_location(error)
-                    self.add_error(error.message, location)
-
-            # If there are any custom rules, apply them, too.
-            sets_dictionary = dict()
-            self.__extract_rule_sets(schema_doc, sets_dictionary)
-            for name in sets_dictionary:
-                rule_sets = sets_dictionary[name]
-                if not name:
-                    name = "anonymous"
-                for rule_set in rule_sets:
-                    filter_xml = etree.tostring(rule_set.xslt)
+            with self.__timing("schema"):
+                if not schema.validate(doc):
+                    line_map = None
+                    if eids:
+                        nodes = ((n.sourceline, n.tag, e) for n, e in eids)
+                        line_map = self.LineMap(nodes)
+                    for error in schema.error_log:
+                        location = None
+                        if line_map is not None:
+                            location = line_map.get_error_location(error)
+                        self.add_error(error.message, location)
+
+            # If there are any custom rules, apply them, too. They need
+            # the `cdr-eid` attributes to report the error locations.
+            with self.__timing("custom_rules"):
+                if rule_sets:
+                    for node, eid in eids:
+                        node.set("cdr-eid", eid)
+                for filter in rule_sets:
                     parser = Doc.Parser()
-                    result = self.__apply_filter(filter_xml, doc, parser)
+                    result = self.__apply_filter(filter, doc, parser)
                     for node in result.result_tree.findall("Err"):
                         self.add_error(node.text, node.get("cdr-eid"))
                     for entry in result.error_log:
@@ -3430,6 +3990,7 @@ class Doc(object):
             # even if something goes horribly wrong during the validation.
             Resolver.local.docs.pop()
 
+    @timed("link_validation")
     def __validate_links(self, resolved, store="always"):
         """
         Collect and check all of the document's links for validity
@@ -3443,43 +4004,176 @@ class Doc(object):
                   "never": don't touch the database
                   "valid": store link info if the document is valid
                   "always": store the link info unconditionally (the default)
+
+        Return:
+          True if the linking tables were updated; otherwise False
         """
 
         if not self.doctype or not self.doctype.id:
             problem = "invalid" if self.doctype else "missing"
             raise Exception(f"__validate_links(): {problem} doctype")
         links = self.__collect_links(resolved)
+        Link.load_fragments(self.session, links)
         for link in links:
             if link.internal:
                 link.validate()
         if self.id:
             if store == "always" or store == "valid" and not self.errors:
                 self.__store_links(links)
+                return True
+        return False
 
     # ------------------------------------------------------------------
     # STATIC AND CLASS METHODS START HERE.
     # ------------------------------------------------------------------
 
-    @staticmethod
-    def create_label(session, label, comment=None):
+    @classmethod
+    def bulk_load(cls, session, ids, version="lastp", before=None, **opts):
         """
-        Create a name which can be used for tagging one or more doc versions
+        Fetch many documents with a handful of set-based queries
+
+        Building `Doc` objects one at a time means several queries for
+        each document (version resolution, XML, document type, etc.).
+        This method resolves the versions, and fetches the XML and the
+        metadata snapshot for a batch of documents in a single query
+        (and the BLOBs in two more, if requested), breaking the ID list
+        into chunks to stay under SQL Server's limit on the number of
+        parameters.
 
         Called by:
-          cdr.create_label()
-          client XML wrapper command CdrCreateLabel
+          publishing and batch jobs processing many documents
 
         Pass:
           session - reference to object representing user's login
-          label - string used to tag document versions
-          comment - optional string describing the label's usage
-        """
+          ids - sequence of CDR document IDs (integers or strings)
+          version - "lastp" (the default) for latest publishable versions,
+                    "last" for latest versions, "lastv" for latest valid
+                    versions, a version number, or None (or "current")
+                    for the current working documents
+          before - optional date/time cutoff for the versions
 
-        session.log(f"Doc.create_label({label!r}, comment={comment!r})")
-        assert label, "Missing label name"
+        Optional keyword arguments:
+          blobs - if True, fetch the documents' BLOBs as well
+          level - passed through to the `Doc` constructor
+          xml - if False, don't fetch the documents' XML (it will be
+                loaded on demand if needed); default is True
+          deleted - if True, include deleted documents when loading
+                    the current working documents; default is False
+
+        Return:
+          sequence of `Doc` objects, in the order of the `ids` passed in;
+          documents for which the requested version can't be found are
+          omitted
+        """
+
+        # Normalize the arguments.
+        if isinstance(version, str):
+            version = version.lower()
+            if version in ("current", "none"):
+                version = None
+            elif version == "lastversion":
+                version = "last"
+        if before:
+            if not isinstance(before, (datetime.date, datetime.datetime)):
+                before = dateutil.parser.parse(before)
+            before = before.replace(microsecond=0)
+            if not version:
+                version = "last"
+        unique_ids = []
+        seen = set()
+        for doc_id in ids:
+            doc_id = cls.extract_id(doc_id)
+            if doc_id not in seen:
+                seen.add(doc_id)
+                unique_ids.append(doc_id)
+
+        # Work through the documents in chunks.
+        load_xml = opts.get("xml", True)
         cursor = session.conn.cursor()
-        query = Query("version_label", "COUNT(*) AS n")
-        query.where(query.Condition("name", label))
+        docs = {}
+        doctypes = {}
+        try:
+            chunk_size = cls.BULK_LOAD_CHUNK_SIZE
+            for start in range(0, len(unique_ids), chunk_size):
+                chunk = unique_ids[start:start+chunk_size]
+                if version:
+                    xml = "v.xml" if load_xml else "NULL AS xml"
+                    fields = ["v.id", "v.num", xml, "v.publishable"]
+                    fields += [f"v.{name}" for name in cls.Metadata.VERSIONED]
+                    fields += ["d.active_status", "v.num AS found"]
+                    fields += cls.Metadata.AGGREGATES
+                    query = Query("doc_version v", *fields)
+                    query.join("all_docs d", "d.id = v.id")
+                    query.where(query.Condition("v.id", chunk, "IN"))
+                    if str(version).isdigit():
+                        query.where(query.Condition("v.num", int(version)))
+                    else:
+                        subquery = Query("doc_version", "MAX(num)")
+                        subquery.where("id = v.id")
+                        if version.startswith("lastp"):
+                            subquery.where("publishable = 'Y'")
+                        elif version.startswith("lastv"):
+                            subquery.where("val_status = 'V'")
+                        elif version != "last":
+                            raise Exception(f"invalid version spec {version}")
+                        if before:
+                            subquery.where(subquery.Condition("dt", before, "<"))
+                        query.where(query.Condition("v.num", subquery))
+                else:
+                    xml = "d.xml" if load_xml else "NULL AS xml"
+                    fields = ["d.id", "NULL AS num", xml]
+                    fields += ["NULL AS publishable"]
+                    fields += [f"d.{name}" for name in cls.Metadata.VERSIONED]
+                    fields += ["d.active_status", "d.id AS found"]
+                    fields += cls.Metadata.AGGREGATES
+                    query = Query("all_docs d", *fields)
+                    query.where(query.Condition("d.id", chunk, "IN"))
+                    if not opts.get("deleted"):
+                        query.where("d.active_status <> 'D'")
+                for row in query.execute(cursor).fetchall():
+                    doc_opts = dict(id=row.id, version=row.num)
+                    if "level" in opts:
+                        doc_opts["level"] = opts["level"]
+                    doc = cls(session, **doc_opts)
+                    doc._version = row.num
+                    if load_xml:
+                        doc._xml = row.xml
+                    doc._metadata = cls.Metadata(row, row.num)
+                    if row.doc_type not in doctypes:
+                        doctype = Doctype(session, id=row.doc_type)
+                        doctypes[row.doc_type] = doctype
+                    doc._doctype = doctypes[row.doc_type]
+                    docs[row.id] = doc
+
+                # Pick up the BLOBs if the caller wants them.
+                if opts.get("blobs"):
+                    cls.__load_blobs(cursor, docs, chunk, version)
+        finally:
+            cursor.close()
+        session.logger.debug("bulk_load() loaded %d of %d documents",
+                             len(docs), len(unique_ids))
+        return [docs[doc_id] for doc_id in unique_ids if doc_id in docs]
+
+    @staticmethod
+    def create_label(session, label, comment=None):
+        """
+        Create a name which can be used for tagging one or more doc versions
+
+        Called by:
+          cdr.create_label()
+          client XML wrapper command CdrCreateLabel
+
+        Pass:
+          session - reference to object representing user's login
+          label - string used to tag document versions
+          comment - optional string describing the label's usage
+        """
+
+        session.log(f"Doc.create_label({label!r}, comment={comment!r})")
+        assert label, "Missing label name"
+        cursor = session.conn.cursor()
+        query = Query("version_label", "COUNT(*) AS n")
+        query.where(query.Condition("name", label))
         if query.execute(cursor).fetchall()[0].n > 0:
             raise Exception(f"Label {label!r} already exists")
         insert = "INSERT INTO version_label (name, comment) VALUES (?, ?)"
@@ -3523,6 +4217,28 @@ class Doc(object):
             session.logger.exception("delete_label() failure")
             raise Exception(f"Failure deleting label {label!r}")
 
+    @classmethod
+    def make_query_term_rows(cls, doc_id, terms):
+        """
+        Build the rows for inserting values into a query term table
+
+        Pass:
+          doc_id - integer for the document's ID
+          terms - sequence of path/location/value tuples
+
+        Return:
+          sequence of value tuples matching `QUERY_TERM_FIELDS`
+        """
+
+        rows = []
+        for path, location, value in terms:
+            integers = cls.INTEGERS.findall(value)
+            int_val = int(integers[0]) if integers else None
+            if int_val is not None and abs(int_val) > 2147483647:
+                int_val = 0
+            rows.append((doc_id, path, value, int_val, location))
+        return rows
+
     @staticmethod
     def extract_id(arg):
         """
@@ -3558,6 +4274,64 @@ class Doc(object):
             return default
         return "".join(node.itertext("*"))
 
+    @classmethod
+    def resolve_revision_markup(cls, root, level=None):
+        """
+        Resolve revision markup without using the XSL/T filter
+
+        Implements the same rules as the "Revision Markup Filter": the
+        content of an accepted `Insertion` element is kept (without the
+        wrapper) and the content of a rejected `Insertion` is discarded,
+        while the content of an accepted `Deletion` is discarded and
+        the content of a rejected `Deletion` is kept. Markup is accepted
+        if its `RevisionLevel` is allowed by the requested level (see
+        REVISION_MARKUP_LEVELS). Use `check_revision_markup()` to
+        confirm that the two implementations agree for a document.
+
+        Pass:
+          root - parsed document to be resolved (not modified)
+          level - integer (1-3) for what markup to apply/discard
+
+        Return:
+          new tree with the revision markup resolved
+        """
+
+        level = int(level or cls.DEFAULT_REVISION_LEVEL)
+        root = copy.deepcopy(root)
+        for node in list(root.iter(*cls.REVISION_MARKUP_TAGS)):
+            revision_level = node.get("RevisionLevel")
+            highest = cls.REVISION_MARKUP_LEVELS.get(revision_level, 0)
+            if (node.tag == "Insertion") == (level <= highest):
+                cls.__unwrap_node(node)
+            else:
+                cls.__drop_node(node)
+        return root
+
+    @staticmethod
+    def get_schema_generation(cursor):
+        """
+        Identify the current state of the schema documents
+
+        The value changes whenever a schema document is added,
+        modified, or deleted, so it can be used to decide whether
+        something derived from the schemas is stale.
+
+        Pass:
+          cursor - database access
+
+        Return:
+          string combining the count of schema documents and the time
+          of the most recent change to any of them
+        """
+
+        fields = "COUNT(DISTINCT d.id) AS n", "MAX(a.dt) AS dt"
+        query = Query("all_docs d", *fields)
+        query.join("doc_type t", "t.id = d.doc_type")
+        query.join("audit_trail a", "a.document = d.id")
+        query.where("t.name = 'schema'")
+        row = query.execute(cursor).fetchone()
+        return f"{row.n}:{row.dt}"
+
     @classmethod
     def get_schema_xml(cls, name, cursor):
         """
@@ -3658,6 +4432,8 @@ class Doc(object):
         thousands of documents from what we give to the cancer.gov
         web site into what we give to the PDQ data partners.
         We create the transform object once and use it many times.
+        The compiled object comes from the process-wide cache, so
+        loading the same filter more than once is cheap.
 
         Pass:
           session - reference to object representing user's login
@@ -3672,9 +4448,7 @@ class Doc(object):
         doc = cls(session, id=filter_id)
         Resolver.local.docs.append(doc)
         try:
-            filter_xml = doc.get_filter(filter_id).xml
-            parser = cls.Parser()
-            transform = etree.XSLT(etree.fromstring(filter_xml, parser))
+            transform = doc.get_filter(filter_id).transform
         except:
             session.logger.exception("etree.XSLT() failure")
             raise
@@ -3876,25 +4650,30 @@ class Doc(object):
 
         Takes advantage of the fact that we have added unique `cdr-eid`
         attribute values to every element in the document being validated.
+        The map is built lazily, as errors are looked up, and only reads
+        as far into the document as it needs to in order to find the
+        elements on the line of the error being located. As the errors
+        come back from the schema validator in document order, and most
+        documents have few (if any) errors, this usually means we only
+        look at a small part of a large document.
 
         Attribute:
           lines - dictionary of `Doc.LineMap.Line` objects indexed by line #
         """
 
-        def __init__(self, root):
+        def __init__(self, nodes):
             """
-            Walk through the parsed document and build the line map
+            Prepare to build the map from the document's elements
 
             Pass:
-              root - parsed XML document to be mapped
+              nodes - sequence of (source line, element tag, cdr-eid value)
+                      tuples for the document's elements, in document order
             """
 
             self.lines = dict()
-            for node in root.iter("*"):
-                line = self.lines.get(node.sourceline)
-                if not line:
-                    line = self.lines[node.sourceline] = self.Line()
-                line.add_node(node)
+            self.__nodes = iter(nodes)
+            self.__last_line = 0
+            self.__exhausted = False
 
         def get_error_location(self, error):
             """
@@ -3908,6 +4687,19 @@ class Doc(object):
               occurred (or our best guess)
             """
 
+            while not self.__exhausted and self.__last_line <= error.line:
+                node = next(self.__nodes, None)
+                if node is None:
+                    self.__exhausted = True
+                    break
+                line_number, tag, eid = node
+                if line_number is None:
+                    continue
+                line = self.lines.get(line_number)
+                if not line:
+                    line = self.lines[line_number] = self.Line()
+                line.add_node(tag, eid)
+                self.__last_line = max(self.__last_line, line_number)
             line = self.lines.get(error.line)
             return line and line.get_error_location(error) or None
 
@@ -3935,7 +4727,7 @@ class Doc(object):
                 self.tags = dict()
                 self.first = None
 
-            def add_node(self, node):
+            def add_node(self, tag, eid):
                 """
                 Record a node's `cdr-eid` attribute value
 
@@ -3945,13 +4737,14 @@ class Doc(object):
                 ID to the `tags` dictionary.
 
                 Pass:
-                  node - reference to element in the XML document
+                  tag - name of the element
+                  eid - element's `cdr-eid` attribute value
                 """
 
                 if not self.first:
-                    self.first = node.get("cdr-eid")
-                if not self.tags.get(node.tag):
-                    self.tags[node.tag] = node.get("cdr-eid")
+                    self.first = eid
+                if not self.tags.get(tag):
+                    self.tags[tag] = eid
 
             def get_error_location(self, error):
                 """
@@ -4006,6 +4799,73 @@ class Doc(object):
             return "Document checked out to {} ({}) {}".format(*args)
 
 
+    class Metadata:
+        """
+        Snapshot of a document's values from the database
+
+        Attributes:
+          version - integer for the version whose values were fetched
+                    (None for the current working document, or
+                    UNRESOLVED if the version-specific values were
+                    not fetched)
+          found - true if the values for the version were found
+          active_status - 'A', 'I', or 'D' from the `all_docs` table
+          last_version - integer for the most recent version (or None)
+          last_publishable_version - integer for the most recent
+                                     publishable version (or None)
+          last_valid_version - integer for the most recent valid version
+          last_version_date - when the last version was created
+          last_saved - date/time of the latest audit trail entry for
+                       adding or modifying the document
+          doc_type - primary key for the version's document type
+          title - string for the version's title
+          comment - string for the version's comment
+          val_status - validation status for the version
+          val_date - when the version was last validated
+          publishable - 'Y' or 'N' for a numbered version, else None
+        """
+
+        UNRESOLVED = "unresolved"
+        VERSIONED = "doc_type", "title", "comment", "val_status", "val_date"
+        AGGREGATES = (
+            "(SELECT MAX(num) FROM doc_version WHERE id = d.id)"
+            " AS last_version",
+            "(SELECT MAX(num) FROM doc_version WHERE id = d.id"
+            " AND publishable = 'Y') AS last_publishable_version",
+            "(SELECT MAX(num) FROM doc_version WHERE id = d.id"
+            " AND val_status = 'V') AS last_valid_version",
+            "(SELECT MAX(updated_dt) FROM doc_version WHERE id = d.id)"
+            " AS last_version_date",
+            "(SELECT MAX(t.dt) FROM audit_trail t"
+            " JOIN action a ON a.id = t.action WHERE t.document = d.id"
+            " AND a.name IN ('ADD DOCUMENT', 'MODIFY DOCUMENT'))"
+            " AS last_saved",
+        )
+
+        def __init__(self, row, version):
+            """
+            Capture the values from the database
+
+            Pass:
+              row - result set row from `Doc.__fetch_metadata()`
+              version - which version the row represents
+            """
+
+            self.version = version
+            self.active_status = row.active_status
+            self.last_version = row.last_version
+            self.last_publishable_version = row.last_publishable_version
+            self.last_valid_version = row.last_valid_version
+            self.last_version_date = row.last_version_date
+            self.last_saved = row.last_saved
+            self.found = False
+            for name in self.VERSIONED + ("publishable",):
+                setattr(self, name, None)
+            if version != self.UNRESOLVED:
+                self.found = row.found is not None
+                for name in self.VERSIONED + ("publishable",):
+                    setattr(self, name, getattr(row, name))
+
     class Parser(etree.XMLParser):
         """
         Create a custom parser for filtering which can resolve our URIs
@@ -4179,190 +5039,1377 @@ class Doc(object):
             self.fullname = fullname
 
 
-class Local(threading.local):
+class SaveTimer:
     """
-    Thread-specific storage for XSL/T filtering
+    Optional instrumentation for the phases of `Doc.save()`
+
+    When timing is turned on (by setting the CDR_SAVE_TIMING environment
+    variable to "Y", by setting `SaveTimer.ENABLED` to True, or by passing
+    `timing=True` to `Doc.save()`), each save records, for every phase
+    it passes through, the number of calls, the elapsed wall-clock time,
+    and the number of SQL statements (and rows affected) executed through
+    the document's cursor. Phases can be nested (for example, custom rule
+    validation happens inside schema validation, which happens inside
+    "validate"), so the numbers for each phase are inclusive.
+
+    When the save is finished, the timer is attached to the `Doc` object
+    (as its `timing` property), a single JSON line is written to the
+    session's log, and the phase times are added to the per-doctype
+    histograms for the process, which can be fetched by calling `dump()`.
+
+    Class values:
+      ENABLED - default for whether `Doc.save()` is timed
+      BUCKETS - upper bounds (in seconds) for the histogram buckets
+      HISTOGRAMS - phase histograms indexed by doctype name, then phase
+      LOCK - used to make access to the histograms thread-safe
 
-    Attribute:
-      docs - stack of documents, the one currently being processed on top
-             (this is the only way we can get to information we need from
-             the documents within the XSL/T callbacks, as the maintainer
-             of the lxml package didn't seem to understand why anyone would
-             need to have user-specific storage passed on the stack, and
-             I couldn't convince him otherwise; as tempting as the name of
-             the `context` argument to `Resolver.resolve()` might look, we
-             don't own it, and we don't have access to its internals).
+    Attributes:
+      doc - `Doc` object being saved
+      started - value of `time.perf_counter()` when the save began
+      elapsed - total seconds for the save (None until `finish()`)
+      statements - total number of SQL statements executed
+      rows - total number of rows affected by those statements
+      phases - dictionary of `Phase` objects indexed by name
     """
 
-    def __init__(self, **kw):
-        self.docs = []
-        self.__dict__.update(kw)
+    ENABLED = os.environ.get("CDR_SAVE_TIMING", "N").upper() == "Y"
+    BUCKETS = 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0
+    HISTOGRAMS = {}
+    LOCK = threading.Lock()
 
+    def __init__(self, doc):
+        """
+        Start the clock for a document save
 
-class Resolver(etree.Resolver):
-    """
-    Callback support for XSL/T filtering
-    """
+        Pass:
+          doc - `Doc` object being saved
+        """
 
-    # Strings which might represent SQL injection attacks. We reject these.
-    UNSAFE = re.compile(r"insert\s|update\s|delete\s|create\s|alter\s"
-                        r"exec[(\s]|execute[(\s]")
+        self.doc = doc
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self.statements = self.rows = 0
+        self.phases = OrderedDict()
 
-    # Expression for normalizing protocol IDs for eliminating duplicates.
-    ID_KEY_STRIP = re.compile("[^A-Z0-9]+")
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Track the time and SQL for a block of code
 
-    # URL pattern for the Enterprise Vocabulary System.
-    EVS = "https://evsrestapi.nci.nih.gov/evsrestapi/api/v1/ctrp/concept/{}/"
+        Pass:
+          name - string identifying the phase
+        """
 
-    # Thread-specific storage.
-    local = Local()
+        if name not in self.phases:
+            self.phases[name] = self.Phase()
+        phase = self.phases[name]
+        statements, rows = self.statements, self.rows
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.calls += 1
+            phase.seconds += time.perf_counter() - start
+            phase.statements += self.statements - statements
+            phase.rows += self.rows - rows
 
-    def resolve(self, url, pubid, context):
+    def install(self):
+        """
+        Route the document's SQL through a counting wrapper cursor
         """
-        Handle a callback from an XSL/T filter
 
-        Callback requests are received in the form of a URL in the syntax
-        SCHEME:/PARAMETERS, where SCHEME is one of:
-           'cdr' or 'cdrx'
-              request for a document; these two scheme prefixes are
-              synonymous, except that the 'cdrx' scheme just returns
-              an empty result when the URL can't be resolved, whereas
-              the 'cdr' scheme raises an exception (yes, it would have
-              made more sense for the 'x' version to be the one which
-              raises the eXception, but that's not how the original
-              programmer implemented the callback; cdr:/1234 retrieves
-              the current working document for CDR0000001234; see the
-              `__get_doc()` method below for specifics on the syntax
-           'cdrutil'
-              invokes a named custom function; e.g., cdrutil:/date
-              to get the current date and time in XML format; see the
-              `__run_function()` method below for a list of supported
-              callback functions
+        cursor = self.doc.cursor
+        if not isinstance(cursor, self.Cursor):
+            self.doc._cursor = self.Cursor(cursor, self)
+
+    def finish(self, success=True):
+        """
+        Stop the clock, log the results, and update the histograms
 
         Pass:
-          url - string for the callback request
-          pubid - ignored
-          context - opaque information, passed through to the method of the
-                    base class used to package the return value
+          success - False if the save failed
+        """
 
-        Return:
-          result packaged by the base class
+        self.elapsed = time.perf_counter() - self.started
+        cursor = getattr(self.doc, "_cursor", None)
+        if isinstance(cursor, self.Cursor):
+            self.doc._cursor = cursor.cursor
+        try:
+            doctype = self.doc.doctype.name
+        except Exception:
+            doctype = None
+        values = dict(
+            doc=self.doc.id,
+            doctype=doctype,
+            success=success,
+            seconds=round(self.elapsed, 6),
+            statements=self.statements,
+            rows=self.rows,
+            phases=OrderedDict([
+                (name, phase.values) for name, phase in self.phases.items()
+            ]),
+        )
+        self.doc.session.logger.info("save timing %s", json.dumps(values))
+        with self.LOCK:
+            phases = self.HISTOGRAMS.setdefault(doctype or "unknown", {})
+            self.__record(phases, "total", self.elapsed)
+            for name, phase in self.phases.items():
+                self.__record(phases, name, phase.seconds)
+
+    @classmethod
+    def dump(cls, doctype=None):
         """
+        Get a snapshot of the histograms collected by this process
 
-        # Get the document being filtered from the top of the stack
-        self.doc = self.local.docs[-1]
-        self.session = self.doc.session
-        self.cursor = self.session.conn.cursor()
-        self.session.logger.debug("resolve(%r)", url)
+        Pass:
+          doctype - optional name of the document type to report on
 
-        # Remove the escaping imposed on the URL to elude syntax constraints.
-        self.url = url_unquote(url.replace("+", " "))
-        self.url = self.url.replace("@@PLUS@@", "+")
+        Return:
+          dictionary of histogram values indexed by doctype name and phase
+          (each has `count`, `total`, and `max` seconds, and a `buckets`
+          dictionary of counts indexed by upper bound, with "+Inf" for
+          the times too long for any of the other buckets)
+        """
+
+        with cls.LOCK:
+            return {
+                name: {
+                    phase: dict(
+                        count=histogram["count"],
+                        total=round(histogram["total"], 6),
+                        max=round(histogram["max"], 6),
+                        buckets=OrderedDict([
+                            (str(bound), count) for bound, count in
+                            zip(cls.BUCKETS + ("+Inf",), histogram["buckets"])
+                        ]),
+                    )
+                    for phase, histogram in phases.items()
+                }
+                for name, phases in cls.HISTOGRAMS.items()
+                if doctype is None or name == doctype
+            }
 
-        # If a document request slipped through without an ID, we know
-        # we're not going to find the document.
-        if url == "cdrx:/last":
-            return self.resolve_string("<empty/>", context)
+    @classmethod
+    def reset(cls):
+        """
+        Discard the histograms collected so far
+        """
 
-        # Parse the request and route it to the appropriate handler.
-        scheme, parms = self.url.split(":", 1)
-        parms = parms.strip("/")
-        if scheme in ("cdr", "cdrx"):
-            return self.__get_doc(scheme, parms, context)
-        elif scheme == "cdrutil":
-            return self.__run_function(parms, context)
-        raise Exception(f"unsupported url {self.url!r}")
+        with cls.LOCK:
+            cls.HISTOGRAMS.clear()
 
-    def __get_doc(self, scheme, parms, context):
+    # Decorator for the `Doc` methods which make up the save's phases
+    # (defined ahead of `Doc`, which needs it while its class is built).
+    timed = staticmethod(timed)
+
+    @classmethod
+    def __record(cls, phases, name, seconds):
         """
-        Fetch information from another CDR document
+        Add a measurement to a histogram (caller holds the lock)
 
         Pass:
-          scheme - 'cdr' or 'cdrx'
-          parms - string specifying what to retrieve for which document
-          context - opaque information echoed back to the caller
+          phases - histograms for the document type
+          name - string identifying the phase
+          seconds - elapsed time for the phase
+        """
 
-        Return:
-          varies; see logic below
+        histogram = phases.get(name)
+        if histogram is None:
+            histogram = dict(count=0, total=0.0, max=0.0,
+                             buckets=[0] * (len(cls.BUCKETS) + 1))
+            phases[name] = histogram
+        histogram["count"] += 1
+        histogram["total"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+        histogram["buckets"][bisect.bisect_left(cls.BUCKETS, seconds)] += 1
+
+    class Phase:
         """
+        Numbers collected for one phase of a save
 
-        # Prepare for failure.
-        message = f"Unable to resolve uri {parms!r}"
+        Attributes:
+          calls - number of times the phase was entered
+          seconds - total elapsed wall-clock time for the phase
+          statements - number of SQL statements executed
+          rows - number of rows affected by those statements
+        """
 
-        # Documents (usually, but not always, Filters) can be fetched by name.
-        if parms.startswith("name:"):
-            parms = parms[5:]
-            if "/" in parms:
-                title, version = parms.split("/", 1)
-            else:
-                title, version = parms, None
-            doc_id = Doc.id_from_title(title, self.cursor)
-            if not doc_id:
-                if scheme == "cdrx":
-                    return self.resolve_string("<empty/>", context)
-                raise Exception(f"Filter {title!r} not found")
-            doc = Doc(self.session, id=doc_id, version=version)
-            if doc.doctype.name == "Filter":
-                doc_xml = doc.get_filter(doc_id, version=version).xml
-                return self.resolve_string(doc_xml, context)
-            spec = None
+        def __init__(self):
+            self.calls = self.statements = self.rows = 0
+            self.seconds = 0.0
 
-        # Find the requested document by ID
-        elif "/" in parms:
-            doc_id, spec = parms.split("/", 1)
-            if doc_id == "*":
-                doc = self.doc
-            else:
-                if "/" in spec:
-                    version, spec = spec.split("/", 1)
-                elif spec.isdigit() or spec in ("last", "lastp"):
-                    version, spec = spec, None
-                else:
-                    version, spec = None, spec
-                try:
-                    doc = Doc(self.session, id=doc_id, version=version)
-                except:
-                    message = f"Doc({parms}) failure"
-                    self.doc.session.logger.exception(message)
-                    if scheme == "cdrx":
-                        return self.resolve_string("<empty/>", context)
-                    raise Exception(message)
-        else:
-            spec = None
-            try:
-                doc = Doc(self.session, id=parms)
-            except:
-                message = f"Doc({parms}) failure"
-                self.doc.session.logger.exception(message)
-                if scheme == "cdrx":
-                    return self.resolve_string("<empty/>", context)
-                raise Exception(message)
+        @property
+        def values(self):
+            """Dictionary of the phase's numbers for logging"""
 
-        # Return control information about the doc if requested.
-        if spec == "CdrCtl":
-            element = doc.legacy_doc_control(filtering=True)
-            return self.__package_result(element, context)
+            return dict(
+                calls=self.calls,
+                seconds=round(self.seconds, 6),
+                statements=self.statements,
+                rows=self.rows,
+            )
 
-        # Return the document's title if requested.
-        elif spec == "DocTitle":
-            element = etree.Element("CdrDocTitle")
-            element.text = doc.title
-            return self.__package_result(element, context)
+    class Cursor:
+        """
+        Wrapper for a database cursor which counts SQL statements
 
-        # Guard against unsupported requests.
-        elif spec:
-            raise Exception(message)
+        Everything other than `execute()` and `executemany()` is handed
+        off to the wrapped cursor. For `executemany()` the number of
+        parameter sets is counted as the number of rows; otherwise the
+        cursor's `rowcount` is used when the driver provides one.
+        """
 
-        # Wrap up the document XML and return it.
-        try:
-            return self.resolve_string(doc.xml, context)
-        except:
-            msg = "resolve_string() [context=%r, scheme=%r]"
-            self.doc.session.logger.exception(msg, context, scheme)
+        def __init__(self, cursor, timer):
+            object.__setattr__(self, "cursor", cursor)
+            object.__setattr__(self, "timer", timer)
+
+        def execute(self, sql, *args):
+            self.cursor.execute(sql, *args)
+            self.timer.statements += 1
+            rowcount = getattr(self.cursor, "rowcount", -1)
+            if isinstance(rowcount, int) and rowcount > 0:
+                self.timer.rows += rowcount
+            return self
+
+        def executemany(self, sql, params):
+            params = list(params)
+            self.cursor.executemany(sql, params)
+            self.timer.statements += 1
+            self.timer.rows += len(params)
+            return self
+
+        def __getattr__(self, name):
+            return getattr(self.cursor, name)
+
+        def __setattr__(self, name, value):
+            setattr(self.cursor, name, value)
+
+        def __iter__(self):
+            return iter(self.cursor)
+
+
+class IndexPlan:
+    """
+    Compiled rules for which parts of a document type get indexed
+
+    The `query_term_def` paths for a document type are compiled into
+    a trie of element tags, so that the indexing code can walk the
+    document's tree without building and looking up path strings for
+    every element and attribute, and can skip entire subtrees when no
+    rule could apply to anything in them. Relative paths (for example,
+    "//@cdr:ref") match any element (or attribute) with that name, so
+    subtrees can only be skipped for document types which have no such
+    rules. As with the original path string comparisons, relative paths
+    with more than one step never match anything.
+
+    The plans are cached for the process, and are rebuilt when the
+    `query_term_def` table changes (see `get_generation()`) or when
+    `invalidate()` is called (by `QueryTermDef.add()` and `delete()`).
+
+    Class values:
+      PLANS - cache of plans, indexed by tier name and doctype name
+      LOCK - used to make access to the cache thread-safe
+
+    Attributes:
+      doctype - string for the name of the document type
+      generation - value of `get_generation()` when the plan was built
+      paths - set of `query_term_def` path strings used for the plan
+      root - top of the trie, whose children are the plan's root elements
+      wild_tags - set of tags for elements indexed wherever they appear
+      wild_attrs - set of (prefixed) names for attributes indexed on
+                   any element
+      prunable - True if subtrees with no absolute rules can be skipped
+    """
+
+    PLANS = {}
+    LOCK = threading.Lock()
+
+    def __init__(self, doctype, paths, generation=None):
+        """
+        Compile the rules for this document type
+
+        Pass:
+          doctype - string for the name of the document type
+          paths - sequence of `query_term_def` path strings
+          generation - optional value from `get_generation()`
+        """
+
+        self.doctype = doctype
+        self.generation = generation
+        self.paths = set(paths)
+        self.root = self.Step()
+        self.wild_tags = set()
+        self.wild_attrs = set()
+        for path in self.paths:
+            if path.startswith("//"):
+                name = path[2:]
+                if name.startswith("@"):
+                    self.wild_attrs.add(name[1:])
+                else:
+                    self.wild_tags.add(name)
+            elif path.startswith("/"):
+                steps = path[1:].split("/")
+                attribute = None
+                if steps[-1].startswith("@"):
+                    attribute = steps.pop()[1:]
+                step = self.root
+                for tag in steps:
+                    if tag not in step.children:
+                        step.children[tag] = self.Step()
+                    step = step.children[tag]
+                if attribute:
+                    step.attributes.add(attribute)
+                else:
+                    step.indexed = True
+        self.prunable = not self.wild_tags and not self.wild_attrs
+
+    class Step:
+        """
+        Node in the plan's trie, for an element reached by a specific path
+
+        Attributes:
+          children - dictionary of `Step` objects indexed by child tag
+          indexed - True if the element's text content is indexed
+          attributes - set of prefixed names of the indexed attributes
+        """
+
+        def __init__(self):
+            self.children = {}
+            self.indexed = False
+            self.attributes = set()
+
+    @classmethod
+    def get(cls, session, doctype, cursor=None):
+        """
+        Find or build the indexing plan for a document type
+
+        Pass:
+          session - reference to object representing the current login
+          doctype - string for the name of the document type
+          cursor - optional cursor for the database queries (by default
+                   one is created from the session's connection)
+
+        Return:
+          `IndexPlan` object
+        """
+
+        if cursor is None:
+            cursor = session.conn.cursor()
+            try:
+                return cls.get(session, doctype, cursor)
+            finally:
+                cursor.close()
+        generation = cls.get_generation(cursor)
+        key = session.tier.name, doctype
+        with cls.LOCK:
+            plan = cls.PLANS.get(key)
+            if plan is not None and plan.generation == generation:
+                return plan
+        absolute_path = f"path LIKE '/{doctype}/%'"
+        relative_path = "path LIKE '//%'"
+        query = Query("query_term_def", "path")
+        query.where(query.Or(absolute_path, relative_path))
+        rows = query.execute(cursor).fetchall()
+        plan = cls(doctype, [row.path for row in rows], generation)
+        with cls.LOCK:
+            cls.PLANS[key] = plan
+        session.logger.debug("compiled %d index paths for %s",
+                             len(plan.paths), doctype)
+        return plan
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drop all of the cached plans
+        """
+
+        with cls.LOCK:
+            cls.PLANS = {}
+
+    @staticmethod
+    def get_generation(cursor):
+        """
+        Get a value which changes whenever the `query_term_def` table does
+
+        Pass:
+          cursor - used for the database query
+
+        Return:
+          string combining the row count and a checksum of the paths
+        """
+
+        fields = "COUNT(*) AS n", "CHECKSUM_AGG(CHECKSUM(path)) AS checksum"
+        query = Query("query_term_def", *fields)
+        row = query.execute(cursor).fetchone()
+        return f"{row.n}:{row.checksum}"
+
+
+class IndexDigests:
+    """
+    Record of what was last indexed for each document
+
+    For each document and query term table we remember a digest of
+    what the index rows were built from (the document's XML, its type,
+    the revision level, the generation of the indexing rules, and for
+    documents with revision markup, the rules used to resolve it), a
+    checksum of the rows we wrote (computed by the database server),
+    and any warnings raised while collecting the values. If both the
+    digest and the checksum of the rows currently in the table match,
+    reindexing the document would write the same rows again, so we
+    can skip it. Checking the rows' checksum protects us from changes
+    made to the table by other means (or rolled back after we wrote
+    them).
+
+    The records are stored in a SQLite database on the local disk.
+    Its location is controlled by the CDR_INDEX_DIGESTS environment
+    variable (set it to "none" to turn the optimization off), falling
+    back on a file in the Cache directory under the CDR base directory.
+
+    Attributes:
+      path - location of the SQLite database file
+    """
+
+    FILENAME = "index-digests.db"
+    STORES = {}
+    LOCK = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Make sure the database is ready for use
+
+        Pass:
+          path - location of the SQLite database file
+        """
+
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__execute("CREATE TABLE IF NOT EXISTS index_digest ("
+                       "tier TEXT, doc_id INTEGER, tbl TEXT, digest TEXT, "
+                       "checksum TEXT, warnings TEXT, "
+                       "PRIMARY KEY (tier, doc_id, tbl))")
+
+    def check(self, session, cursor, doc_id, table, digest):
+        """
+        Find out whether a document's index rows are already current
+
+        Pass:
+          session - reference to object representing the current login
+          cursor - for getting the checksum of the document's rows
+          doc_id - integer for the document's ID
+          table - "query_term" or "query_term_pub"
+          digest - value returned by `make_digest()`
+
+        Return:
+          sequence of warning messages raised the last time the values
+          were collected if the rows are current; otherwise None
+        """
+
+        query = ("SELECT digest, checksum, warnings FROM index_digest "
+                 "WHERE tier = ? AND doc_id = ? AND tbl = ?")
+        rows = self.__execute(query, (session.tier.name, doc_id, table))
+        if not rows or rows[0][0] != digest:
+            return None
+        if rows[0][1] != self.get_checksum(cursor, doc_id, table):
+            return None
+        return json.loads(rows[0][2] or "[]")
+
+    def record(self, session, cursor, doc_id, table, digest, warnings=None):
+        """
+        Remember what we just indexed for a document
+
+        Pass:
+          session - reference to object representing the current login
+          cursor - for getting the checksum of the document's rows
+          doc_id - integer for the document's ID
+          table - "query_term" or "query_term_pub"
+          digest - value returned by `make_digest()`
+          warnings - optional sequence of messages raised while collecting
+                     the document's index values
+        """
+
+        checksum = self.get_checksum(cursor, doc_id, table)
+        values = (session.tier.name, doc_id, table, digest, checksum,
+                  json.dumps(warnings or []))
+        self.__execute("INSERT OR REPLACE INTO index_digest "
+                       "(tier, doc_id, tbl, digest, checksum, warnings) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", values)
+
+    def __execute(self, sql, values=()):
+        """
+        Run a statement against the SQLite database and commit it
+
+        Pass:
+          sql - string for the SQL statement
+          values - optional sequence of values for the placeholders
+
+        Return:
+          sequence of result rows (empty for statements with no results)
+        """
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            rows = conn.execute(sql, values).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    @classmethod
+    def get_store(cls, session):
+        """
+        Get the process-wide digest store for the session's tier
+
+        Failure to open the database is logged (once) and disables
+        the optimization.
+
+        Pass:
+          session - reference to object representing the current login
+
+        Return:
+          `IndexDigests` object, or None if the optimization is off
+        """
+
+        path = os.environ.get("CDR_INDEX_DIGESTS")
+        if not path:
+            path = f"{session.tier.basedir}/Cache/{cls.FILENAME}"
+        elif path.lower() == "none":
+            return None
+        with cls.LOCK:
+            if path not in cls.STORES:
+                try:
+                    cls.STORES[path] = cls(path)
+                except Exception:
+                    session.logger.exception("can't open %s", path)
+                    cls.STORES[path] = None
+            return cls.STORES[path]
+
+    @staticmethod
+    def get_markup_generation(doc):
+        """
+        Identify the rules used to resolve a document's revision markup
+
+        Documents without revision markup aren't affected by those
+        rules, so the database is only queried for documents which
+        have some, and only when the XSL/T filter is being used.
+
+        Pass:
+          doc - `Doc` object being indexed
+
+        Return:
+          None for a document with no revision markup; otherwise a
+          string for the implementation in use (for the XSL/T filter,
+          when the "Revision Markup Filter" was last changed)
+        """
+
+        if next(doc.root.iter(*Doc.REVISION_MARKUP_TAGS), None) is None:
+            return None
+        if Doc.NATIVE_REVISION_MARKUP:
+            return "native"
+        query = Query("audit_trail a", "MAX(a.dt) AS dt")
+        query.join("document d", "d.id = a.document")
+        query.where("d.title = 'Revision Markup Filter'")
+        return f"filter|{query.execute(doc.cursor).fetchone().dt}"
+
+    @staticmethod
+    def get_checksum(cursor, doc_id, table):
+        """
+        Ask the database server for a checksum of a document's index rows
+
+        Pass:
+          cursor - used for the database query
+          doc_id - integer for the document's ID
+          table - "query_term" or "query_term_pub"
+
+        Return:
+          string combining the row count and the checksum
+        """
+
+        checksum = "CHECKSUM_AGG(CHECKSUM(path, node_loc, value))"
+        query = Query(table, "COUNT(*) AS n", f"{checksum} AS checksum")
+        query.where(query.Condition("doc_id", doc_id))
+        row = query.execute(cursor).fetchone()
+        return f"{row.n}:{row.checksum}"
+
+    @staticmethod
+    def make_digest(xml, *values):
+        """
+        Create a digest of what a document's index rows are built from
+
+        Pass:
+          xml - serialized document
+          values - other values affecting the indexing (e.g., the
+                   doctype name, the revision level, and the
+                   `IndexPlan` generation)
+
+        Return:
+          hex string for the SHA-1 digest
+        """
+
+        digest = hashlib.sha1(json.dumps(values, default=str).encode("utf-8"))
+        digest.update(xml.encode("utf-8"))
+        return digest.hexdigest()
+
+
+class ValidationMemo:
+    """
+    Remembered results of document validations
+
+    Documents are often validated again without any change which
+    could affect the outcome (for example, a save followed by a
+    publish-time validation, or a batch validation after an unrelated
+    schema edit). For each validation we remember a digest of what the
+    results depend on (the resolved XML, the validation options, the
+    generation of the schemas, the custom rule template and the link
+    type definitions, and the state of the documents the links point
+    to), together with the validation status and the errors which
+    were found. When `Doc.validate()` is invoked and the digest
+    matches, the stored results are used instead of validating the
+    document again. If the validation would have updated the linking
+    tables, we also make sure those tables still hold what we stored
+    the last time (using a checksum computed by the database server).
+
+    Computing the digest costs several queries, so a validation which
+    misses the memo is slower than one which doesn't use it at all.
+    The memo is therefore only used when `memo=True` is passed to
+    `Doc.validate()`, which is done by the batch callers (`cdr.valPair()`
+    as used by global change jobs) where most documents are validated
+    again unchanged.
+
+    The digest does not cover what the custom validation rules pull in
+    through filter callbacks: the `cdrutil:` functions (for example,
+    `sql-query`, `valid-zip`, and `get-pv-num`) and `document()`
+    requests for documents other than the link targets (whose state is
+    captured by `get_target_state()`). Use `invalidate()` after changes
+    to data those rules depend on.
+
+    The records are stored in a SQLite database on the local disk.
+    Its location is controlled by the CDR_VALIDATION_MEMO environment
+    variable (set it to "none" to turn the optimization off), falling
+    back on a file in the Cache directory under the CDR base directory.
+    Use `invalidate()` to discard the stored results for a document
+    type. Records not used for MAX_AGE days are dropped.
+
+    Attributes:
+      path - location of the SQLite database file
+    """
+
+    FILENAME = "validation-memo.db"
+    MAX_AGE = 30
+    VERSION = 1
+    STORES = {}
+    LOCK = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Make sure the database is ready for use
+
+        Pass:
+          path - location of the SQLite database file
+        """
+
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__execute("CREATE TABLE IF NOT EXISTS validation_memo ("
+                       "tier TEXT, digest TEXT, doc_id INTEGER, "
+                       "doctype TEXT, val_status TEXT, errors TEXT, "
+                       "links TEXT, used TEXT, "
+                       "PRIMARY KEY (tier, digest))")
+        cutoff = datetime.datetime.now() - datetime.timedelta(self.MAX_AGE)
+        self.__execute("DELETE FROM validation_memo WHERE used < ?",
+                       (cutoff.isoformat(),))
+
+    def check(self, doc, digest, types, store):
+        """
+        Put the remembered results of a validation into the document
+
+        Pass:
+          doc - `Doc` object being validated
+          digest - value returned by `make_digest()`
+          types - sequence of validation types requested
+          store - "always", "never", or "valid" (see `Doc.validate()`)
+
+        Return:
+          True if the results were found and applied; otherwise False
+        """
+
+        query = ("SELECT val_status, errors, links FROM validation_memo "
+                 "WHERE tier = ? AND digest = ?")
+        rows = self.__execute(query, (doc.session.tier.name, digest))
+        if not rows:
+            return False
+        val_status, errors, links = rows[0]
+        errors = [doc.Error(*error[:2], type=error[2], level=error[3])
+                  for error in json.loads(errors)]
+        if doc.id and "links" in types:
+            if store == "always" or store == "valid" and not errors:
+                if links != self.get_links_checksum(doc.cursor, doc.id):
+                    return False
+        doc._errors = errors
+        doc._val_status = val_status
+        self.__execute("UPDATE validation_memo SET used = ? "
+                       "WHERE tier = ? AND digest = ?",
+                       (datetime.datetime.now().isoformat(),
+                        doc.session.tier.name, digest))
+        return True
+
+    def record(self, doc, digest, links_stored=False):
+        """
+        Remember the results of a document's validation
+
+        Pass:
+          doc - `Doc` object which has just been validated
+          digest - value returned by `make_digest()`
+          links_stored - True if the validation updated the linking tables
+        """
+
+        links = None
+        if links_stored:
+            links = self.get_links_checksum(doc.cursor, doc.id)
+        errors = [(error.message, error.location, error.type, error.level)
+                  for error in doc.errors]
+        values = (doc.session.tier.name, digest, doc.id, doc.doctype.name,
+                  doc.val_status, json.dumps(errors), links,
+                  datetime.datetime.now().isoformat())
+        self.__execute("INSERT OR REPLACE INTO validation_memo "
+                       "(tier, digest, doc_id, doctype, val_status, errors, "
+                       "links, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       values)
+
+    def __execute(self, sql, values=()):
+        """
+        Run a statement against the SQLite database and commit it
+
+        Pass:
+          sql - string for the SQL statement
+          values - optional sequence of values for the placeholders
+
+        Return:
+          sequence of result rows (empty for statements with no results)
+        """
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            rows = conn.execute(sql, values).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    @classmethod
+    def get_store(cls, session):
+        """
+        Get the process-wide validation memo for the session's tier
+
+        Failure to open the database is logged (once) and disables
+        the optimization.
+
+        Pass:
+          session - reference to object representing the current login
+
+        Return:
+          `ValidationMemo` object, or None if the optimization is off
+        """
+
+        path = os.environ.get("CDR_VALIDATION_MEMO")
+        if not path:
+            path = f"{session.tier.basedir}/Cache/{cls.FILENAME}"
+        elif path.lower() == "none":
+            return None
+        with cls.LOCK:
+            if path not in cls.STORES:
+                try:
+                    cls.STORES[path] = cls(path)
+                except Exception:
+                    session.logger.exception("can't open %s", path)
+                    cls.STORES[path] = None
+            return cls.STORES[path]
+
+    @classmethod
+    def invalidate(cls, session, doctype=None):
+        """
+        Discard remembered validation results
+
+        Pass:
+          session - reference to object representing the current login
+          doctype - optional name of the document type whose results
+                    should be dropped (default is all document types)
+        """
+
+        memo = cls.get_store(session)
+        if memo is not None:
+            delete = "DELETE FROM validation_memo WHERE tier = ?"
+            values = [session.tier.name]
+            if doctype:
+                delete += " AND doctype = ?"
+                values.append(doctype)
+            memo.__execute(delete, values)
+
+    @staticmethod
+    def get_generation(cursor):
+        """
+        Identify the current state of the rules used for validation
+
+        Pass:
+          cursor - database access
+
+        Return:
+          string combining the schema generation, the last change to
+          the custom rule template, and a checksum of the link type
+          definitions
+        """
+
+        query = Query("audit_trail a", "MAX(a.dt) AS dt")
+        query.join("document d", "d.id = a.document")
+        query.where("d.title = 'Validation Template'")
+        template = query.execute(cursor).fetchone().dt
+        links = []
+        tables = (
+            ("link_type", "id, chk_type"),
+            ("link_xml", "link_id, doc_type, element"),
+            ("link_target", "source_link_type, target_doc_type"),
+            ("link_properties",
+             "link_id, property_id, CAST(value AS NVARCHAR(MAX))"),
+        )
+        for table, columns in tables:
+            checksum = f"CHECKSUM_AGG(CHECKSUM({columns})) AS checksum"
+            query = Query(table, "COUNT(*) AS n", checksum)
+            row = query.execute(cursor).fetchone()
+            links.append(f"{row.n}:{row.checksum}")
+        generation = Doc.get_schema_generation(cursor)
+        return f"{generation}|{template}|{','.join(links)}"
+
+    @staticmethod
+    def get_links_checksum(cursor, doc_id):
+        """
+        Ask the database server for a checksum of a document's link rows
+
+        Pass:
+          cursor - used for the database query
+          doc_id - integer for the document's ID
+
+        Return:
+          string combining the row counts and checksums for the
+          `link_net` and `link_fragment` tables
+        """
+
+        columns = "link_type, source_elem, target_doc, target_frag, url"
+        checksum = f"CHECKSUM_AGG(CHECKSUM({columns})) AS checksum"
+        query = Query("link_net", "COUNT(*) AS n", checksum)
+        query.where(query.Condition("source_doc", doc_id))
+        net = query.execute(cursor).fetchone()
+        checksum = "CHECKSUM_AGG(CHECKSUM(fragment)) AS checksum"
+        query = Query("link_fragment", "COUNT(*) AS n", checksum)
+        query.where(query.Condition("doc_id", doc_id))
+        frag = query.execute(cursor).fetchone()
+        return f"{net.n}:{net.checksum}|{frag.n}:{frag.checksum}"
+
+    @staticmethod
+    def get_target_state(cursor, ids):
+        """
+        Identify the current state of the documents a document links to
+
+        Covers everything link validation looks at for the targets:
+        their types and status, their publishable versions, and their
+        indexed values (including the fragment IDs).
+
+        Pass:
+          cursor - database access
+          ids - sequence of integers for the link targets' document IDs
+
+        Return:
+          string combining row counts and checksums for the targets
+        """
+
+        ids = sorted(set(ids))
+        tables = (
+            ("all_docs", "id", "id, doc_type, active_status"),
+            ("all_doc_versions", "id", "id, num, publishable"),
+            ("query_term", "doc_id", "doc_id, path, node_loc, value"),
+            ("query_term_pub", "doc_id", "doc_id, path, node_loc, value"),
+        )
+        state = []
+        chunk_size = Doc.BULK_LOAD_CHUNK_SIZE
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start+chunk_size]
+            for table, key, columns in tables:
+                checksum = f"CHECKSUM_AGG(CHECKSUM({columns})) AS checksum"
+                query = Query(table, "COUNT(*) AS n", checksum)
+                query.where(query.Condition(key, chunk, "IN"))
+                row = query.execute(cursor).fetchone()
+                state.append(f"{row.n}:{row.checksum}")
+        return ",".join(state)
+
+    @classmethod
+    def make_digest(cls, doc, xml, resolved, **opts):
+        """
+        Create a digest of what a document's validation results depend on
+
+        Pass:
+          doc - `Doc` object being validated
+          xml - serialized document with revision markup resolved
+          resolved - parsed document with revision markup resolved
+          opts - validation options (see `Doc.validate()`)
+
+        Return:
+          hex string for the SHA-1 digest
+        """
+
+        types = sorted(opts.get("types", ["schema", "links"]))
+        level = int(opts.get("level") or doc.revision_level)
+        values = [
+            cls.VERSION,
+            doc.id,
+            doc.doctype.name,
+            types,
+            level,
+            bool(opts.get("locators")),
+            cls.get_generation(doc.cursor),
+        ]
+        if "links" in types:
+            ids = []
+            names = [f"{{{Doc.NS}}}{name}" for name in ("ref", "href")]
+            for node in resolved.iter("*"):
+                for name in names:
+                    value = node.get(name)
+                    if value:
+                        try:
+                            ids.append(Doc.extract_id(value))
+                        except Exception:
+                            pass
+            if doc.id:
+                ids.append(doc.id)
+            values.append(cls.get_target_state(doc.cursor, ids))
+        digest = hashlib.sha1(json.dumps(values, default=str).encode("utf-8"))
+        digest.update(xml.encode("utf-8"))
+        return digest.hexdigest()
+
+
+class Local(threading.local):
+    """
+    Thread-specific storage for XSL/T filtering
+
+    Attribute:
+      docs - stack of documents, the one currently being processed on top
+             (this is the only way we can get to information we need from
+             the documents within the XSL/T callbacks, as the maintainer
+             of the lxml package didn't seem to understand why anyone would
+             need to have user-specific storage passed on the stack, and
+             I couldn't convince him otherwise; as tempting as the name of
+             the `context` argument to `Resolver.resolve()` might look, we
+             don't own it, and we don't have access to its internals).
+    """
+
+    def __init__(self, **kw):
+        self.docs = []
+        self.callback_cache = None
+        self.zipcodes = None
+        self.__dict__.update(kw)
+
+
+class CallbackCache:
+    """
+    Bounded cache of results for XSL/T filter callbacks
+
+    Used for job-scoped caching of the payloads returned by the
+    `Resolver` (see `Resolver.cache_callbacks()`). The values stored
+    are the bytes handed to `resolve_string()`, so a hit costs nothing
+    but the dictionary lookup. Entries can be given a time-to-live,
+    after which they are fetched again.
+
+    Attributes:
+      max_size - number of payloads held before the least recently
+                 used one is dropped
+      cutoff - optional date/time cutoff for the job, made part of
+               each key
+      hits - number of requests satisfied from the cache
+      misses - number of requests which went to the database
+    """
+
+    MAX_SIZE = 5000
+
+    def __init__(self, max_size=None, cutoff=None):
+        """
+        Set up an empty cache
+
+        Pass:
+          max_size - optional override for the default size limit
+          cutoff - optional date/time cutoff for the job
+        """
+
+        self.max_size = int(max_size or self.MAX_SIZE)
+        self.cutoff = str(cutoff) if cutoff else None
+        self.hits = self.misses = 0
+        self.__payloads = OrderedDict()
+
+    def __len__(self):
+        """Number of payloads currently held."""
+        return len(self.__payloads)
+
+    @property
+    def hit_rate(self):
+        """Percentage of requests satisfied from the cache."""
+        requests = self.hits + self.misses
+        return 100.0 * self.hits / requests if requests else 0.0
+
+    @property
+    def stats(self):
+        """
+        Dictionary of cache statistics (for logging)
+        """
+
+        return dict(
+            size=len(self),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=round(self.hit_rate, 1),
+        )
+
+    def get(self, key):
+        """
+        Look up a cached payload
+
+        Pass:
+          key - tuple returned by `make_key()`
+
+        Return:
+          bytes for the cached payload, or None
+        """
+
+        entry = self.__payloads.get(key)
+        if entry is not None:
+            payload, expires = entry
+            if expires is None or expires > time.time():
+                self.__payloads.move_to_end(key)
+                self.hits += 1
+                return payload
+            del self.__payloads[key]
+        self.misses += 1
+        return None
+
+    def make_key(self, *values):
+        """
+        Assemble a key which includes the job's cutoff
+
+        Pass:
+          values - normalized values identifying the request
+
+        Return:
+          tuple for indexing the cache
+        """
+
+        return (self.cutoff,) + values
+
+    def put(self, key, payload, ttl=None):
+        """
+        Remember a payload, evicting the oldest if we're full
+
+        Pass:
+          key - tuple returned by `make_key()`
+          payload - bytes to be handed to `resolve_string()`
+          ttl - optional number of seconds the payload stays good
+                (if omitted, it lasts as long as the cache does)
+        """
+
+        expires = time.time() + ttl if ttl else None
+        self.__payloads[key] = payload, expires
+        self.__payloads.move_to_end(key)
+        while len(self.__payloads) > self.max_size:
+            self.__payloads.popitem(last=False)
+
+
+class Resolver(etree.Resolver):
+    """
+    Callback support for XSL/T filtering
+    """
+
+    # Strings which might represent SQL injection attacks. We reject these.
+    UNSAFE = re.compile(r"insert\s|update\s|delete\s|create\s|alter\s"
+                        r"exec[(\s]|execute[(\s]")
+
+    # Expression for normalizing protocol IDs for eliminating duplicates.
+    ID_KEY_STRIP = re.compile("[^A-Z0-9]+")
+
+    # URL pattern for the Enterprise Vocabulary System.
+    EVS = "https://evsrestapi.nci.nih.gov/evsrestapi/api/v1/ctrp/concept/{}/"
+
+    # Thread-specific storage.
+    local = Local()
+
+    # Custom functions whose results can be cached while a job is running,
+    # with the number of seconds each result stays good (None means for
+    # the life of the job). A function opts in by being listed here.
+    MEMOIZE = {
+        "denormalizeterm": 1800,
+        "get-pv-num": 300,
+        "sql-query": 600,
+        "tier": None,
+        "valid-zip": None,
+    }
+
+    @classmethod
+    def cache_callbacks(cls, max_size=None, cutoff=None):
+        """
+        Start caching the results of filter callbacks for this thread
+
+        Intended for publishing jobs, during which the same Term,
+        Organization, and Glossary documents are pulled in by the
+        filters thousands of times, and the same custom functions
+        (see `MEMOIZE`) are invoked with the same arguments over and
+        over. The cache lives until `stop_caching_callbacks()` is
+        called, so it shouldn't be used by long-running processes
+        which need to see edits made while they run. Opened by the
+        publishing control thread (see `cdrpub.Control`) and by the
+        batch job runner in `CdrLongReports`; export worker scripts
+        should do the same around each batch of documents, closing
+        the cache in a `finally` block.
+
+        Pass:
+          max_size - optional limit on the number of cached payloads
+          cutoff - optional date/time cutoff for the job
+
+        Return:
+          `CallbackCache` object
+        """
+
+        cls.local.callback_cache = CallbackCache(max_size, cutoff)
+        cls.local.zipcodes = None
+        return cls.local.callback_cache
+
+    @classmethod
+    def stop_caching_callbacks(cls, logger=None):
+        """
+        Discard this thread's filter callback cache
+
+        Pass:
+          logger - optional object for recording the cache statistics
+
+        Return:
+          `CallbackCache` object which was in use (or None)
+        """
+
+        cache = cls.local.callback_cache
+        cls.local.callback_cache = cls.local.zipcodes = None
+        if cache is not None and logger is not None:
+            logger.info("filter callback cache: %s", cache.stats)
+        return cache
+
+    def resolve_string(self, string, context, **opts):
+        """
+        Remember the last payload we wrapped, so it can be cached
+
+        See `__run_function()`.
+        """
+
+        self.__payload = string
+        return etree.Resolver.resolve_string(self, string, context, **opts)
+
+    def resolve(self, url, pubid, context):
+        """
+        Handle a callback from an XSL/T filter
+
+        Callback requests are received in the form of a URL in the syntax
+        SCHEME:/PARAMETERS, where SCHEME is one of:
+           'cdr' or 'cdrx'
+              request for a document; these two scheme prefixes are
+              synonymous, except that the 'cdrx' scheme just returns
+              an empty result when the URL can't be resolved, whereas
+              the 'cdr' scheme raises an exception (yes, it would have
+              made more sense for the 'x' version to be the one which
+              raises the eXception, but that's not how the original
+              programmer implemented the callback; cdr:/1234 retrieves
+              the current working document for CDR0000001234; see the
+              `__get_doc()` method below for specifics on the syntax
+           'cdrutil'
+              invokes a named custom function; e.g., cdrutil:/date
+              to get the current date and time in XML format; see the
+              `__run_function()` method below for a list of supported
+              callback functions
+
+        Pass:
+          url - string for the callback request
+          pubid - ignored
+          context - opaque information, passed through to the method of the
+                    base class used to package the return value
+
+        Return:
+          result packaged by the base class
+        """
+
+        # Get the document being filtered from the top of the stack
+        self.doc = self.local.docs[-1]
+        self.session = self.doc.session
+        self.cursor = self.session.conn.cursor()
+        self.session.logger.debug("resolve(%r)", url)
+
+        # Remove the escaping imposed on the URL to elude syntax constraints.
+        self.url = url_unquote(url.replace("+", " "))
+        self.url = self.url.replace("@@PLUS@@", "+")
+
+        # If a document request slipped through without an ID, we know
+        # we're not going to find the document.
+        if url == "cdrx:/last":
+            return self.resolve_string("<empty/>", context)
+
+        # Parse the request and route it to the appropriate handler.
+        scheme, parms = self.url.split(":", 1)
+        parms = parms.strip("/")
+        if scheme in ("cdr", "cdrx"):
+            return self.__get_doc(scheme, parms, context)
+        elif scheme == "cdrutil":
+            return self.__run_function(parms, context)
+        raise Exception(f"unsupported url {self.url!r}")
+
+    def __get_doc(self, scheme, parms, context):
+        """
+        Fetch information from another CDR document
+
+        Pass:
+          scheme - 'cdr' or 'cdrx'
+          parms - string specifying what to retrieve for which document
+          context - opaque information echoed back to the caller
+
+        Return:
+          varies; see logic below
+        """
+
+        # Prepare for failure.
+        message = f"Unable to resolve uri {parms!r}"
+
+        # See if we've already resolved this request during the job.
+        key = self.__make_doc_key(scheme, parms)
+        if key is not None:
+            payload = self.local.callback_cache.get(key)
+            if payload is not None:
+                return self.resolve_string(payload, context)
+
+        # Documents (usually, but not always, Filters) can be fetched by name.
+        if parms.startswith("name:"):
+            parms = parms[5:]
+            if "/" in parms:
+                title, version = parms.split("/", 1)
+            else:
+                title, version = parms, None
+            doc_id = Doc.id_from_title(title, self.cursor)
+            if not doc_id:
+                if scheme == "cdrx":
+                    return self.__wrap_doc_payload(key, b"<empty/>", context)
+                raise Exception(f"Filter {title!r} not found")
+            doc = Doc(self.session, id=doc_id, version=version)
+            if doc.doctype.name == "Filter":
+                doc_xml = doc.get_filter(doc_id, version=version).xml
+                return self.__wrap_doc_payload(key, doc_xml, context)
+            spec = None
+
+        # Find the requested document by ID
+        elif "/" in parms:
+            doc_id, spec = parms.split("/", 1)
+            if doc_id == "*":
+                doc = self.doc
+            else:
+                if "/" in spec:
+                    version, spec = spec.split("/", 1)
+                elif spec.isdigit() or spec in ("last", "lastp"):
+                    version, spec = spec, None
+                else:
+                    version, spec = None, spec
+                try:
+                    doc = Doc(self.session, id=doc_id, version=version)
+                except:
+                    message = f"Doc({parms}) failure"
+                    self.doc.session.logger.exception(message)
+                    if scheme == "cdrx":
+                        return self.resolve_string("<empty/>", context)
+                    raise Exception(message)
+        else:
+            spec = None
+            try:
+                doc = Doc(self.session, id=parms)
+            except:
+                message = f"Doc({parms}) failure"
+                self.doc.session.logger.exception(message)
+                if scheme == "cdrx":
+                    return self.resolve_string("<empty/>", context)
+                raise Exception(message)
+
+        # Return control information about the doc if requested.
+        if spec == "CdrCtl":
+            element = doc.legacy_doc_control(filtering=True)
+            payload = etree.tostring(element, encoding="utf-8")
+            return self.__wrap_doc_payload(key, payload, context)
+
+        # Return the document's title if requested.
+        elif spec == "DocTitle":
+            element = etree.Element("CdrDocTitle")
+            element.text = doc.title
+            payload = etree.tostring(element, encoding="utf-8")
+            return self.__wrap_doc_payload(key, payload, context)
+
+        # Guard against unsupported requests.
+        elif spec:
+            raise Exception(message)
+
+        # Wrap up the document XML and return it.
+        try:
+            return self.__wrap_doc_payload(key, doc.xml, context)
+        except:
+            msg = "resolve_string() [context=%r, scheme=%r]"
+            self.doc.session.logger.exception(msg, context, scheme)
             if scheme == "cdrx":
                 return self.resolve_string("<empty/>", context)
             raise Exception(message)
 
+    def __get_zipcodes(self):
+        """
+        Load the entire `zipcode` table for the job's ZIP code lookups
+
+        Return:
+          dictionary of `zip` column values, indexed by themselves
+          (so that the lookup works whether the column is numeric
+          or a string)
+        """
+
+        if self.local.zipcodes is None:
+            query = Query("zipcode", "zip").unique()
+            rows = query.execute(self.cursor).fetchall()
+            self.local.zipcodes = dict([(row.zip, row.zip) for row in rows])
+            args = len(self.local.zipcodes)
+            self.session.logger.debug("loaded %d ZIP codes", args)
+        return self.local.zipcodes
+
+    def __make_doc_key(self, scheme, parms):
+        """
+        Create the key for caching the results of a document request
+
+        The document ID is normalized, so that "CDR0000012345" and
+        "12345" share the same cache entry. Requests for the document
+        being filtered ("*/...") are never cached.
+
+        Pass:
+          scheme - 'cdr' or 'cdrx'
+          parms - string specifying what to retrieve for which document
+
+        Return:
+          tuple for indexing the cache, or None if caching isn't active
+          for this request
+        """
+
+        if self.local.callback_cache is None or parms.startswith("*"):
+            return None
+        if not parms.startswith("name:"):
+            doc_id, rest = parms, ""
+            if "/" in parms:
+                doc_id, rest = parms.split("/", 1)
+            try:
+                parms = f"{Doc.extract_id(doc_id)}/{rest}"
+            except Exception:
+                return None
+        return self.local.callback_cache.make_key(scheme, parms)
+
     def __run_function(self, parms, context):
         """
         Handle a custom callback function
@@ -4390,10 +6437,22 @@ class Resolver(etree.Resolver):
         function, args = parms, None
         if "/" in parms:
             function, args = parms.split("/", 1)
-        method_name = f"_{function.lower().replace('-', '_')}"
+        name = function.lower()
+        method_name = f"_{name.replace('-', '_')}"
         handler = getattr(self, method_name)
         if handler is not None:
-            return handler(args, context)
+            cache = self.local.callback_cache
+            if cache is None or name not in self.MEMOIZE:
+                return handler(args, context)
+
+            # For sql-query the arguments are the query plus its values.
+            key = cache.make_key("cdrutil", name, args)
+            payload = cache.get(key)
+            if payload is not None:
+                return self.resolve_string(payload, context)
+            result = handler(args, context)
+            cache.put(key, self.__payload, self.MEMOIZE[name])
+            return result
         error = f"unsupported function {function!r} in {self.url!r}"
         raise Exception(error)
 
@@ -4518,6 +6577,14 @@ class Resolver(etree.Resolver):
         """
         Get the preferred name for a concept from the NCI Thesaurus.
 
+        Names are served from the persistent `ConceptNameCache`. When
+        a publishing job is running (that is, the job's callback cache
+        is active), we only read from that cache, so the job isn't at
+        the mercy of EVS response times, and we use names which have
+        aged out rather than dropping them (refreshing them is the
+        job of `ConceptNameCache.warm()`). Otherwise, names not already
+        in the cache (or too old) are fetched from EVS (and cached).
+
         Pass:
           concept_id - fondly known as the "C-name"; e.g., C2039
           context - opaque information echoed back to the caller
@@ -4527,10 +6594,21 @@ class Resolver(etree.Resolver):
         """
 
         element = etree.Element("PreferredName")
+        code = concept_id.upper().strip()
         try:
-            url = self.EVS.format(concept_id.upper().strip())
-            response = requests.get(url)
-            element.text = response.json()["preferredName"]
+            cache = ConceptNameCache.get_cache(self.session.tier)
+            publishing = self.local.callback_cache is not None
+            name = cache.get(code, allow_stale=publishing)
+            if name is None:
+
+                # Publishing jobs don't wait on EVS (see `cache_callbacks()`).
+                if publishing:
+                    message = "no cached name for concept %s"
+                    self.session.logger.warning(message, code)
+                    name = ""
+                else:
+                    name = cache.fetch(code)
+            element.text = name
         except Exception:
             self.session.logger.exception("failure resolving %s", concept_id)
             element.text = ""
@@ -4612,6 +6690,14 @@ class Resolver(etree.Resolver):
         """
 
         result = etree.Element("ValidZip")
+        if self.local.callback_cache is not None:
+            zipcodes = self.__get_zipcodes()
+            zipcode = zipcodes.get(args[:5])
+            if zipcode is None and args[:5].isdigit():
+                zipcode = zipcodes.get(int(args[:5]))
+            if zipcode:
+                result.text = str(zipcode)[:5]
+            return self.__package_result(result, context)
         query = Query("zipcode", "zip")
         query.where(query.Condition("zip", args[:5]))
         rows = query.execute(self.cursor).fetchall()
@@ -4689,6 +6775,26 @@ class Resolver(etree.Resolver):
         result = etree.tostring(result, encoding="utf-8")
         return self.resolve_string(result, context)
 
+    def __wrap_doc_payload(self, key, payload, context):
+        """
+        Hand back a document callback result, caching it if appropriate
+
+        Pass:
+          key - tuple for the cache entry (None if we're not caching)
+          payload - serialized XML for the result
+          context - opaque information echoed back to the caller
+
+        Return:
+          wrapped payload
+        """
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        result = self.resolve_string(payload, context)
+        if key is not None:
+            self.local.callback_cache.put(key, payload)
+        return result
+
     @classmethod
     def __make_id_key(cls, id):
         """
@@ -4730,6 +6836,214 @@ class Resolver(etree.Resolver):
 # Register our custom extension function for XSL/T filters to use.
 etree.FunctionNamespace(Doc.NS).update({"escape-uri": Resolver.escape_uri})
 
+
+class ConceptNameCache:
+    """
+    Persistent cache of preferred names for NCI Thesaurus concepts
+
+    Backs the `ncit-pn` filter callback, which would otherwise make
+    a live request to the Enterprise Vocabulary System for every
+    invocation. The names are stored in a SQLite database on the
+    local disk, so they survive from one process to the next. We
+    also remember (for a shorter period) which concept codes EVS
+    told us it doesn't have, so we don't keep asking.
+
+    The location of the database is controlled by the CDR_NCIT_CACHE
+    environment variable, falling back on a file in the Cache
+    directory under the CDR base directory.
+
+    Attributes:
+      path - location of the SQLite database file
+      url - pattern for the EVS request URL (with {} for the code)
+      ttl - number of seconds a name stays good
+      negative_ttl - number of seconds we remember a missing concept
+      timeout - number of seconds to wait for EVS
+    """
+
+    TTL = 30 * 24 * 60 * 60
+    NEGATIVE_TTL = 24 * 60 * 60
+    TIMEOUT = 10
+    FILENAME = "ncit-names.db"
+    CACHES = {}
+    LOCK = threading.Lock()
+
+    def __init__(self, path, **opts):
+        """
+        Make sure the database is ready for use
+
+        Pass:
+          path - location of the SQLite database file
+
+        Optional keyword arguments:
+          url - override for the EVS URL pattern (e.g., for testing)
+          ttl - override for the number of seconds a name stays good
+          negative_ttl - override for how long a missing concept is
+                         remembered
+          timeout - override for the number of seconds to wait for EVS
+        """
+
+        self.path = path
+        self.url = opts.get("url") or Resolver.EVS
+        self.ttl = opts.get("ttl", self.TTL)
+        self.negative_ttl = opts.get("negative_ttl", self.NEGATIVE_TTL)
+        self.timeout = opts.get("timeout", self.TIMEOUT)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__execute("CREATE TABLE IF NOT EXISTS concept_name ("
+                       "code TEXT PRIMARY KEY, name TEXT, fetched REAL)")
+
+    def fetch(self, code):
+        """
+        Get the preferred name for a concept from EVS and cache it
+
+        Failures to reach EVS are not cached (they're passed on to the
+        caller); a definitive "not found" answer is.
+
+        Pass:
+          code - concept code (e.g., "C2039")
+
+        Return:
+          string for the preferred name ("" if EVS doesn't have it)
+        """
+
+        code = code.upper().strip()
+        url = self.url.format(code)
+        response = requests.get(url, timeout=self.timeout)
+        if response.status_code == 404:
+            name = None
+        else:
+            response.raise_for_status()
+            name = response.json().get("preferredName") or None
+        self.put(code, name)
+        return name or ""
+
+    def get(self, code, allow_stale=False):
+        """
+        Look up a concept's preferred name in the cache
+
+        Pass:
+          code - concept code (e.g., "C2039")
+          allow_stale - if True, return what we have even if it has
+                        aged out
+
+        Return:
+          string for the preferred name; "" if EVS is known not to
+          have the concept; None if we have no current information
+        """
+
+        code = code.upper().strip()
+        query = "SELECT name, fetched FROM concept_name WHERE code = ?"
+        rows = self.__execute(query, (code,))
+        if not rows:
+            return None
+        name, fetched = rows[0]
+        ttl = self.ttl if name is not None else self.negative_ttl
+        if fetched + ttl < time.time() and not allow_stale:
+            return None
+        return name or ""
+
+    def put(self, code, name):
+        """
+        Store a concept's preferred name
+
+        Pass:
+          code - concept code (e.g., "C2039")
+          name - string for the concept's preferred name, or None
+                 if EVS doesn't have the concept
+        """
+
+        code = code.upper().strip()
+        self.__execute("INSERT OR REPLACE INTO concept_name "
+                       "(code, name, fetched) VALUES (?, ?, ?)",
+                       (code, name, time.time()))
+
+    def warm(self, cursor=None, **opts):
+        """
+        Pre-fetch the names for the concepts used by CDR Term documents
+
+        Intended to be run before publishing jobs, so that the `ncit-pn`
+        callback never has to wait on EVS.
+
+        Pass:
+          cursor - optional database cursor
+
+        Optional keyword arguments:
+          limit - maximum number of concepts to fetch
+          refresh - if True, fetch names even if they're still current
+          logger - object for recording failures
+
+        Return:
+          dictionary of counts for "cached", "fetched", and "failed"
+        """
+
+        query = Query("query_term", "value").unique()
+        query.where("path = '/Term/NCIThesaurusConcept'")
+        query.where("value LIKE 'C%'")
+        query.where("value NOT LIKE 'CDR%'")
+        codes = sorted(set([row.value.upper().strip()
+                            for row in query.execute(cursor).fetchall()]))
+        counts = dict(cached=0, fetched=0, failed=0)
+        limit = opts.get("limit")
+        for code in codes:
+            if not opts.get("refresh") and self.get(code) is not None:
+                counts["cached"] += 1
+                continue
+            if limit is not None and counts["fetched"] >= limit:
+                break
+            try:
+                self.fetch(code)
+                counts["fetched"] += 1
+            except Exception:
+                counts["failed"] += 1
+                if opts.get("logger"):
+                    opts["logger"].exception("fetching %s", code)
+        return counts
+
+    def __execute(self, sql, values=()):
+        """
+        Run a statement against the SQLite database and commit it
+
+        We use a fresh connection for each operation so that the cache
+        can be shared safely by threads and processes.
+
+        Pass:
+          sql - string for the SQL statement
+          values - optional sequence of values for the placeholders
+
+        Return:
+          sequence of result rows (empty for statements with no results)
+        """
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            rows = conn.execute(sql, values).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    @classmethod
+    def get_cache(cls, tier):
+        """
+        Get the process-wide cache object for a CDR tier
+
+        Pass:
+          tier - `Tier` object for the CDR server
+
+        Return:
+          `ConceptNameCache` object
+        """
+
+        path = os.environ.get("CDR_NCIT_CACHE")
+        if not path:
+            path = f"{tier.basedir}/Cache/{cls.FILENAME}"
+        with cls.LOCK:
+            if path not in cls.CACHES:
+                cls.CACHES[path] = cls(path)
+            return cls.CACHES[path]
+
+
 class Term:
     """
     Term document with parents
@@ -4772,114 +7086,497 @@ class Term:
                 return
             raise
 
-    def get_xml(self, with_upcoding=True):
+    def get_xml(self, with_upcoding=True):
+        """
+        Return one of the serialized versions of the Term document
+
+        Pass:
+          with_upcoding - return the version which includes parent terms
+                          if `True`
+
+        Return:
+          utf-8 bytes for serialized document
+        """
+
+        with self.session.cache.term_lock:
+            if self.xml and self.full_xml:
+                return with_upcoding and self.full_xml or self.xml
+        self.serialize(need_locking=True)
+        return with_upcoding and self.full_xml or self.xml
+
+    def serialize(self, need_locking=False):
+        """
+        Generate two string representations of the term
+
+        One serialization is for the bare Term information, and the
+        other includes upcoding.
+
+        Pass:
+          need_locking - if True, take precautions to avoid cross-thread
+                         collisions with use of the cache
+
+        Return:
+          None (side effect is population of `self.xml` and `self.full_xml`)
+        """
+
+        term = etree.Element("Term", nsmap=Doc.NSMAP)
+        term.set(Link.CDR_REF, self.cdr_id)
+        if self.pdq_key:
+            term.set("PdqKey", "Term:" + self.pdq_key)
+        etree.SubElement(term, "PreferredName").text = self.name
+        xml = etree.tostring(term, encoding="utf-8")
+        for doc_id in sorted(self.parents):
+            parent = self.parents[doc_id]
+            if parent is not None and parent.include and parent.name:
+                child = etree.SubElement(term, "Term")
+                child.set(Link.CDR_REF, parent.cdr_id)
+                if parent.pdq_key:
+                    child.set("PdqKey", "Term:" + parent.pdq_key)
+                etree.SubElement(child, "PreferredName").text = parent.name
+        full_xml = etree.tostring(term, encoding="utf-8")
+        if need_locking:
+            with self.session.cache.term_lock:
+                if not(self.xml and self.full_xml):
+                    self.xml, self.full_xml = xml, full_xml
+        else:
+            self.xml, self.full_xml = xml, full_xml
+
+    def get_parent(self, node, depth):
+        """
+        Fetch the parent document from the cache or the database
+
+        Pass:
+          node - document node containing the link to the parent term document
+          depth - integer for how far we've crawled in the stack (preventing
+                  out-of-control recursion)
+
+        Return:
+          None (side effect is population of cache and `self.parents`)
+        """
+
+        try:
+            doc_id = Doc.extract_id(node.get(Link.CDR_REF))
+        except:
+            error = f"No cdr:ref for parent of Term {self.cdr_id}"
+            raise Exception(failure)
+        if doc_id not in self.parents:
+            parent = Term.get_term(self.session, doc_id, depth + 1)
+            if parent:
+                self.parents.update(parent.parents)
+                self.parents[doc_id] = parent
+
+    @classmethod
+    def get_term(cls, session, doc_id, depth=0):
+        """
+        Pull a Term document from the cache or the database
+
+        Pass:
+          session - reference to object representing the current login
+          doc_id - unique ID of the CDR Term document
+          depth - keeps track of level of recursion
+        """
+
+        # Stop if recursion has gotten out of hand.
+        if depth > cls.MAX_DEPTH:
+            error = f"term hierarchy depth exceeded at CDR{doc_id}"
+            raise Exception(error)
+
+        # Pull the Term object from the cache if we already have it.
+        with session.cache.term_lock:
+            if doc_id in session.terms:
+                return session.cache.terms[doc_id]
+
+        # Fetch the term information from the database, cache and return it.
+        term = cls(session, doc_id, depth)
+        if not term.name:
+            term = None
+        with session.cache.term_lock:
+            if doc_id not in session.cache.terms:
+                session.cache.terms[doc_id] = term
+        return term
+
+
+class TransformCache:
+    """
+    Process-wide cache of compiled XSL/T filters
+
+    Compiling a filter costs far more than applying it, and publishing
+    jobs apply the same handful of filters to thousands of documents.
+    Entries are keyed by the filter's document ID, its version, and a
+    digest of the filter's XML, so a compiled transform is never reused
+    for a filter whose content has changed. The compiled transform
+    keeps the `Resolver` of the parser used to compile it, and lxml
+    makes no promise that an `etree.XSLT` object can safely be invoked
+    by more than one thread at a time, so the key also includes the
+    identity of the thread for which the transform was compiled.
+
+    A compiled transform also has the modules it pulls in with
+    xsl:include and xsl:import (cdr:name:... URLs) baked into it, and
+    those aren't reflected in the key. So the whole cache is dropped
+    whenever a filter is saved by this process, and when a cursor is
+    passed to `get()` the latest `audit_trail` date for any Filter
+    document is checked (at most once every CHECK_INTERVAL seconds) to
+    catch changes made by other processes.
+
+    Attributes:
+      max_size - number of transforms held before the least recently
+                 used one is dropped (can be overridden by setting the
+                 CDR_XSLT_CACHE_SIZE environment variable; zero disables
+                 caching)
+      hits - number of requests satisfied from the cache
+      misses - number of requests which required compilation
+    """
+
+    MAX_SIZE = 250
+    CHECK_INTERVAL = 60
+
+    def __init__(self, max_size=None):
+        """
+        Set up an empty cache
+
+        Pass:
+          max_size - optional override for the default size limit
+        """
+
+        if max_size is None:
+            max_size = os.environ.get("CDR_XSLT_CACHE_SIZE", self.MAX_SIZE)
+        self.max_size = int(max_size)
+        self.hits = self.misses = 0
+        self.__transforms = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__generation = None
+        self.__checked = 0
+
+    def __len__(self):
+        """Number of compiled transforms currently held."""
+        return len(self.__transforms)
+
+    @property
+    def stats(self):
+        """
+        Dictionary of cache statistics (for logging)
+        """
+
+        return dict(
+            size=len(self),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+    def get(self, filter_xml, parser=None, doc_id=None, version=None,
+            cursor=None):
+        """
+        Find or create the `etree.XSLT` object for a filter
+
+        Pass:
+          filter_xml - serialized XSL/T document
+          parser - optional object capable of resolving URLs
+          doc_id - optional integer for the filter's CDR document ID
+                   (None for in-memory filters)
+          version - optional integer for the filter's version
+          cursor - optional database cursor used to check whether any
+                   filters have been changed by other processes
+
+        Return:
+          `etree.XSLT` object
+        """
+
+        if cursor is not None:
+            self.check_generation(cursor)
+        xml = filter_xml
+        if isinstance(xml, str):
+            xml = xml.encode("utf-8")
+        digest = hashlib.sha1(xml).hexdigest()
+        key = doc_id, version, digest, threading.get_ident()
+        with self.__lock:
+            transform = self.__transforms.get(key)
+            if transform is not None:
+                self.__transforms.move_to_end(key)
+                self.hits += 1
+                return transform
+            self.misses += 1
+        transform = etree.XSLT(etree.fromstring(filter_xml, parser))
+        if self.max_size > 0:
+            with self.__lock:
+                self.__transforms[key] = transform
+                while len(self.__transforms) > self.max_size:
+                    self.__transforms.popitem(last=False)
+        return transform
+
+    def invalidate(self, doc_id=None):
+        """
+        Drop cached transforms
+
+        Pass:
+          doc_id - optional integer for the filter whose transforms
+                   should be discarded; if omitted, clear the cache
+        """
+
+        with self.__lock:
+            if doc_id is None:
+                self.__transforms.clear()
+            else:
+                for key in list(self.__transforms):
+                    if key[0] == doc_id:
+                        del self.__transforms[key]
+
+    def check_generation(self, cursor):
+        """
+        Drop the cached transforms if any filter has changed
+
+        The check is skipped if it was run within the last
+        CHECK_INTERVAL seconds.
+
+        Pass:
+          cursor - used for finding the latest change to a filter
+        """
+
+        now = time.time()
+        with self.__lock:
+            if now - self.__checked < self.CHECK_INTERVAL:
+                return
+            self.__checked = now
+        query = Query("audit_trail a", "MAX(a.dt) AS dt")
+        query.join("all_docs d", "d.id = a.document")
+        query.join("doc_type t", "t.id = d.doc_type")
+        query.where("t.name = 'Filter'")
+        try:
+            generation = str(query.execute(cursor).fetchone().dt)
+        except Exception:
+            return
+        with self.__lock:
+            if generation != self.__generation:
+                if self.__generation is not None:
+                    self.__transforms.clear()
+                self.__generation = generation
+
+
+class FilterSetCache:
+    """
+    Process-wide cache of assembled filter sets
+
+    Expanding a filter set means fetching every member filter document
+    (recursing through nested sets), and it's one of the first things
+    every publishing export batch does. Assembled sets are cached here,
+    outliving the sessions which loaded them, keyed by the CDR tier,
+    the filter set, the version specifier, and the cutoff date.
+
+    Each entry carries a stamp recording the state of the database when
+    the set was assembled: a checksum of the `filter_set_member` table
+    and the number and latest modification time of the `doc_version`
+    rows for the member filters (or the latest `audit_trail` entry for
+    those filters if the set was assembled from the current working
+    documents). Before an entry is handed out, the stamp is recomputed,
+    which costs a couple of aggregate queries instead of a fetch for
+    every filter in the set, and the entry is discarded if anything
+    has changed.
+
+    If the CDR_FILTER_SET_CACHE environment variable names a file,
+    the cache is persisted there (in a SQLite database, one row for
+    each set, so adding a set doesn't rewrite the others) so that new
+    processes start out warm. The stamps are still checked before the
+    persisted entries are used.
+    """
+
+    def __init__(self, path=None):
         """
-        Return one of the serialized versions of the Term document
+        Set up an empty cache
 
         Pass:
-          with_upcoding - return the version which includes parent terms
-                          if `True`
+          path - optional override for the location of the cache file
+        """
+
+        self.path = path or os.environ.get("CDR_FILTER_SET_CACHE")
+        self.hits = self.misses = 0
+        self.__sets = None
+        self.__lock = threading.Lock()
+
+    def get(self, session, set_id, version=None, before=None):
+        """
+        Find the cached filters for a set, if still current
+
+        Pass:
+          session - object used for the tier and for database access
+          set_id - primary key integer into the `filter_set` table
+          version - versions of the filters (e.g., 'lastp')
+          before - restrict versions to those created before this date/time
 
         Return:
-          utf-8 bytes for serialized document
+          sequence of `Filter` objects if a valid entry is found;
+          otherwise None
+        """
+
+        key = self.__make_key(session, set_id, version, before)
+        with self.__lock:
+            entry = self.__load().get(key)
+        if entry is not None:
+            stamp, filters = entry
+            if stamp == self.__make_stamp(session, filters, version, before):
+                with self.__lock:
+                    self.hits += 1
+                return filters
+            with self.__lock:
+                if self.__sets.get(key) is entry:
+                    del self.__sets[key]
+            self.__persist(key)
+        with self.__lock:
+            self.misses += 1
+        return None
+
+    def put(self, session, set_id, filters, version=None, before=None):
         """
+        Remember the filters assembled for a set
 
-        with self.session.cache.term_lock:
-            if self.xml and self.full_xml:
-                return with_upcoding and self.full_xml or self.xml
-        self.serialize(need_locking=True)
-        return with_upcoding and self.full_xml or self.xml
+        Pass:
+          session - object used for the tier and for database access
+          set_id - primary key integer into the `filter_set` table
+          filters - sequence of `Filter` objects for the set
+          version - versions of the filters (e.g., 'lastp')
+          before - restrict versions to those created before this date/time
+        """
 
-    def serialize(self, need_locking=False):
+        key = self.__make_key(session, set_id, version, before)
+        stamp = self.__make_stamp(session, filters, version, before)
+        with self.__lock:
+            self.__load()[key] = stamp, filters
+        self.__persist(key, stamp, filters)
+
+    def clear(self):
+        """
+        Drop all of the cached sets (including any persisted copy)
         """
-        Generate two string representations of the term
 
-        One serialization is for the bare Term information, and the
-        other includes upcoding.
+        with self.__lock:
+            self.__sets = {}
+        self.__execute("DELETE FROM filter_set_cache")
 
-        Pass:
-          need_locking - if True, take precautions to avoid cross-thread
-                         collisions with use of the cache
+    def __load(self):
+        """
+        Make sure the cache has been populated from disk if appropriate
+
+        Caller must hold the lock.
 
         Return:
-          None (side effect is population of `self.xml` and `self.full_xml`)
+          dictionary of cache entries
         """
 
-        term = etree.Element("Term", nsmap=Doc.NSMAP)
-        term.set(Link.CDR_REF, self.cdr_id)
-        if self.pdq_key:
-            term.set("PdqKey", "Term:" + self.pdq_key)
-        etree.SubElement(term, "PreferredName").text = self.name
-        xml = etree.tostring(term, encoding="utf-8")
-        for doc_id in sorted(self.parents):
-            parent = self.parents[doc_id]
-            if parent is not None and parent.include and parent.name:
-                child = etree.SubElement(term, "Term")
-                child.set(Link.CDR_REF, parent.cdr_id)
-                if parent.pdq_key:
-                    child.set("PdqKey", "Term:" + parent.pdq_key)
-                etree.SubElement(child, "PreferredName").text = parent.name
-        full_xml = etree.tostring(term, encoding="utf-8")
-        if need_locking:
-            with self.session.cache.term_lock:
-                if not(self.xml and self.full_xml):
-                    self.xml, self.full_xml = xml, full_xml
-        else:
-            self.xml, self.full_xml = xml, full_xml
+        if self.__sets is None:
+            self.__sets = {}
+            if self.path and os.path.exists(self.path):
+                sql = "SELECT key, stamp, filters FROM filter_set_cache"
+                try:
+                    for key, stamp, filters in self.__execute(sql):
+                        filters = [Filter(*v) for v in json.loads(filters)]
+                        self.__sets[tuple(json.loads(key))] = (
+                            json.loads(stamp),
+                            filters,
+                        )
+                except Exception:
+                    self.__sets = {}
+        return self.__sets
 
-    def get_parent(self, node, depth):
+    def __persist(self, key, stamp=None, filters=None):
         """
-        Fetch the parent document from the cache or the database
+        Write (or drop) one set's row if persistence has been requested
 
         Pass:
-          node - document node containing the link to the parent term document
-          depth - integer for how far we've crawled in the stack (preventing
-                  out-of-control recursion)
+          key - tuple returned by `__make_key()`
+          stamp - list returned by `__make_stamp()` (None to drop the row)
+          filters - sequence of `Filter` objects for the set
+        """
+
+        key = json.dumps(key)
+        if stamp is None:
+            sql = "DELETE FROM filter_set_cache WHERE key = ?"
+            self.__execute(sql, (key,))
+            return
+        values = []
+        for f in filters:
+            xml = f.xml
+            if isinstance(xml, bytes):
+                xml = xml.decode("utf-8")
+            values.append((f.doc_id, xml, f.version))
+        sql = ("INSERT OR REPLACE INTO filter_set_cache (key, stamp, filters)"
+               " VALUES (?, ?, ?)")
+        self.__execute(sql, (key, json.dumps(stamp), json.dumps(values)))
+
+    def __execute(self, sql, values=()):
+        """
+        Run a statement against the SQLite database and commit it
+
+        Failure to use the database is not fatal: we just don't get
+        a warm start in the next process.
+
+        Pass:
+          sql - string for the SQL statement
+          values - optional sequence of values for the placeholders
 
         Return:
-          None (side effect is population of cache and `self.parents`)
+          sequence of result rows (empty if persistence is off or
+          the statement failed)
         """
 
+        if not self.path:
+            return []
         try:
-            doc_id = Doc.extract_id(node.get(Link.CDR_REF))
-        except:
-            error = f"No cdr:ref for parent of Term {self.cdr_id}"
-            raise Exception(failure)
-        if doc_id not in self.parents:
-            parent = Term.get_term(self.session, doc_id, depth + 1)
-            if parent:
-                self.parents.update(parent.parents)
-                self.parents[doc_id] = parent
+            conn = sqlite3.connect(self.path, timeout=30)
+            try:
+                conn.execute("CREATE TABLE IF NOT EXISTS filter_set_cache ("
+                             "key TEXT PRIMARY KEY, stamp TEXT, filters TEXT)")
+                rows = conn.execute(sql, values).fetchall()
+                conn.commit()
+                return rows
+            finally:
+                conn.close()
+        except Exception:
+            return []
 
-    @classmethod
-    def get_term(cls, session, doc_id, depth=0):
+    @staticmethod
+    def __make_key(session, set_id, version, before):
+        """
+        Assemble the (JSON-friendly) key for a cache entry
         """
-        Pull a Term document from the cache or the database
 
-        Pass:
-          session - reference to object representing the current login
-          doc_id - unique ID of the CDR Term document
-          depth - keeps track of level of recursion
+        before = str(before) if before else None
+        version = str(version) if version else None
+        return session.tier.name, set_id, version, before
+
+    @staticmethod
+    def __make_stamp(session, filters, version, before):
         """
+        Capture the state of the tables from which a set was assembled
 
-        # Stop if recursion has gotten out of hand.
-        if depth > cls.MAX_DEPTH:
-            error = f"term hierarchy depth exceeded at CDR{doc_id}"
-            raise Exception(error)
+        Pass:
+          session - object used for database access
+          filters - sequence of `Filter` objects for the set
+          version - versions of the filters (e.g., 'lastp')
+          before - restrict versions to those created before this date/time
 
-        # Pull the Term object from the cache if we already have it.
-        with session.cache.term_lock:
-            if doc_id in session.terms:
-                return session.cache.terms[doc_id]
+        Return:
+          list of strings which will change if the set would change
+        """
 
-        # Fetch the term information from the database, cache and return it.
-        term = cls(session, doc_id, depth)
-        if not term.name:
-            term = None
-        with session.cache.term_lock:
-            if doc_id not in session.cache.terms:
-                session.cache.terms[doc_id] = term
-        return term
+        cursor = session.conn.cursor()
+        try:
+            column = "CHECKSUM_AGG(CHECKSUM(*)) AS c"
+            row = Query("filter_set_member", column).execute(cursor).fetchone()
+            stamp = [str(row.c)]
+            doc_ids = sorted(set([f.doc_id for f in filters if f.doc_id]))
+            if doc_ids:
+                if version or before:
+                    columns = "COUNT(*) AS n", "MAX(updated_dt) AS dt"
+                    query = Query("doc_version", *columns)
+                    query.where(query.Condition("id", doc_ids, "IN"))
+                else:
+                    columns = "COUNT(*) AS n", "MAX(dt) AS dt"
+                    query = Query("audit_trail", *columns)
+                    query.where(query.Condition("document", doc_ids, "IN"))
+                row = query.execute(cursor).fetchone()
+                stamp += [str(row.n), str(row.dt)]
+            return stamp
+        finally:
+            cursor.close()
 
 
 class Filter:
@@ -4889,6 +7586,8 @@ class Filter:
     Attributes:
       doc_id - unique ID of the CDR Filter document
       xml - utf-8 bytes for the serialized filter document
+      version - integer for the filter's version (None for the
+                current working document or for an in-memory filter)
       now - was originally used to track how long the filter has sat in
             the cache unused; drop?
     """
@@ -4899,19 +7598,36 @@ class Filter:
     # Namespace for XSL/T documents
     NS = "http://www.w3.org/1999/XSL/Transform"
 
-    def __init__(self, doc_id, xml):
+    # Compiled transforms, shared by all sessions in the process.
+    TRANSFORMS = TransformCache()
+
+    # Assembled filter sets, also shared across sessions.
+    SETS = FilterSetCache()
+
+    def __init__(self, doc_id, xml, version=None):
         """
         Capture the filter ID and xml, forcing the xml to bytes
 
         Pass:
           doc_id - unique ID for the CDR Filter document
           xml - utf-8 bytes or Unicode serialization of the Filter document
+          version - optional integer for the filter document's version
         """
 
         self.doc_id = doc_id
         self.xml = xml #.encode("utf-8") if isinstance(xml, str) else xml
+        self.version = version
         self.now = time.time()
 
+    @property
+    def transform(self):
+        """
+        Compiled `etree.XSLT` object for this filter (from the cache)
+        """
+
+        return self.TRANSFORMS.get(self.xml, Doc.Parser(), self.doc_id,
+                                   self.version)
+
 
 class Schema:
     """
@@ -4994,13 +7710,8 @@ class Doctype:
         if not hasattr(self, "_active"):
             self._active = self.__opts.get("active")
             if not self._active:
-                if self.id:
-                    query = Query("doc_type", "active")
-                    query.where(query.Condition("id", self.id))
-                    rows = query.execute(self.cursor).fetchall()
-                    self._active = rows[0].active if rows else "Y"
-                else:
-                    self._active = "Y"
+                row = self.__get_row()
+                self._active = row.active if row else "Y"
         assert self._active in "YN", "invalid doctype active value"
         return self._active
 
@@ -5018,13 +7729,9 @@ class Doctype:
         if not hasattr(self, "_comment"):
             if "comment" in self.__opts:
                 self._comment = self.__opts["comment"]
-            elif self.id:
-                query = Query("doc_type", "comment")
-                query.where(query.Condition("id", self.id))
-                rows = query.execute(self.cursor).fetchall()
-                self._comment = rows[0].comment if rows else None
             else:
-                self._comment = None
+                row = self.__get_row()
+                self._comment = row.comment if row else None
             if self._comment:
                 self._comment = self._comment.strip()
             else:
@@ -5077,13 +7784,10 @@ class Doctype:
 
         if not hasattr(self, "_format"):
             self._format = self.__opts.get("format")
-            if not self._format and self.id:
-                query = Query("format f", "f.name", "f.id")
-                query.join("doc_type t", "t.format = f.id")
-                query.where(query.Condition("t.id", self.id))
-                rows = query.execute(self.cursor).fetchall()
-                if rows:
-                    self._format, self._format_id = rows[0]
+            if not self._format:
+                row = self.__get_row()
+                if row and row.format_name:
+                    self._format, self._format_id = row.format_name, row.format
             if not self._format:
                 self._format = "xml"
         return self._format
@@ -5122,10 +7826,8 @@ class Doctype:
                 else:
                     name = self.__opts.get("name")
                 if name:
-                    query = Query("doc_type", "id")
-                    query.where(query.Condition("name", name))
-                    rows = query.execute(self.cursor).fetchall()
-                    self._id = rows[0].id if rows else None
+                    row = self.__get_row(name=name)
+                    self._id = row.id if row else None
                 else:
                     self.session.logger.warning("Doctype.id: NO NAME!!!")
         return self._id
@@ -5138,11 +7840,9 @@ class Doctype:
 
         if not hasattr(self, "_name"):
             self._name = self.__opts.get("name")
-            if not self._name and self.id:
-                query = Query("doc_type", "name")
-                query.where(query.Condition("id", self.id))
-                rows = query.execute(self.cursor).fetchall()
-                self._name = rows[0].name if rows else None
+            if not self._name:
+                row = self.__get_row()
+                self._name = row.name if row else None
         return self._name
 
     @name.setter
@@ -5279,13 +7979,8 @@ class Doctype:
         if not hasattr(self, "_versioning"):
             self._versioning = self.__opts.get("versioning")
             if not self._versioning:
-                if self.id:
-                    query = Query("doc_type", "versioning")
-                    query.where(query.Condition("id", self.id))
-                    rows = query.execute(self.cursor).fetchall()
-                    self._versioning = rows[0].versioning if rows else "Y"
-                else:
-                    self._versioning = "Y"
+                row = self.__get_row()
+                self._versioning = row.versioning if row else "Y"
         assert self._versioning in "YN", "invalid doctype versioning value"
         return self._versioning
 
@@ -5349,6 +8044,8 @@ class Doctype:
             sql = f"DELETE FROM {table} WHERE {column} = ?"
             self.cursor.execute(sql, (self.id,))
         self.session.conn.commit()
+        names = [table for table, column in tables]
+        RefCache.invalidate(names, tier=self.session.tier)
 
     def elements_allowing_fragment_ids(self):
         """
@@ -5439,6 +8136,7 @@ class Doctype:
             self.cursor.execute("SELECT @@IDENTITY AS id")
             self._id = self.cursor.fetchall()[0].id
         self.session.conn.commit()
+        RefCache.invalidate("doc_type", tier=self.session.tier)
         self.session.logger.debug("committed doctype %s", self.id)
         return self.id
 
@@ -5453,10 +8151,12 @@ class Doctype:
           integer for the row's primary key
         """
 
-        query = Query("format", "id")
-        query.where(query.Condition("name", name))
-        rows = query.execute(self.cursor).fetchall()
-        return rows[0].id if rows else None
+        query = Query("format", "id", "name")
+        opts = dict(cursor=self.cursor, tier=self.session.tier)
+        for row in RefCache.get("format", "formats", query, **opts):
+            if row.name.lower() == (name or "").lower():
+                return row.id
+        return None
 
     def __fetch_dates(self):
         """
@@ -5471,17 +8171,64 @@ class Doctype:
         """
 
         self._created = self._schema_date = None
-        if self.id:
-            query = Query("doc_type", "created", "schema_date")
-            query.where(query.Condition("id", self.id))
-            rows = query.execute(self.cursor).fetchall()
-            if rows:
-                values = []
-                for value in rows[0]:
-                    if isinstance(value, datetime.datetime):
-                        value = value.replace(microsecond=0)
-                    values.append(value)
-                self._created, self._schema_date = values
+        row = self.__get_row()
+        if row:
+            values = []
+            for value in row.created, row.schema_date:
+                if isinstance(value, datetime.datetime):
+                    value = value.replace(microsecond=0)
+                values.append(value)
+            self._created, self._schema_date = values
+
+    def __get_row(self, name=None):
+        """
+        Find this document type's row in the `doc_type` table
+
+        The whole (small) table is held in the process-wide cache
+        for reference tables, so the properties for a document type
+        don't each need their own query. If the row isn't in the
+        cached copy (perhaps because it was just added by another
+        process) we go to the database for it.
+
+        Pass:
+          name - optional name to look for instead of our `id`
+
+        Return:
+          database row (with the name of the document type's format
+          added), or None if not found
+        """
+
+        if name is None:
+            if not self.id:
+                return None
+            column, value = "id", int(self.id)
+        else:
+            column, value = "name", name.strip().lower()
+        opts = dict(cursor=self.cursor, tier=self.session.tier)
+        query = self.__make_row_query()
+        rows = RefCache.get(("doc_type", "format"), "rows", query, **opts)
+        for row in rows:
+            if column == "id" and row.id == value:
+                return row
+            if column == "name" and row.name.strip().lower() == value:
+                return row
+        query = self.__make_row_query()
+        query.where(query.Condition(f"t.{column}", value))
+        rows = query.execute(self.cursor).fetchall()
+        return rows[0] if rows else None
+
+    @staticmethod
+    def __make_row_query():
+        """
+        Create the query for `doc_type` rows and their format names
+        """
+
+        fields = ("t.id", "t.name", "t.active", "t.comment", "t.versioning",
+                  "t.created", "t.schema_date", "t.format",
+                  "f.name AS format_name")
+        query = Query("doc_type t", *fields)
+        query.outer("format f", "f.id = t.format")
+        return query
 
     def __parse_schema(self, title, elements, types, schemas):
         """
@@ -6518,6 +9265,17 @@ class LinkType:
     TYPE_IDS = dict()
     LOCK = threading.Lock()
 
+    # Tables from which the process-wide cache of the link types
+    # governing each linking element is built (see `RefCache`).
+    SOURCE_TABLES = (
+        "link_type",
+        "link_target",
+        "link_properties",
+        "link_prop_type",
+        "link_xml",
+        "doc_type",
+    )
+
     # Codes for limitations on the link target's version.
     CHECK_TYPES = {
         "C": "current document",
@@ -6816,6 +9574,7 @@ class LinkType:
         try:
             self.__save()
             self.session.conn.commit()
+            self.__clear_cache(self.session)
         except:
             try:
                 self.session.logger.exception("LinkType.save() failure")
@@ -6845,6 +9604,7 @@ class LinkType:
         try:
             self.__delete()
             self.session.conn.commit()
+            self.__clear_cache(self.session)
         except:
             try:
                 self.session.logger.exception("LinkType.delete() failure")
@@ -6916,7 +9676,7 @@ class LinkType:
         # types can contain links of this type.
         for source in self.sources:
             args = self.session, source.doctype, source.element
-            linktype = self.lookup(*args)
+            linktype = self.lookup(*args, cached=False)
             if linktype:
                 args = linktype.name, source.doctype.name, source.element
                 message = "Link type {} already defined for {}/{}"
@@ -6983,7 +9743,7 @@ class LinkType:
         return cls.TYPES[id]
 
     @classmethod
-    def lookup(cls, session, doctype, element_tag):
+    def lookup(cls, session, doctype, element_tag, cached=True):
         """
         Find the `LinkType` object for this linking source
 
@@ -6996,11 +9756,20 @@ class LinkType:
           session - logged-in sesion of CDR account
           doctype - `Doctype` for the linking document
           element_tag - string for the linking element's name
+          cached - if False, bypass the process-wide cache and go
+                   straight to the database (used when saving link
+                   types); default is True
 
         Return:
           `LinkType` object or None
         """
 
+        if cached:
+            sources, types = cls.__get_sources(session)
+            link_id = sources.get((doctype.id, element_tag))
+            if link_id not in types:
+                return None
+            return cls(session, **types[link_id])
         cursor = session.conn.cursor()
         query = Query("link_xml", "link_id")
         query.where(query.Condition("doc_type", doctype.id))
@@ -7009,6 +9778,78 @@ class LinkType:
         cursor.close()
         return cls(session, id=rows[0].link_id) if rows else None
 
+    @classmethod
+    def __get_sources(cls, session):
+        """
+        Get the cached linking rules for the session's tier
+
+        The first time they're needed (and again when the cached copy
+        ages out and the link tables have changed) all of the link
+        types are loaded with four set-based queries, with their
+        targets and properties populated eagerly, so that validating
+        a document's links doesn't need any queries for the link types
+        themselves. The `Doctype` and `Property` objects are shared by
+        all the `LinkType` objects created from the cache.
+
+        Pass:
+          session - reference to object representing the current login
+
+        Return:
+          tuple of a dictionary of link type IDs indexed by doctype
+          ID/element name tuples and a dictionary of `LinkType`
+          constructor options indexed by link type ID
+        """
+
+        def load(cursor):
+            types = dict()
+            query = Query("link_type", "id", "name", "chk_type", "comment")
+            for row in query.execute(cursor).fetchall():
+                comment = None if row.comment == "None" else row.comment
+                types[row.id] = dict(
+                    id=row.id,
+                    name=row.name,
+                    chk_type=row.chk_type,
+                    comment=comment,
+                    targets=dict(),
+                    properties=[],
+                )
+            query = Query("link_target l", "l.source_link_type", "t.id",
+                          "t.name")
+            query.join("doc_type t", "t.id = l.target_doc_type")
+            for row in query.execute(cursor).fetchall():
+                if row.source_link_type in types:
+                    doctype = Doctype(session, id=row.id, name=row.name)
+                    types[row.source_link_type]["targets"][row.id] = doctype
+            fields = "p.link_id", "t.name", "p.value", "p.comment"
+            query = Query("link_properties p", *fields)
+            query.join("link_prop_type t", "t.id = p.property_id")
+            message = "Property type {!r} not supported"
+            for row in query.execute(cursor).fetchall():
+                if row.link_id in types:
+                    args = row.name, row.value, row.comment
+                    property = getattr(cls, row.name)(session, *args)
+                    if not isinstance(property, cls.Property):
+                        raise Exception(message.format(row.name))
+                    types[row.link_id]["properties"].append(property)
+            sources = dict()
+            query = Query("link_xml", "link_id", "doc_type", "element")
+            for row in query.execute(cursor).fetchall():
+                sources[(row.doc_type, row.element)] = row.link_id
+            args = len(types), len(sources)
+            session.logger.debug("cached %d link types for %d sources", *args)
+            return sources, types
+
+        opts = dict(cursor=session.cursor, tier=session.tier)
+        return RefCache.get(cls.SOURCE_TABLES, "sources", load, **opts)
+
+    @classmethod
+    def __clear_cache(cls, session):
+        """
+        Drop the cached linking rules for the session's tier
+        """
+
+        RefCache.invalidate(cls.SOURCE_TABLES, tier=session.tier)
+
     @classmethod
     def get_property_types(cls, session):
         """
@@ -7551,6 +10392,10 @@ class Link:
       VERSIONS - map of `LinkType.CHECK_TYPE` codes to strings used
                  for generically specifying which version of a document
                  to fetch
+      FRAGMENT_CACHE_SIZE - maximum number of target documents whose
+                            fragment IDs are cached for a session
+      FIELDS - names of the `link_net` columns we populate
+      INSERT - SQL statement for adding a `link_net` row
 
     Instance attributes:
       doc - reference to `Doc` object representing CDR document in which
@@ -7576,6 +10421,10 @@ class Link:
             if any errors are found (this is an ephemeral identifier)
       id - stable unique identifier for this element node if it can
            be the explicit target of link
+      target_id - string for the ID of the linked document (internal
+                  links only)
+      target_version - version specifier for the linked document
+                       (see `VERSIONS`)
     """
 
     CDR_ID = Doc.qname("id")
@@ -7585,8 +10434,21 @@ class Link:
     LINK_ATTRS = CDR_REF, CDR_HREF, CDR_XREF
     INTERNAL_LINK_ATTRS = {CDR_REF, CDR_HREF}
     VERSIONS = dict(C="Current", V="last", P="lastp")
+    FRAGMENT_CACHE_SIZE = 1000
+    FIELDS = (
+        "link_type",
+        "source_doc",
+        "source_elem",
+        "target_doc",
+        "target_frag",
+        "url",
+    )
+    INSERT = "INSERT INTO link_net ({}) VALUES ({})".format(
+        ", ".join(FIELDS),
+        ", ".join(["?"] * len(FIELDS)),
+    )
 
-    def __init__(self, doc, node, name):
+    def __init__(self, doc, node, name, **opts):
         """
         Collect the linking information for this element node (if any)
 
@@ -7594,12 +10456,19 @@ class Link:
           doc - reference to `Doc` object for linking document
           node - reference to `etree._Element` object containing the link
           name - attribute name for link
+
+        Optional keyword arguments:
+          resolve - if False, leave the lookup of the target document
+                    to the caller, which will typically resolve the
+                    targets for all of a document's links at once with
+                    `Link.resolve_targets()`; default is True
         """
 
         # Start with a clean slate
         doc.session.logger.debug("top of Link() constructor")
         self.link_name = self.url = self.internal = self.store = None
         self.target_doc = self.fragment_id = self.linktype = None
+        self.target_id = self.target_version = None
 
         # Capture the values we were given.
         self.doc = doc
@@ -7633,17 +10502,81 @@ class Link:
             else:
                 self.chk_type = "C"
                 doc.session.logger.debug("link type not found")
-            version = self.VERSIONS[self.chk_type]
-            try:
-                target_doc = Doc(doc.session, id=doc_id, version=version)
-                assert target_doc.doctype, "version not found"
-                doc.session.logger.debug("target doc is %s", target_doc.cdr_id)
-                self.target_doc = target_doc
-            except Exception as e:
-                doc.session.logger.debug("link type not found: %s", e)
-                self.store = False
+            self.target_id = doc_id
+            self.target_version = self.VERSIONS[self.chk_type]
+            if opts.get("resolve", True):
+                self.__resolve_target()
         doc.session.logger.debug("bottom of Link() constructor")
 
+    def __resolve_target(self):
+        """
+        Find the linked document (one link at a time)
+        """
+
+        session = self.doc.session
+        version = self.target_version
+        try:
+            target_doc = Doc(session, id=self.target_id, version=version)
+            assert target_doc.doctype, "version not found"
+            session.logger.debug("target doc is %s", target_doc.cdr_id)
+            self.target_doc = target_doc
+        except Exception as e:
+            session.logger.debug("link type not found: %s", e)
+            self.store = False
+
+    @classmethod
+    def resolve_targets(cls, session, links):
+        """
+        Find the linked documents for a batch of links
+
+        Constructing a separate `Doc` object for each link costs several
+        queries per link, which adds up for documents with hundreds or
+        thousands of links. Instead, we group the links by the version
+        of the target they need, and resolve each group's targets (and
+        their document types) with a single call to `Doc.bulk_load()`,
+        skipping the XML. Links to the same version of the same document
+        share a single `Doc` object.
+
+        Pass:
+          session - reference to object representing the current login
+          links - sequence of `Link` objects created with `resolve=False`
+        """
+
+        # Find out which documents we need for which versions.
+        wanted = dict()
+        for link in links:
+            if link.internal:
+                try:
+                    doc_id = Doc.extract_id(link.target_id)
+                except Exception:
+                    continue
+                if link.target_version not in wanted:
+                    wanted[link.target_version] = set()
+                wanted[link.target_version].add(doc_id)
+
+        # Fetch the documents, one query per version specifier.
+        targets = dict()
+        for version, ids in wanted.items():
+            opts = dict(xml=False, deleted=True)
+            for doc in Doc.bulk_load(session, sorted(ids), version, **opts):
+                targets[(version, doc.id)] = doc
+
+        # Plug the target documents into the links.
+        for link in links:
+            if link.internal:
+                try:
+                    doc_id = Doc.extract_id(link.target_id)
+                except Exception:
+                    doc_id = None
+                target_doc = targets.get((link.target_version, doc_id))
+                if target_doc is None:
+                    session.logger.debug("target %r not found", link.url)
+                    link.store = False
+                else:
+                    link.target_doc = target_doc
+        args = len(links), len(targets)
+        session.logger.debug("resolved %d links to %d targets", *args)
+
     def save(self, cursor):
         """
         Remember the link in the `link_net` table
@@ -7652,6 +10585,14 @@ class Link:
           cursor - session's object for executing the INSERT statement
         """
 
+        cursor.execute(self.INSERT, self.row)
+
+    @property
+    def row(self):
+        """
+        Tuple of values for the link's `link_net` row (see `FIELDS`)
+        """
+
         target_doc = self.target_doc
         target_doc_id = target_doc.id if target_doc else None
         fields = dict(
@@ -7662,11 +10603,74 @@ class Link:
             target_frag=self.fragment_id,
             url=self.url
         )
-        names = sorted(fields)
-        placeholders = ["?"] * len(names)
-        args = ", ".join(names), ", ".join(placeholders)
-        insert = "INSERT INTO link_net ({}) VALUES ({})".format(*args)
-        cursor.execute(insert, tuple([fields[name] for name in names]))
+        return tuple([fields[name] for name in self.FIELDS])
+
+    @property
+    def fragment_table(self):
+        """
+        Name of the table holding the fragment IDs of the target version
+        """
+
+        return "query_term_pub" if self.chk_type == "P" else "query_term"
+
+    @classmethod
+    def load_fragments(cls, session, links):
+        """
+        Fetch the fragment IDs for the targets of a batch of links
+
+        Instead of running a query for each link to a fragment in
+        another document, we collect the distinct target documents for
+        all such links and fetch their fragment IDs with one query per
+        index table (in chunks for very large lists), so the links can
+        be checked in memory. The sets of fragment IDs are cached for
+        the session (see `Session.Cache`), up to `FRAGMENT_CACHE_SIZE`
+        target documents.
+
+        Pass:
+          session - reference to object representing the current login
+          links - sequence of `Link` objects
+        """
+
+        # Find the target documents whose fragment IDs we don't have yet.
+        wanted = dict()
+        with session.cache.fragment_lock:
+            for link in links:
+                if link.internal and link.fragment_id and link.target_doc:
+                    doc_id = link.target_doc.id
+                    if doc_id != link.doc.id:
+                        table = link.fragment_table
+                        if (doc_id, table) not in session.cache.fragments:
+                            if table not in wanted:
+                                wanted[table] = set()
+                            wanted[table].add(doc_id)
+        if not wanted:
+            return
+
+        # Fetch the fragment IDs, with an empty set for targets with none.
+        cursor = session.conn.cursor()
+        try:
+            for table, ids in wanted.items():
+                fragments = {doc_id: set() for doc_id in ids}
+                ids = sorted(ids)
+                chunk_size = Doc.BULK_LOAD_CHUNK_SIZE
+                for start in range(0, len(ids), chunk_size):
+                    chunk = ids[start:start+chunk_size]
+                    query = Query(table, "doc_id", "value")
+                    query.where(query.Condition("doc_id", chunk, "IN"))
+                    query.where("path LIKE '%@cdr:id'")
+                    for row in query.execute(cursor).fetchall():
+                        fragments[row.doc_id].add(row.value)
+                with session.cache.fragment_lock:
+                    cache = session.cache.fragments
+                    for doc_id in ids:
+                        while len(cache) >= cls.FRAGMENT_CACHE_SIZE:
+                            del cache[next(iter(cache))]
+                        cache[(doc_id, table)] = fragments[doc_id]
+                args = len(ids), table
+                session.logger.debug("loaded fragment IDs for %d docs from %s",
+                                     *args)
+        finally:
+            cursor.close()
 
     def add_error(self, message):
         """
@@ -7699,19 +10703,18 @@ class Link:
 
         # Check links to a specific location in the target document.
         if self.fragment_id:
-            table = "query_term_pub" if self.chk_type == "P" else "query_term"
             if self.target_doc.id == self.doc.id:
                 found = self.fragment_id in self.doc.frag_ids
             else:
-                found = False
-                query = Query(table, "value")
-                query.where(query.Condition("doc_id", self.target_doc.id))
-                query.where(query.Condition("value", self.fragment_id))
-                query.where("path LIKE '%@cdr:id'")
-                for row in query.execute(self.doc.cursor).fetchall():
-                    if self.fragment_id == row.value:
-                        found = True
-                        break
+                session = self.doc.session
+                key = self.target_doc.id, self.fragment_table
+                with session.cache.fragment_lock:
+                    fragments = session.cache.fragments.get(key)
+                if fragments is None:
+                    self.load_fragments(session, [self])
+                    with session.cache.fragment_lock:
+                        fragments = session.cache.fragments.get(key, set())
+                found = self.fragment_id in fragments
             if not found:
                 template = "Fragment {} not found in target document"
                 message = template.format(self.fragment_id)
@@ -708,7 +708,7 @@ class Job:
                     control.logger.info("Selecting for query\n%s\n", sql)
                     cursor = control.conn.cursor()
                     cursor.execute(sql)
-                    for row in cursor.fetchall():
+                    for row in Query.iterate(cursor):
                         doc_id = row[0]
                         if row[0] not in control.processed:
                             version = row[1] if len(row) > 1 else "lastp"
@@ -3,7 +3,7 @@ Search support in the CDR
 """
 
 from cdrapi.db import Query
-from cdrapi.docs import Doc
+from cdrapi.docs import Doc, IndexPlan
 
 
 class Search:
@@ -355,6 +355,10 @@ class QueryTermDef:
         """
         Store the new query term definition
 
+        Existing documents are not indexed for the new path until
+        they are saved or reindexed; run `bulk_reindex.py --paths`
+        to backfill just the new path's values.
+
         Called by:
           cdr.addQueryTermDef()
           client XML wrapper command CdrAddQueryTermDef
@@ -375,6 +379,7 @@ class QueryTermDef:
         insert = f"INSERT INTO query_term_def ({names}) VALUES (?, ?)"
         self.session.cursor.execute(insert, values)
         self.session.conn.commit()
+        IndexPlan.invalidate()
 
     def delete(self):
         """
@@ -397,6 +402,7 @@ class QueryTermDef:
             self.session.cursor.execute("ROLLBACK TRANSACTION")
             raise Exception("Query term definition not found")
         self.session.conn.commit()
+        IndexPlan.invalidate()
 
     @classmethod
     def get_rules(cls, session):
@@ -1332,7 +1332,8 @@ class Session:
 
     class Cache:
         """
-        Optimization for retrieval of filters, filter sets, and terms
+        Optimization for retrieval of filters, filter sets, terms, and
+        the fragment IDs of link target documents
 
         The fetching and caching of terms (which is complicated) seems
         to be obsolete, as the users just told us that the denormalization
@@ -1347,10 +1348,12 @@ class Session:
 
             self.terms = {}
             self.filters = {}
-            self.filter_sets = {}
+            self.filter_sets = {} # indexed by (set ID, version, cutoff)
+            self.fragments = {} # indexed by (doc ID, query term table)
             self.term_lock = threading.Lock()
             self.filter_lock = threading.Lock()
             self.filter_set_lock = threading.Lock()
+            self.fragment_lock = threading.Lock()
 
         def clear(self):
             """
@@ -1363,6 +1366,8 @@ class Session:
                 self.filters = {}
             with self.filter_set_lock:
                 self.filter_sets = {}
+            with self.fragment_lock:
+                self.fragments = {}
 
 
     class Local(threading.local):
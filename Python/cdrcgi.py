@@ -250,7 +250,8 @@ class Controller:
         """Factor out logic for collecting a valid values set.
 
         This works because our tables for valid values have the
-        same structure.
+        same structure. The rows are held in the process-wide cache
+        for reference tables.
 
         Pass:
             table_name - name of the database table for the values
@@ -260,7 +261,9 @@ class Controller:
         """
 
         query = self.Query(table_name, "value_id", "value_name")
-        rows = query.order("value_pos").execute(self.cursor).fetchall()
+        query.order("value_pos")
+        opts = dict(cursor=self.cursor, tier=self.tier)
+        rows = db.RefCache.get(table_name, "valid values", query, **opts)
         class Values:
             def __init__(self, rows):
                 self.map = {}
@@ -614,7 +617,7 @@ function {function_name}(value) {{
     def conn(self):
         """Database connection for this controller."""
         if not hasattr(self, "_conn"):
-            self._conn = db.connect()
+            self._conn = db.connect(tier=self.tier)
         return self._conn
 
     @property
@@ -925,6 +928,11 @@ jQuery(function() {
         """Title to be used for the page."""
         return self.__opts.get("title") or self.TITLE or self.PAGE_TITLE
 
+    @property
+    def tier(self):
+        """Tier on which this controller's database connection is opened."""
+        return TIER
+
     @staticmethod
     def bail(message=TAMPERING, banner="CDR Web Interface", extra=None,
              logfile=None):
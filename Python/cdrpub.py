@@ -29,7 +29,7 @@ from lxml import etree, html
 from PIL import Image
 import cdr
 from cdrapi import db
-from cdrapi.docs import Doc
+from cdrapi.docs import Doc, Resolver
 from cdrapi.publishing import Job, DrupalClient
 from cdrapi.settings import Tier
 from cdrapi.users import Session
@@ -135,16 +135,26 @@ class Control:
             self.logger.debug("Job %d opts=%s", *args)
             self.processed = set()
 
-            # 2. Export jobs don't have a `SubSetName` parameter.
-            if "SubSetName" not in self.job.parms:
-                self.export_docs()
-                verb = "Exported"
-                count = len(self.processed)
+            # Filter callbacks made in this thread can be reused for the
+            # life of the job, keyed by the job's document cutoff.
+            cutoff = self.job.parms.get("MaxDocUpdatedDate")
+            if not cutoff or cutoff == "JobStartDateTime":
+                cutoff = self.job.started
+            Resolver.cache_callbacks(cutoff=cutoff)
+            try:
 
-            # 3. Otherwise, this is a push job.
-            else:
-                verb = "Pushed"
-                count = self.push_docs()
+                # 2. Export jobs don't have a `SubSetName` parameter.
+                if "SubSetName" not in self.job.parms:
+                    self.export_docs()
+                    verb = "Exported"
+                    count = len(self.processed)
+
+                # 3. Otherwise, this is a push job.
+                else:
+                    verb = "Pushed"
+                    count = self.push_docs()
+            finally:
+                Resolver.stop_caching_callbacks(self.logger)
 
             # Report the job's completion.
             elapsed = (datetime.datetime.now() - start).total_seconds()
@@ -17,6 +17,7 @@ import lxml.etree as etree
 import requests
 import cdr
 from cdrapi import db
+from cdrapi.docs import ConceptNameCache
 
 class NamedValue:
     """
@@ -502,7 +503,8 @@ class Concept:
             "print-xml",
             "print-changes",
             "find-changed-terms",
-            "count-properties"
+            "count-properties",
+            "warm-name-cache"
         )
         formatter_class = argparse.ArgumentDefaultsHelpFormatter
         parser = argparse.ArgumentParser(formatter_class=formatter_class)
@@ -513,9 +515,31 @@ class Concept:
         parser.add_argument("--indent", type=int, default=2)
         parser.add_argument("--directory", default=".")
         parser.add_argument("--filename")
+        parser.add_argument("--refresh", action="store_true")
         args = parser.parse_args()
         getattr(cls, args.action.replace("-", "_"))(args)
 
+    @classmethod
+    def warm_name_cache(cls, args):
+        """
+        Pre-fetch the preferred names used by the ncit-pn filter callback
+
+        Fills the persistent cache of concept names for all of the
+        concepts referenced by CDR Term documents, so that publishing
+        jobs never have to wait on EVS. Only names which are missing
+        or stale are fetched, unless the --refresh option is used.
+
+        Pass:
+            args - dictionary of command line arguments (this action
+                   uses the --limit and --refresh options)
+        """
+
+        cache = ConceptNameCache.get_cache(cdr.Tier())
+        opts = dict(limit=args.limit, refresh=args.refresh, logger=cls.logger)
+        counts = cache.warm(**opts)
+        print("cached={cached} fetched={fetched} failed={failed}".format(
+              **counts))
+
     @classmethod
     def find_changed_terms(cls, args):
         """
@@ -12,15 +12,23 @@ read the documentation in the `cdrapi` package.
 """
 
 import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
 import os
 import random
+import re
 import string
+import tempfile
+import threading
 import time
 import unittest
+from unittest import mock
 from lxml import etree
 import cdr
 from cdrapi.users import Session
 from cdrapi import db
+from cdrapi.docs import ConceptNameCache, Doc, IndexPlan, Resolver
+from cdrapi.docs import Filter, FilterSetCache, Link, ValidationMemo
 
 
 class Tests(unittest.TestCase):
@@ -47,6 +55,150 @@ class Tests(unittest.TestCase):
         chars = string.ascii_letters + string.digits + string.punctuation
         return "".join(random.choice(chars) for _ in range(length))
 
+
+class _10ThesaurusTests_(unittest.TestCase):
+    """Exercise the concept name cache against a stub EVS server."""
+    class Handler(BaseHTTPRequestHandler):
+        requests = []
+        def do_GET(self):
+            self.requests.append(self.path)
+            if self.path == "/C1234/":
+                body = json.dumps(dict(preferredName="Test Concept"))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body.encode("utf-8"))
+            else:
+                self.send_response(404)
+                self.end_headers()
+        def log_message(self, *args):
+            pass
+    def test_75_ncit_cache__(self):
+        server = HTTPServer(("127.0.0.1", 0), self.Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/{{}}/"
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "names.db")
+                cache = ConceptNameCache(path, url=url, timeout=5)
+                self.assertIsNone(cache.get("C1234"))
+                self.assertEqual(cache.fetch("c1234"), "Test Concept")
+                self.assertEqual(cache.fetch("C9999"), "")
+                cache = ConceptNameCache(path, url=url)
+                self.assertEqual(cache.get("C1234"), "Test Concept")
+                self.assertEqual(cache.get("C9999"), "")
+                self.assertEqual(len(self.Handler.requests), 2)
+                cache = ConceptNameCache(path, url=url, negative_ttl=-1)
+                self.assertIsNone(cache.get("C9999"))
+                cache = ConceptNameCache(path, url=url, ttl=-1)
+                self.assertIsNone(cache.get("C1234"))
+                name = cache.get("C1234", allow_stale=True)
+                self.assertEqual(name, "Test Concept")
+                self.assertEqual(len(self.Handler.requests), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class _15IndexPlanTests_(unittest.TestCase):
+    """Compare the plan-driven indexing with the original path lookups."""
+    XML = """\
+<Summary xmlns:cdr="cims.nci.nih.gov/cdr">
+ <Title>T</Title>
+ <Para cdr:id="_1">P<Term cdr:ref="CDR0000000042">X</Term></Para>
+ <Section><Title>S</Title><Para cdr:id="_2">Q</Para></Section>
+ <Extra><a><b><Term cdr:ref="CDR0000000043">Y</Term></b></a></Extra>
+</Summary>"""
+    PATHS = (
+        "/Summary/Title",
+        "/Summary/Section/Title",
+        "/Summary/Section/Para/@cdr:id",
+        "/Summary/Para/Term/@cdr:ref",
+        "/Summary/Missing/Title",
+        "/Other/Title",
+    )
+    WILD = "//@cdr:ref", "//Term"
+    @classmethod
+    def old_terms(cls, node, terms, paths, parent="", loc=""):
+        if len(loc) > Doc.MAX_LOCATION_LENGTH:
+            raise Exception("Indexing beyond max allowed depth")
+        path = f"{parent}/{node.tag}"
+        if path in paths or f"//{node.tag}" in paths:
+            terms.add((path, loc, Doc.get_text(node, "")))
+        for name, value in node.attrib.items():
+            name = name.replace(f"{{{Doc.NS}}}", "cdr:")
+            attr_path = f"{path}/@{name}"
+            if attr_path in paths or f"//@{name}" in paths:
+                terms.add((attr_path, loc, value))
+        for position, child in enumerate(node.findall("*")):
+            child_loc = loc + Doc.HEX_INDEX.format(position)
+            cls.old_terms(child, terms, paths, path, child_loc)
+        return terms
+    def test_82_index_plan__(self):
+        doc = Doc(None, xml=self.XML)
+        root = etree.fromstring(self.XML)
+        for paths in (self.PATHS, self.PATHS + self.WILD):
+            plan = IndexPlan("Summary", paths)
+            self.assertEqual(plan.prunable, paths == self.PATHS)
+            expected = self.old_terms(root, set(), set(paths))
+            self.assertTrue(expected)
+            actual = doc._Doc__collect_query_terms(root, plan)
+            self.assertEqual(actual, expected)
+        deep = etree.SubElement(root.find("Extra"), "d")
+        for _ in range(Doc.MAX_INDEX_ELEMENT_DEPTH):
+            deep = etree.SubElement(deep, "d")
+        plan = IndexPlan("Summary", self.PATHS)
+        with self.assertRaises(Exception):
+            doc._Doc__collect_query_terms(root, plan)
+
+class _20LineMapTests___(unittest.TestCase):
+    """Compare the lazy line map with the original eager map."""
+    SCHEMA = """\
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+ <xs:element name="doc">
+  <xs:complexType>
+   <xs:choice maxOccurs="unbounded">
+    <xs:element name="item" type="xs:int"/>
+    <xs:element name="code" type="xs:string"/>
+   </xs:choice>
+  </xs:complexType>
+ </xs:element>
+</xs:schema>"""
+    class EagerLineMap:
+        def __init__(self, root):
+            self.lines = dict()
+            for node in root.iter("*"):
+                line = self.lines.get(node.sourceline)
+                if not line:
+                    line = self.lines[node.sourceline] = Doc.LineMap.Line()
+                line.add_node(node.tag, node.get("cdr-eid"))
+        def get_error_location(self, error):
+            line = self.lines.get(error.line)
+            return line and line.get_error_location(error) or None
+    def test_90_line_map____(self):
+        lines = ['<doc cdr-eid="_0">', ' <item cdr-eid="_1">1</item>']
+        lines.append(' <item cdr-eid="_2">bad</item>')
+        lines.append(' <code cdr-eid="_3">a</code><item cdr-eid="_4">x</item>')
+        for i in range(5, 205):
+            lines.append(f' <item cdr-eid="_{i}">{i}</item>')
+        lines.append("</doc>")
+        xml = "\n".join(lines)
+        root = etree.fromstring(xml)
+        doc = Doc(None, xml=xml)
+        copy, eids = doc._Doc__prepare_for_validation(root)
+        self.assertIsNone(copy.find("item").get("cdr-eid"))
+        schema = etree.XMLSchema(etree.fromstring(self.SCHEMA))
+        self.assertFalse(schema.validate(copy))
+        errors = list(schema.error_log)
+        line_map = Doc.LineMap((n.sourceline, n.tag, e) for n, e in eids)
+        eager_map = self.EagerLineMap(root)
+        actual = [line_map.get_error_location(e) for e in errors]
+        expected = [eager_map.get_error_location(e) for e in errors]
+        self.assertEqual(actual, expected)
+        self.assertEqual(expected, ["_2", "_4"])
+        self.assertLess(len(line_map.lines), len(eager_map.lines))
+
 # Set FULL to False temporarily when adding new tests so you can get
 # the new ones working without having to grind through the entire set.
 
@@ -1096,5 +1248,317 @@ if FULL:
             value = cdr.getControlValue("test", "n", tier=self.TIER)
             self.assertIsNone(value)
 
+    class _11RevMarkupTests_(Tests):
+        def test_76_rev_markup__(self):
+            session = Session(self.session, tier=self.TIER)
+            query = db.Query("document", "id").limit(25).order("id DESC")
+            query.where("xml LIKE '%<Insertion%' OR xml LIKE '%<Deletion%'")
+            rows = query.execute(session.cursor).fetchall()
+            for row in rows:
+                doc = Doc(session, id=row.id)
+                for level in (1, 2, 3):
+                    self.assertTrue(doc.check_revision_markup(level))
+            xml = ("<x>a<Insertion RevisionLevel='approved'>b</Insertion>c"
+                   "<Deletion RevisionLevel='publish'>d</Deletion>e</x>")
+            root = etree.fromstring(xml)
+            for level, expected in ((3, "<x>ace</x>"), (2, "<x>abce</x>")):
+                resolved = Doc.resolve_revision_markup(root, level)
+                actual = etree.tostring(resolved, encoding="unicode")
+                self.assertEqual(actual, expected)
+
+    class _12SaveTimingTests(Tests):
+        def test_77_save_timing_(self):
+            session = Session(self.session, tier=self.TIER)
+            xml = "<xxtest><Title>timing test</Title></xxtest>"
+            doc = Doc(session, xml=xml, doctype="xxtest")
+            opts = dict(timing=True, unlock=True, title="timing test")
+            doc.save(**opts)
+            try:
+                self.assertIsNotNone(doc.timing)
+                self.assertTrue(doc.timing.phases)
+                self.assertGreater(doc.timing.statements, 0)
+            finally:
+                doc.delete(reason="unit test cleanup")
+
+    class _13CallbackTests__(Tests):
+        FILTER = """\
+<xsl:transform version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+ <xsl:template match="/">
+  <{}><xsl:value-of select="document('cdrutil:/tier')"/></{}>
+ </xsl:template>
+</xsl:transform>"""
+        def test_78_filter_cache(self):
+            session = Session(self.session, tier=self.TIER)
+            doc = Doc(session, xml="<x/>")
+            Resolver.cache_callbacks(cutoff=datetime.datetime.now())
+            try:
+                for name in ("a", "b"):
+                    result = doc.filter(filter=self.FILTER.format(name, name))
+                    self.assertIn(session.tier.name, str(result.result_tree))
+            finally:
+                cache = Resolver.stop_caching_callbacks(self.logger)
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(cache.hits, 1)
+            self.assertIsNone(Resolver.local.callback_cache)
+        def test_79_memo_lookups(self):
+            xsl = """\
+<xsl:transform version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+ <xsl:template match="/">
+  <r>
+   <xsl:value-of select="document('cdr:/{}/DocTitle')"/>
+   <xsl:value-of select="document('cdrutil:/valid-zip/{}')"/>
+  </r>
+ </xsl:template>
+</xsl:transform>"""
+            session = Session(self.session, tier=self.TIER)
+            doc = Doc(session, xml="<x/>")
+            cache = Resolver.cache_callbacks()
+            try:
+                doc.filter(filter=xsl.format("CDR0000062902", "20892"))
+                self.assertEqual(cache.hits, 0)
+                zipcodes = Resolver.local.zipcodes
+                self.assertIsNotNone(zipcodes)
+                doc.filter(filter=xsl.format("62902", "20892"))
+                self.assertEqual(cache.hits, 2)
+                doc.filter(filter=xsl.format("62902", "20892-1234"))
+                self.assertEqual(cache.hits, 3)
+                self.assertIs(Resolver.local.zipcodes, zipcodes)
+            finally:
+                Resolver.stop_caching_callbacks(self.logger)
+            self.assertIsNone(Resolver.local.zipcodes)
+
+    class _14ValidationMemo_(Tests):
+        XML = "<xxtest><Title>{}</Title></xxtest>"
+        def setUp(self):
+            Tests.setUp(self)
+            self.directory = tempfile.TemporaryDirectory()
+            path = os.path.join(self.directory.name, "memo.db")
+            self.saved = os.environ.get("CDR_VALIDATION_MEMO")
+            os.environ["CDR_VALIDATION_MEMO"] = path
+            self.doc_session = Session(self.session, tier=self.TIER)
+        def tearDown(self):
+            if self.saved is None:
+                del os.environ["CDR_VALIDATION_MEMO"]
+            else:
+                os.environ["CDR_VALIDATION_MEMO"] = self.saved
+            self.directory.cleanup()
+            Tests.tearDown(self)
+        def validate(self, title, **opts):
+            xml = self.XML.format(title)
+            doc = Doc(self.doc_session, xml=xml, doctype="xxtest")
+            checks = []
+            check = ValidationMemo.check
+            def wrapper(memo, *args):
+                checks.append(check(memo, *args))
+                return checks[-1]
+            with mock.patch.object(ValidationMemo, "check", wrapper):
+                doc.validate(store="never", **opts)
+            return checks, doc.val_status
+        def test_80_val_memo_hit(self):
+            checks, status = self.validate("memo test", memo=True)
+            self.assertEqual(checks, [False])
+            self.assertEqual(self.validate("memo test", memo=True),
+                             ([True], status))
+            checks, status = self.validate("memo test edited", memo=True)
+            self.assertEqual(checks, [False])
+        def test_81_val_memo_off(self):
+            self.assertEqual(self.validate("memo test", memo=True)[0], [False])
+            self.assertEqual(self.validate("memo test")[0], [])
+            self.assertEqual(self.validate("memo test", memo=False)[0], [])
+            self.assertEqual(self.validate("memo test", memo=True)[0], [True])
+            ValidationMemo.invalidate(self.doc_session, "xxtest")
+            self.assertEqual(self.validate("memo test", memo=True)[0], [False])
+
+    class _16FilterCacheTest(Tests):
+        FILTER = """\
+<xsl:transform version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+ <xsl:template match="/"><{}/></xsl:template>
+</xsl:transform>"""
+        def test_83_xslt_cache__(self):
+            session = Session(self.session, tier=self.TIER)
+            Filter.TRANSFORMS.get(self.FILTER.format("cached"))
+            self.assertGreater(len(Filter.TRANSFORMS), 0)
+            xml = self.FILTER.format("saved")
+            doc = Doc(session, xml=xml, doctype="Filter")
+            doc.save(unlock=True, title="transform cache test")
+            try:
+                self.assertEqual(len(Filter.TRANSFORMS), 0)
+            finally:
+                doc.delete(reason="unit test cleanup")
+        def test_84_filter_set___(self):
+            session = Session(self.session, tier=self.TIER)
+            filters = cdr.getFilters(self.session, tier=self.TIER)[:2]
+            members = [cdr.IdAndName(f.id, f.name) for f in filters]
+            name = "Filter Set Cache Test {}".format(datetime.datetime.now())
+            args = name, "Filter set cache test", None, members[:1]
+            filter_set = cdr.FilterSet(*args)
+            cdr.addFilterSet(self.session, filter_set, tier=self.TIER)
+            try:
+                sets = cdr.getFilterSets(self.session, tier=self.TIER)
+                set_id = dict([(s.name, s.id) for s in sets])[name]
+                doc_id = int(filters[0].id[3:])
+                cache = FilterSetCache()
+                cache.put(session, set_id, [Filter(doc_id, "<x/>")])
+                self.assertIsNotNone(cache.get(session, set_id))
+                filter_set.members = members
+                cdr.repFilterSet(self.session, filter_set, tier=self.TIER)
+                self.assertIsNone(cache.get(session, set_id))
+            finally:
+                cdr.delFilterSet(self.session, name, tier=self.TIER)
+
+    class _17SchemaCacheTest(Tests):
+        def test_85_schema_lru__(self):
+            session = Session(self.session, tier=self.TIER)
+            xml = "<xxtest><Title>schema cache test</Title></xxtest>"
+            query = db.Query("document d", "d.id").limit(1)
+            query.join("doc_type t", "t.id = d.doc_type")
+            query.where("t.name = 'Summary'")
+            doc_id = query.execute(session.cursor).fetchone().id
+            docs = (
+                Doc(session, xml=xml, doctype="xxtest"),
+                Doc(session, id=doc_id),
+            )
+            with mock.patch.object(Doc, "SCHEMA_CACHE_SIZE", 1):
+                for doc in docs + docs:
+                    doc.validate(store="never")
+                    self.assertEqual(len(Doc.SCHEMAS), 1)
+                    key = list(Doc.SCHEMAS)[0]
+                    self.assertEqual(key[1], doc.doctype.schema_id)
+
+    class _18LinkCheckTests_(Tests):
+        def find_doc(self, session, pattern):
+            query = db.Query("document d", "d.id").limit(1).order("d.id DESC")
+            query.join("doc_type t", "t.id = d.doc_type")
+            query.where("t.name = 'Summary'")
+            query.where(query.Condition("d.xml", pattern, "LIKE"))
+            return Doc(session, id=query.execute(session.cursor).fetchone().id)
+        def test_86_link_targets(self):
+            session = Session(self.session, tier=self.TIER)
+            doc = self.find_doc(session, "%cdr:ref=%")
+            name = Doc.qname("ref")
+            nodes = doc.root.xpath("//*[@cdr:ref]", namespaces=Doc.NSMAP)
+            nodes.append(etree.Element(nodes[0].tag, {name: "CDR0999999999"}))
+            single = [Link(doc, node, name) for node in nodes]
+            batch = [Link(doc, node, name, resolve=False) for node in nodes]
+            Link.resolve_targets(session, batch)
+            def describe(link):
+                target = link.target_doc
+                if target is not None:
+                    target = target.id, target.version, target.doctype.name
+                return link.url, link.target_version, link.store, target
+            self.assertEqual([describe(l) for l in batch],
+                             [describe(l) for l in single])
+            self.assertIsNone(batch[-1].target_doc)
+            self.assertFalse(batch[-1].store)
+        def test_87_fragment_ids(self):
+            session = Session(self.session, tier=self.TIER)
+            doc = self.find_doc(session, "%cdr:href=\"CDR%#%")
+            name = Doc.qname("href")
+            nodes = doc.root.xpath("//*[@cdr:href]", namespaces=Doc.NSMAP)
+            nodes = [node for node in nodes if "#" in node.get(name)]
+            links = [Link(doc, node, name) for node in nodes]
+            for link in links:
+                if link.target_doc and link.target_doc.id != doc.id:
+                    url = f"{link.target_id}#_no_such_fragment"
+                    node = etree.Element(link.element, {name: url})
+                    links.append(Link(doc, node, name))
+                    break
+            expected = []
+            for link in links:
+                if link.target_doc and link.target_doc.id != doc.id:
+                    query = db.Query(link.fragment_table, "value")
+                    query.where(query.Condition("doc_id", link.target_doc.id))
+                    query.where(query.Condition("value", link.fragment_id))
+                    query.where("path LIKE '%@cdr:id'")
+                    if not query.execute(session.cursor).fetchall():
+                        expected.append(link.fragment_id)
+            self.assertIn("_no_such_fragment", expected)
+            for batch in (False, True):
+                session.cache.clear()
+                doc._errors = []
+                if batch:
+                    Link.load_fragments(session, links)
+                for link in links:
+                    link.validate()
+                actual = []
+                for error in doc.errors:
+                    match = re.match(r"Fragment (.+) not found", error.message)
+                    if match:
+                        actual.append(match.group(1))
+                self.assertEqual(actual, expected)
+
+    class _19BatchWriteTest_(Tests):
+        def setUp(self):
+            Tests.setUp(self)
+            self.doc_session = Session(self.session, tier=self.TIER)
+            self.conn = db.connect(tier=self.TIER)
+            self.cursor = self.conn.cursor()
+            query = db.Query("document d", "d.id").limit(1).order("d.id DESC")
+            query.join("doc_type t", "t.id = d.doc_type")
+            query.where("t.name = 'Summary'")
+            query.where("d.xml LIKE '%cdr:ref=%'")
+            self.doc_id = query.execute(self.cursor).fetchone().id
+        def tearDown(self):
+            self.conn.close()
+            Tests.tearDown(self)
+        def fetch(self, table, key, *columns):
+            query = db.Query(table, *columns).order(*columns)
+            query.where(query.Condition(key, self.doc_id))
+            return [tuple(row) for row in query.execute(self.cursor)]
+        def test_88_query_terms_(self):
+            columns = "path", "node_loc", "value", "int_val"
+            doc = Doc(self.doc_session, id=self.doc_id)
+            with mock.patch.object(Doc, "BULK_QUERY_TERMS", False):
+                doc.update_query_terms(tables=["query_term"], force=True)
+                self.doc_session.conn.commit()
+            expected = self.fetch("query_term", "doc_id", *columns)
+            self.assertTrue(expected)
+            delete = ("DELETE FROM query_term WHERE doc_id = ? AND path = ?"
+                      " AND node_loc = ? AND value = ?")
+            insert = ("INSERT INTO query_term"
+                      " (doc_id, path, node_loc, value, int_val)"
+                      " VALUES (?, '/Summary/Bogus', '0001', 'bogus', NULL)")
+            for bulk in (False, True):
+                for row in expected[::2]:
+                    self.cursor.execute(delete, (self.doc_id,) + row[:3])
+                self.cursor.execute(insert, (self.doc_id,))
+                self.conn.commit()
+                with mock.patch.object(Doc, "BULK_QUERY_TERMS", bulk):
+                    doc.update_query_terms(tables=["query_term"], force=True)
+                    self.doc_session.conn.commit()
+                actual = self.fetch("query_term", "doc_id", *columns)
+                self.assertEqual(actual, expected)
+        def test_89_link_net____(self):
+            columns = "link_type", "source_elem", "target_doc", "target_frag"
+            columns += "url",
+            doc = Doc(self.doc_session, id=self.doc_id)
+            with mock.patch.object(Doc, "BULK_QUERY_TERMS", False):
+                doc.set_links()
+            links = self.fetch("link_net", "source_doc", *columns)
+            fragments = self.fetch("link_fragment", "doc_id", "fragment")
+            self.assertTrue(links)
+            delete = ("DELETE FROM link_net WHERE source_doc = ?"
+                      " AND source_elem = ? AND url = ?")
+            insert = ("INSERT INTO link_net (link_type, source_doc,"
+                      " source_elem, url) VALUES (?, ?, 'Bogus', 'bogus')")
+            delete_fragment = ("DELETE FROM link_fragment WHERE doc_id = ?"
+                               " AND fragment = ?")
+            insert_fragment = ("INSERT INTO link_fragment (doc_id, fragment)"
+                               " VALUES (?, '_bogus')")
+            for bulk in (False, True):
+                for row in links[::2]:
+                    self.cursor.execute(delete, (self.doc_id, row[1], row[4]))
+                self.cursor.execute(insert, (links[0][0], self.doc_id))
+                for row in fragments[::2]:
+                    self.cursor.execute(delete_fragment, (self.doc_id, row[0]))
+                self.cursor.execute(insert_fragment, (self.doc_id,))
+                self.conn.commit()
+                with mock.patch.object(Doc, "BULK_QUERY_TERMS", bulk):
+                    doc.set_links()
+                actual = self.fetch("link_net", "source_doc", *columns)
+                self.assertEqual(actual, links)
+                actual = self.fetch("link_fragment", "doc_id", "fragment")
+                self.assertEqual(actual, fragments)
+
 if __name__ == "__main__":
     unittest.main()